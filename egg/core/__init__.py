@@ -4,9 +4,20 @@
 # LICENSE file in the root directory of this source tree.
 
 from .trainers import Trainer
-from .callbacks import Callback, ConsoleLogger, TensorboardLogger, TemperatureUpdater, CheckpointSaver
-from .util import init, get_opts, build_optimizer, dump_sender_receiver, move_to, get_summary_writer, close
-from .early_stopping import EarlyStopperAccuracy
+from .callbacks import (Callback, ConsoleLogger, TensorboardLogger, TemperatureUpdater,
+                        CheckpointSaver, CheckpointManager, StepTimer)
+from .util import (init, get_opts, build_optimizer, dump_sender_receiver, move_to, get_summary_writer, close, autocast,
+                   RandomStateIterator)
+from .early_stopping import (EarlyStopperAccuracy, EarlyStopperPlateau, EarlyStopperMovingAverage,
+                             EarlyStopperWallClock)
+from .metrics import MetricsAccumulator
+from .prefetch import PrefetchIterator
+from .distributed import get_rank, get_world_size, is_main_process
+from .compilation import compile_game
+from .evaluation import Interaction, InteractionCapture
+from .ensemble import EnsembleGame, build_ensemble
+from .checkpoint_evaluation import evaluate_checkpoints, load_model_state
+from .sampling import sample_categorical, gumbel_softmax_sample
 from .gs_wrappers import (GumbelSoftmaxWrapper,
                           SymbolGameGS, RelaxedEmbedding,
                           RnnSenderGS, RnnReceiverGS,
@@ -27,10 +38,15 @@ __all__ = [
     'build_optimizer',
     'Callback',
     'EarlyStopperAccuracy',
+    'EarlyStopperPlateau',
+    'EarlyStopperMovingAverage',
+    'EarlyStopperWallClock',
     'ConsoleLogger',
     'TensorboardLogger',
     'TemperatureUpdater',
     'CheckpointSaver',
+    'CheckpointManager',
+    'StepTimer',
     'ReinforceWrapper',
     'GumbelSoftmaxWrapper',
     'SymbolGameGS',
@@ -46,8 +62,24 @@ __all__ = [
     'SenderReceiverRnnGS',
     'dump_sender_receiver',
     'move_to',
+    'RandomStateIterator',
+    'autocast',
     'get_summary_writer',
     'close',
+    'MetricsAccumulator',
+    'PrefetchIterator',
+    'get_rank',
+    'get_world_size',
+    'is_main_process',
+    'compile_game',
+    'Interaction',
+    'InteractionCapture',
+    'EnsembleGame',
+    'build_ensemble',
+    'evaluate_checkpoints',
+    'load_model_state',
+    'sample_categorical',
+    'gumbel_softmax_sample',
     'SymbolReceiverWrapper',
     'TransformerReceiverDeterministic',
     'TransformerSenderReinforce',
@@ -3,17 +3,27 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
 import json
-from typing import Dict, Any, Union,  NamedTuple
+import time
+from collections import defaultdict
+from typing import Dict, Any, Union, Sequence, Optional
 import pathlib
 
+import numpy as np
 import torch
 
 from egg.core.util import get_summary_writer
+from egg.core.checkpointing import (AsyncCheckpointWriter, Checkpoint, CHECKPOINT_SUFFIXES, save_checkpoint,
+                                    read_manifest, write_manifest)
+from egg.core.evaluation import Interaction
+from egg.core.metrics import MetricsAccumulator
 
 
 class Callback:
     trainer: 'Trainer'
+    # under distributed training, such callbacks are only run by the process with rank 0
+    main_process_only: bool = False
 
     def on_train_begin(self, trainer_instance: 'Trainer'):
         self.trainer = trainer_instance
@@ -33,22 +43,78 @@ class Callback:
     def on_epoch_end(self, loss: float, logs: Dict[str, Any] = None):
         pass
 
+    def on_batch_begin(self, batch: Any, batch_id: int):
+        pass
+
+    def state_dict(self) -> Optional[Dict[str, Any]]:
+        """
+        The state of the callback that is saved in the checkpoints and restored when the training is resumed
+        """
+        return None
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        pass
+
+    def on_batch_end(self, batch: Any, loss: torch.Tensor, logs: Dict[str, Any], batch_id: int):
+        """
+        Called after the forward/backward passes (and the optimizer step, if one is done) over a training batch.
+        `loss` and the values of `logs` are those returned by the game, averaged over the micro-batches; they are
+        not transferred to the host, nor aggregated over the processes under distributed training, hence reading them
+        (e.g. with `.item()`) synchronizes with the device.
+        Trainer only dispatches the batch-level events to the callbacks that override them.
+        """
+        pass
+
+    def on_test_batch_end(self, game: torch.nn.Module, interaction: Interaction, batch_id: int):
+        """
+        Called after the forward pass of the game over a validation batch, within `torch.no_grad()`. `interaction`
+        holds the inputs, the messages, and the outputs of Receiver of that very pass, hence the analyses of the
+        communication (e.g. entropies, interventions, dumps) do not need to run the agents over the data again; `game`
+        is the evaluated game in the evaluation mode, e.g. for running Receiver on altered messages.
+        Under asynchronous validation, the event is dispatched from the validation thread.
+        """
+        pass
+
+
+def _validation_epoch(logger: Callback) -> int:
+    # under asynchronous validation, the results can arrive after the epoch counter of the logger has moved on
+    trainer = getattr(logger, 'trainer', None)
+    return trainer.validation_epoch if trainer is not None else logger.epoch_counter
+
 
 class ConsoleLogger(Callback):
+    main_process_only = True
 
-    def __init__(self, print_train_loss=False, as_json=False):
+    def __init__(self, print_train_loss=False, as_json=False, print_every_steps=0):
+        """
+        :param print_every_steps: if positive (and `print_train_loss` is set), the training loss and metrics averaged
+            over the last `print_every_steps` training batches are printed, too; e.g. for games with endless data
+            streams, whose epochs are arbitrary
+        """
         self.print_train_loss = print_train_loss
         self.as_json = as_json
+        self.print_every_steps = print_every_steps
         self.epoch_counter = 0
+        self._step_accumulator = MetricsAccumulator()
+        if print_train_loss and print_every_steps > 0:
+            # otherwise, Trainer does not dispatch the batch-level events to the logger at all
+            self.on_batch_end = self._log_steps
+
+    def state_dict(self):
+        return dict(epoch_counter=self.epoch_counter)
+
+    def load_state_dict(self, state):
+        self.epoch_counter = state['epoch_counter']
 
     def on_test_end(self, loss: float, logs: Dict[str, Any] = None):
+        epoch = _validation_epoch(self)
         if self.as_json:
-            dump = dict(mode='test', epoch=self.epoch_counter, loss=self._get_metric(loss))
+            dump = dict(mode='test', epoch=epoch, loss=self._get_metric(loss))
             for k, v in logs.items():
                 dump[k] = self._get_metric(v)
             output_message = json.dumps(dump)
         else:
-            output_message = f'test: epoch {self.epoch_counter}, loss {loss},  {logs}'
+            output_message = f'test: epoch {epoch}, loss {loss},  {logs}'
         print(output_message, flush=True)
 
     def on_epoch_end(self, loss: float, logs: Dict[str, Any] = None):
@@ -63,6 +129,24 @@ class ConsoleLogger(Callback):
             print(output_message, flush=True)
         self.epoch_counter += 1
 
+    def _log_steps(self, batch: Any, loss: torch.Tensor, logs: Dict[str, Any], batch_id: int):
+        self._step_accumulator.update(loss, logs, n_samples=1)
+        step = self.trainer.global_step
+        if step % self.print_every_steps != 0:
+            return
+
+        # the statistics of this process only, as the other ones do not run the logger
+        loss, logs = self._step_accumulator.means()
+        self._step_accumulator = MetricsAccumulator()
+        loss, logs = float(loss), {k: float(v) for k, v in logs.items()}
+        if self.as_json:
+            dump = dict(mode='train', epoch=self.epoch_counter, step=step, loss=loss)
+            dump.update(logs)
+            output_message = json.dumps(dump)
+        else:
+            output_message = f'train: epoch {self.epoch_counter}, step {step}, loss {loss},  {logs}'
+        print(output_message, flush=True)
+
     def _get_metric(self, metric: Union[torch.Tensor, float]) -> float:
         if torch.is_tensor(metric) and metric.dim() > 1:
             return metric.mean().item()
@@ -75,84 +159,358 @@ class ConsoleLogger(Callback):
 
 
 class TensorboardLogger(Callback):
+    main_process_only = True
 
     def __init__(self, writer=None):
         if writer:
             self.writer = writer
         else:
-            self.writer = get_summary_writer
+            self.writer = get_summary_writer()
         self.epoch_counter = 0
 
+    def state_dict(self):
+        return dict(epoch_counter=self.epoch_counter)
+
+    def load_state_dict(self, state):
+        self.epoch_counter = state['epoch_counter']
+
     def on_test_end(self, loss: float, logs: Dict[str, Any] = None):
-        self.writer.add_scalar(tag=f'test/loss', scalar_value=loss.mean(), global_step=self.epoch)
+        epoch = _validation_epoch(self)
+        self.writer.add_scalar(tag=f'test/loss', scalar_value=loss, global_step=epoch)
         for k, v in logs.items():
-            self.writer.add_scalar(tag=f'test/{k}', scalar_value=v, global_step=self.epoch)
+            self.writer.add_scalar(tag=f'test/{k}', scalar_value=v, global_step=epoch)
 
     def on_epoch_end(self, loss: float, logs: Dict[str, Any] = None):
-        self.writer.add_scalar(tag=f'train/loss', scalar_value=loss.mean(), global_step=self.epoch)
+        self.writer.add_scalar(tag=f'train/loss', scalar_value=loss, global_step=self.epoch_counter)
         for k, v in logs.items():
-            self.writer.add_scalar(tag=f'train/{k}', scalar_value=v, global_step=self.epoch)
+            self.writer.add_scalar(tag=f'train/{k}', scalar_value=v, global_step=self.epoch_counter)
         self.epoch_counter += 1
 
     def on_train_end(self):
         self.writer.close()
 
 
+class StepTimer(Callback):
+    """
+    Measures the time Trainer spends in each phase of a training (or evaluation) step: fetching the data (`data`),
+    moving it to the device (`move_to`), the forward pass (`forward`), the backward pass (`backward`), and the
+    optimizer step (`optimizer`). At the end of each epoch, the p50/p95/p99 of the per-step time of each phase (in ms),
+    together with the throughput (`steps_per_sec`, `samples_per_sec`), are added to the logs passed to the other
+    callbacks, hence they are printed by ConsoleLogger and written by TensorboardLogger. Under distributed training,
+    the statistics are those of the process with rank 0.
+
+    As CUDA kernels run asynchronously, the device is synchronized at each phase boundary when `synchronize` is set;
+    this makes the attribution exact at the price of a slight slowdown. When the callback is not used, Trainer does not
+    measure anything.
+
+    >>> timer = StepTimer()
+    >>> timer.begin('train', 'cpu')
+    >>> for _ in range(4):
+    ...     timer.mark('data')
+    ...     timer.mark('forward')
+    ...     timer.end_step(n_samples=8)
+    >>> stats = timer.summary()
+    >>> sorted(k for k in stats if k.startswith('forward'))
+    ['forward_ms_p50', 'forward_ms_p95', 'forward_ms_p99']
+    >>> round(stats['samples_per_sec'] / stats['steps_per_sec'])
+    8
+    """
+    def __init__(self, synchronize: bool = True, percentiles: Sequence[float] = (50, 95, 99)):
+        self.synchronize = synchronize
+        self.percentiles = percentiles
+        self.begin('train', 'cpu')
+
+    def begin(self, mode: str, device: torch.device) -> None:
+        """
+        Resets the statistics; called by Trainer before the first step of a training or evaluation epoch.
+        """
+        self.mode = mode
+        self._sync_cuda = self.synchronize and torch.device(device).type == 'cuda'
+        self._phases = defaultdict(list)
+        self._current = defaultdict(float)
+        self._step_times = []
+        self._n_samples = 0
+        self._step_start = self._last_mark = self._now()
+
+    def _now(self) -> float:
+        if self._sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def mark(self, phase: str) -> None:
+        """
+        Attributes the time since the previous mark (or the start of the step) to `phase`. A phase can be marked several
+        times within a step (e.g. forward and backward of micro-batches), then the times are summed up.
+        """
+        now = self._now()
+        self._current[phase] += now - self._last_mark
+        self._last_mark = now
+
+    def end_step(self, n_samples: int) -> None:
+        now = self._now()
+        for phase, duration in self._current.items():
+            self._phases[phase].append(duration)
+        self._current.clear()
+        self._step_times.append(now - self._step_start)
+        self._n_samples += n_samples
+        self._step_start = self._last_mark = now
+
+    def skip(self) -> None:
+        """
+        Excludes the time since the previous mark from the statistics, e.g. that of a validation run within a
+        training epoch.
+        """
+        self._current.clear()
+        self._step_start = self._last_mark = self._now()
+
+    def summary(self) -> Dict[str, float]:
+        """
+        :return: a dict with the percentiles of the per-step time of each phase, steps/sec and samples/sec
+        """
+        stats = {}
+        for phase, durations in self._phases.items():
+            values = np.percentile(np.array(durations) * 1000.0, self.percentiles)
+            for q, v in zip(self.percentiles, values):
+                stats[f'{phase}_ms_p{q:g}'] = float(v)
+
+        total_time = sum(self._step_times)
+        if total_time > 0:
+            stats['steps_per_sec'] = len(self._step_times) / total_time
+            stats['samples_per_sec'] = self._n_samples / total_time
+        return stats
+
+
 class TemperatureUpdater(Callback):
 
-    def __init__(self, agent, decay=0.9, minimum=0.1, update_frequency=1):
+    def __init__(self, agent, decay=0.9, minimum=0.1, update_frequency=1, unit='epoch'):
+        """
+        :param unit: 'epoch' or 'step'; `update_frequency` is measured in epochs or in training batches, respectively
+        """
         self.agent = agent
         assert hasattr(agent, 'temperature'), 'Agent must have a `temperature` attribute'
         assert not isinstance(agent.temperature, torch.nn.Parameter), \
             'When using TemperatureUpdater, `temperature` cannot be trainable'
+        assert unit in ('epoch', 'step'), f'Unknown unit {unit}'
         self.decay = decay
         self.minimum = minimum
         self.update_frequency = update_frequency
+        self.unit = unit
         self.epoch_counter = 0
+        self.step_counter = 0
 
-    def on_epoch_end(self, loss: float, logs: Dict[str, Any] = None):
-        if self.epoch_counter % self.update_frequency == 0:
+    def state_dict(self):
+        return dict(temperature=self.agent.temperature, epoch_counter=self.epoch_counter,
+                    step_counter=self.step_counter)
+
+    def load_state_dict(self, state):
+        self.agent.temperature = state['temperature']
+        self.epoch_counter = state['epoch_counter']
+        self.step_counter = state['step_counter']
+
+    def _update(self, counter: int):
+        if counter % self.update_frequency == 0:
             self.agent.temperature = max(self.minimum, self.agent.temperature * self.decay)
-        self.epoch_counter += 1
 
+    def on_epoch_end(self, loss: float, logs: Dict[str, Any] = None):
+        if self.unit == 'epoch':
+            self._update(self.epoch_counter)
+        self.epoch_counter += 1
 
-class Checkpoint(NamedTuple):
-    epoch: int
-    model_state_dict: Dict[str, Any]
-    optimizer_state_dict: Dict[str, Any]
+    def on_batch_end(self, batch: Any, loss: torch.Tensor, logs: Dict[str, Any], batch_id: int):
+        if self.unit == 'step':
+            self._update(self.step_counter)
+        self.step_counter += 1
 
 
 class CheckpointSaver(Callback):
+    """
+    Saves the checkpoints of the game, the optimizer, and the training loop (see `Trainer.state_dict()`). Trainer
+    dispatches the epoch- and batch-end events to the CheckpointSavers after the other callbacks, hence the saved
+    states of the other callbacks are those after the epoch (batch).
+    """
+    main_process_only = True
 
     def __init__(
             self,
             checkpoint_path: Union[str, pathlib.Path],
             checkpoint_freq: int = 1,
-            prefix: str = ''
+            prefix: str = '',
+            unit: str = 'epoch',
+            async_write: bool = False,
+            max_pending_writes: int = 1,
+            format: str = 'torch'
     ):
+        """
+        :param unit: 'epoch' or 'step'; `checkpoint_freq` is measured in epochs or in training batches, respectively.
+            The step-level checkpoints are named `step_<number of training batches>.tar`
+        :param async_write: if set, the states are copied to host memory and the training continues while they are
+            written to the disk by a background thread
+        :param max_pending_writes: under `async_write`, the maximal number of checkpoints that are being written at the
+            same time; saving another one blocks until the oldest is written
+        :param format: 'torch' saves the checkpoints with torch.save, as `.tar` files; 'flat' saves them as `.flat`
+            files, whose sections (e.g. the weights alone) can be memory-mapped without unpickling, see
+            `checkpointing.save_flat`
+        """
+        assert unit in ('epoch', 'step'), f'Unknown unit {unit}'
+        assert format in CHECKPOINT_SUFFIXES, f'Unknown checkpoint format {format}'
+        self.format = format
+        self.suffix = CHECKPOINT_SUFFIXES[format]
         self.checkpoint_path = pathlib.Path(checkpoint_path)
         self.checkpoint_freq = checkpoint_freq
         self.prefix = prefix
+        self.unit = unit
         self.epoch_counter = 0
+        self.writer = AsyncCheckpointWriter(max_pending_writes) if async_write else None
+        # the longest time saving a checkpoint took, used by Trainer to leave time for the final one
+        self.save_seconds = 0.0
+
+    def state_dict(self):
+        return dict(epoch_counter=self.epoch_counter)
+
+    def load_state_dict(self, state):
+        self.epoch_counter = state['epoch_counter']
 
     def on_epoch_end(self, loss: float, logs: Dict[str, Any] = None):
-        if self.checkpoint_freq > 0 and (self.epoch_counter % self.checkpoint_freq == 0):
-            filename = f'{self.prefix}_{self.epoch_counter}' if self.prefix else str(self.epoch_counter)
-            self.save_checkpoint(filename=filename)
+        epoch = self.epoch_counter
+        # the counter is updated before saving, so that the saved state of the callback is that after the epoch
         self.epoch_counter += 1
+        if self.unit == 'epoch' and self.checkpoint_freq > 0 and (epoch % self.checkpoint_freq == 0):
+            filename = f'{self.prefix}_{epoch}' if self.prefix else str(epoch)
+            self.save_checkpoint(filename=filename)
+
+    def on_batch_end(self, batch: Any, loss: torch.Tensor, logs: Dict[str, Any], batch_id: int):
+        step = self.trainer.global_step
+        if self.unit == 'step' and self.checkpoint_freq > 0 and step % self.checkpoint_freq == 0:
+            filename = f'{self.prefix}_step_{step}' if self.prefix else f'step_{step}'
+            self.save_checkpoint(filename=filename)
 
     def on_train_end(self):
         self.save_checkpoint(filename=f'{self.prefix}_final' if self.prefix else 'final')
+        if self.writer is not None:
+            self.writer.flush()
 
     def save_checkpoint(self, filename: str):
         """
-        Saves the game, agents, and optimizer states to the checkpointing path under `<number_of_epochs>.tar` name
+        Saves the game, agents, and optimizer states to the checkpointing path under `<filename>.tar` (or `.flat`) name.
+        The file is written under a temporary name and renamed once complete, hence an interrupted write never leaves
+        a truncated checkpoint behind.
         """
+        start = time.perf_counter()
         self.checkpoint_path.mkdir(exist_ok=True)
-        path = self.checkpoint_path / f'{filename}.tar'
-        torch.save(self.get_checkpoint(), path)
+        path = self.checkpoint_path / f'{filename}{self.suffix}'
+        if self.writer is not None:
+            self.writer.submit(self.get_checkpoint(), path, self.format)
+        else:
+            save_checkpoint(self.get_checkpoint(), path, self.format)
+        duration = time.perf_counter() - start
+        if self.writer is not None:
+            duration += self.writer.last_write_seconds
+        self.save_seconds = max(self.save_seconds, duration)
 
     def get_checkpoint(self):
-        return Checkpoint(epoch=self.epoch_counter,
+        return Checkpoint(epoch=self.trainer.epoch,
                           model_state_dict=self.trainer.game.state_dict(),
-                          optimizer_state_dict=self.trainer.optimizer.state_dict())
+                          optimizer_state_dict=self.trainer.optimizer.state_dict(),
+                          trainer_state=self.trainer.state_dict())
+
+
+class CheckpointManager(CheckpointSaver):
+    """
+    A CheckpointSaver that only retains a subset of the saved checkpoints and keeps an index of them in a manifest
+    file, `checkpoints.json`, in the checkpointing directory. The manifest is replaced atomically after each change and
+    lists the retained checkpoints with their epoch, step, and metric value, together with the latest one; hence
+    `Trainer.load_from_latest` finds the checkpoint to resume from without listing the directory.
+
+    A checkpoint is retained if any of the policies selects it (the latest checkpoint is always retained):
+     * it is one of the `keep_last` most recent checkpoints;
+     * it is one of the `keep_best` checkpoints with the best value of `metric` on the validation data (the
+       value obtained by the evaluation of the same weights, possibly completed later under asynchronous validation);
+     * its number of completed epochs (or steps, when `unit='step'`) is divisible by `keep_every`.
+    If no policy is specified, all checkpoints are retained.
+    """
+    def __init__(
+            self,
+            checkpoint_path: Union[str, pathlib.Path],
+            checkpoint_freq: int = 1,
+            prefix: str = '',
+            keep_last: Optional[int] = None,
+            keep_best: Optional[int] = None,
+            metric: str = 'loss',
+            mode: str = 'min',
+            keep_every: Optional[int] = None,
+            **kwargs
+    ):
+        """
+        :param keep_last: the number of the most recent checkpoints to retain
+        :param keep_best: the number of the best checkpoints, according to `metric`, to retain
+        :param metric: the name of the validation metric used by `keep_best`; `loss` stands for the validation loss
+        :param mode: 'min' or 'max', whether a lower or a higher value of `metric` is better
+        :param keep_every: the checkpoints saved after a number of epochs (steps) divisible by `keep_every` are
+            retained
+        :param kwargs: passed to CheckpointSaver
+        """
+        super(CheckpointManager, self).__init__(checkpoint_path, checkpoint_freq, prefix, **kwargs)
+        assert mode in ('min', 'max'), f'Unknown mode {mode}'
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.metric = metric
+        self.mode = mode
+        self.keep_every = keep_every
+        # when resuming, the retention continues over the checkpoints of the previous runs
+        manifest = read_manifest(self.checkpoint_path)
+        self.entries = manifest['checkpoints'] if manifest is not None else []
+
+    def save_checkpoint(self, filename: str):
+        super(CheckpointManager, self).save_checkpoint(filename)
+        file = f'{filename}{self.suffix}'
+        self.entries = [e for e in self.entries if e['file'] != file]
+        self.entries.append(dict(file=file, epoch=self.trainer.epoch, step=self.trainer.global_step, metric=None))
+        self._update()
+
+    def on_test_end(self, loss: float, logs: Dict[str, Any] = None):
+        # the value is attached to the checkpoint of the evaluated weights, if there is one
+        entry = next((e for e in reversed(self.entries) if e['step'] == self.trainer.validation_step), None)
+        if entry is None or entry['metric'] is not None:
+            return
+        value = loss if self.metric == 'loss' else (logs or {}).get(self.metric)
+        if value is not None:
+            entry['metric'] = float(value)
+            self._update()
+
+    def _retained(self, entries):
+        if self.keep_last is None and self.keep_best is None and self.keep_every is None:
+            return entries
+
+        keep = {entries[-1]['file']}
+        if self.keep_last:
+            keep.update(e['file'] for e in entries[-self.keep_last:])
+        if self.keep_best:
+            scored = [e for e in entries if e['metric'] is not None]
+            scored.sort(key=lambda e: e['metric'], reverse=self.mode == 'max')
+            keep.update(e['file'] for e in scored[:self.keep_best])
+        if self.keep_every:
+            counter = 'step' if self.unit == 'step' else 'epoch'
+            keep.update(e['file'] for e in entries if e[counter] is not None and e[counter] % self.keep_every == 0)
+        return [e for e in entries if e['file'] in keep]
+
+    def _update(self):
+        retained = self._retained(self.entries)
+        removed = [e['file'] for e in self.entries if e not in retained]
+        self.entries = retained
+
+        checkpoint_dir = self.checkpoint_path
+        manifest = dict(latest=retained[-1]['file'], checkpoints=[dict(e) for e in retained])
+
+        def update_disk():
+            # the manifest never references a removed, or not yet written, checkpoint
+            write_manifest(checkpoint_dir, manifest)
+            for file in removed:
+                try:
+                    os.remove(checkpoint_dir / file)
+                except FileNotFoundError:
+                    pass
+
+        if self.writer is not None:
+            self.writer.run(update_disk)
+        else:
+            update_disk()
@@ -0,0 +1,114 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Union
+
+import csv
+import pathlib
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+from .checkpointing import _atomic_write, load_checkpoint
+from .ensemble import EnsembleGame
+from .metrics import MetricsAccumulator
+from .trainers import _get_batch_size
+from .util import autocast, get_opts, move_to
+
+
+def load_model_state(path: Union[str, pathlib.Path]) -> Dict[str, Any]:
+    """
+    Loads the state of the game from a checkpoint saved by CheckpointSaver, in either format. The file is
+    memory-mapped where possible, hence the tensors are only read from the disk when used, and the optimizer state is
+    never read.
+    """
+    return load_checkpoint(path, sections=['model_state_dict']).model_state_dict
+
+
+def _architecture(game: nn.Module) -> Any:
+    return type(game), tuple((name, tuple(value.shape), value.dtype) for name, value in game.state_dict().items()
+                             if torch.is_tensor(value))
+
+
+def evaluate_checkpoints(
+        make_game: Callable[[pathlib.Path], nn.Module],
+        checkpoint_paths: Iterable[Union[str, pathlib.Path]],
+        data: Iterable[Any],
+        output_path: Optional[Union[str, pathlib.Path]] = None,
+        group_size: int = 16,
+        vectorized: bool = True,
+        device: Optional[torch.device] = None
+) -> List[Dict[str, Any]]:
+    """
+    Evaluates many checkpoints (e.g. those of a sweep) on the same data, in a single process. The data is moved to the
+    device once and stays there; the checkpoints are loaded one by one, and the games built for them are grouped by
+    architecture: once `group_size` games of the same architecture are loaded, they are evaluated at once as an
+    EnsembleGame, i.e. with their weights stacked (see EnsembleGame for the games that need `vectorized=False`).
+
+    :param make_game: builds a game for a checkpoint, given its path; e.g. the hyperparameters of the game can be
+        parsed from the path
+    :param data: the evaluation batches, by agreement (sender_input, labels) plus an optional receiver_input; the
+        whole data is kept on the device
+    :param output_path: if set, the metrics table is written there as a CSV file
+    :param group_size: the maximal number of checkpoints evaluated at once
+    :return: the metrics table, a row per checkpoint in the order of `checkpoint_paths`, with its path, the loss, and
+        the auxiliary metrics of the game averaged over the data
+    """
+    device = device if device is not None else get_opts().device
+    batches = [move_to(batch, device) for batch in data]
+    paths = [pathlib.Path(path) for path in checkpoint_paths]
+
+    results = {}
+    # the games waiting to be evaluated, by architecture
+    pending = OrderedDict()
+
+    def flush(architecture):
+        chunk = pending.pop(architecture)
+        ensemble = EnsembleGame([game for _, game in chunk], vectorized).to(device)
+        results.update(zip([path for path, _ in chunk], _evaluate_ensemble(ensemble, batches, device)))
+
+    for path in paths:
+        game = make_game(path)
+        game.load_state_dict(load_model_state(path))
+        architecture = _architecture(game)
+        pending.setdefault(architecture, []).append((path, game))
+        if len(pending[architecture]) == group_size:
+            flush(architecture)
+    for architecture in list(pending):
+        flush(architecture)
+
+    table = [dict(checkpoint=str(path), **results[path]) for path in paths]
+    if output_path is not None:
+        write_metrics_table(table, output_path)
+    return table
+
+
+def _evaluate_ensemble(ensemble: EnsembleGame, batches: Sequence[Any], device: torch.device) \
+        -> List[Dict[str, float]]:
+    ensemble.eval()
+    accumulator = MetricsAccumulator()
+    with torch.no_grad():
+        for batch in batches:
+            with autocast(device):
+                loss, rest = ensemble(*batch)
+            accumulator.update(loss, rest, _get_batch_size(batch))
+    _, metrics = accumulator.result()
+
+    names = [name[:-2] for name in metrics if name.endswith('_0')]
+    return [{name: metrics[f'{name}_{i}'] for name in names} for i in range(ensemble.n_replicas)]
+
+
+def write_metrics_table(table: List[Dict[str, Any]], path: Union[str, pathlib.Path]) -> None:
+    """
+    Writes a list of rows as a CSV file, with the union of their columns; the file is replaced atomically.
+    """
+    columns = list(OrderedDict.fromkeys(column for row in table for column in row))
+
+    def write(f):
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(table)
+    _atomic_write(path, write, mode='w')
@@ -0,0 +1,372 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Union
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import copy
+import json
+import os
+import pathlib
+import pickle
+import struct
+import threading
+import time
+
+import torch
+
+# the index of the checkpoints stored in a directory, maintained by CheckpointManager
+MANIFEST_NAME = 'checkpoints.json'
+
+# the file suffixes of the checkpoint formats, see `save_checkpoint`
+CHECKPOINT_SUFFIXES = {'torch': '.tar', 'flat': '.flat'}
+FLAT_MAGIC = b'EGGFLAT1'
+# the offsets of the tensors in a flat checkpoint are aligned, hence any dtype can be viewed in place
+_FLAT_ALIGNMENT = 64
+
+
+class Checkpoint(NamedTuple):
+    epoch: int
+    model_state_dict: Dict[str, Any]
+    optimizer_state_dict: Dict[str, Any]
+    # the state of the training loop, see Trainer.state_dict(); absent in the checkpoints of the older versions
+    trainer_state: Optional[Dict[str, Any]] = None
+
+
+def _atomic_write(path: Union[str, pathlib.Path], write: Callable[[Any], None], mode: str = 'wb') -> None:
+    path = pathlib.Path(path)
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    with open(tmp_path, mode) as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    try:
+        # make the rename itself durable
+        dir_fd = os.open(path.parent, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def atomic_save(obj: Any, path: Union[str, pathlib.Path]) -> None:
+    """
+    Saves `obj` with torch.save into a temporary file next to `path`, flushes it to the disk, and renames it to `path`.
+    Hence, `path` either holds a complete checkpoint or is not touched, even if the process is killed while writing.
+    """
+    _atomic_write(path, lambda f: torch.save(obj, f))
+
+
+def _align(offset: int) -> int:
+    return (offset + _FLAT_ALIGNMENT - 1) // _FLAT_ALIGNMENT * _FLAT_ALIGNMENT
+
+
+def _encode(x: Any, tensors: List[torch.Tensor]) -> Any:
+    """
+    Encodes a nested state as JSON, replacing the tensors by their indices in `tensors`. Tuples and dicts are tagged,
+    so that they are decoded with the same types and keys; the values JSON cannot hold are pickled into byte tensors.
+    """
+    if torch.is_tensor(x):
+        tensors.append(x)
+        return {'__tensor__': len(tensors) - 1}
+    if x is None or isinstance(x, (bool, int, float, str)):
+        return x
+    if isinstance(x, list):
+        return [_encode(v, tensors) for v in x]
+    if type(x) is tuple:
+        return {'__tuple__': [_encode(v, tensors) for v in x]}
+    if type(x) in (dict, OrderedDict):
+        encoded = {'__dict__': [[_encode(k, tensors), _encode(v, tensors)] for k, v in x.items()]}
+        # the state dicts of the modules carry the versions of their submodules
+        if getattr(x, '_metadata', None) is not None:
+            encoded['__metadata__'] = _encode(x._metadata, tensors)
+        if type(x) is OrderedDict:
+            encoded['__ordered__'] = True
+        return encoded
+    tensors.append(torch.frombuffer(bytearray(pickle.dumps(x)), dtype=torch.uint8))
+    return {'__pickle__': len(tensors) - 1}
+
+
+def _decode(x: Any, tensor: Callable[[int], torch.Tensor]) -> Any:
+    if isinstance(x, list):
+        return [_decode(v, tensor) for v in x]
+    if not isinstance(x, dict):
+        return x
+    if '__tensor__' in x:
+        return tensor(x['__tensor__'])
+    if '__pickle__' in x:
+        return pickle.loads(tensor(x['__pickle__']).numpy().tobytes())
+    if '__tuple__' in x:
+        return tuple(_decode(v, tensor) for v in x['__tuple__'])
+    decoded = (OrderedDict if x.get('__ordered__') else dict)(
+        (_decode(k, tensor), _decode(v, tensor)) for k, v in x['__dict__'])
+    if '__metadata__' in x:
+        decoded._metadata = _decode(x['__metadata__'], tensor)
+    return decoded
+
+
+def save_flat(checkpoint: Checkpoint, path: Union[str, pathlib.Path]) -> None:
+    """
+    Saves a checkpoint in the flat format: a JSON header describing each field of the checkpoint (a section),
+    followed by the raw bytes of all tensors, each at an aligned offset. The file is written atomically.
+    Loading it with `load_flat` memory-maps the file, without copying or unpickling the tensors, and only the
+    sections that are asked for are decoded; as the tensors of the model come first, loading the weights alone only
+    reads that part of the file.
+
+    >>> import tempfile
+    >>> path = pathlib.Path(tempfile.mkdtemp()) / 'checkpoint.flat'
+    >>> model = torch.nn.Linear(2, 1)
+    >>> save_flat(Checkpoint(epoch=3, model_state_dict=model.state_dict(), optimizer_state_dict={'state': {0: (1, 2)}}),
+    ...           path)
+    >>> checkpoint = load_flat(path)
+    >>> torch.equal(checkpoint.model_state_dict['weight'], model.weight), checkpoint.optimizer_state_dict
+    (True, {'state': {0: (1, 2)}})
+    >>> load_flat(path, sections=['model_state_dict']).optimizer_state_dict is None
+    True
+    """
+    tensors = []
+    sections = {name: _encode(value, tensors) for name, value in checkpoint._asdict().items()}
+
+    entries, offset = [], 0
+    data = []
+    for t in tensors:
+        t = t.detach().to('cpu').contiguous()
+        nbytes = t.numel() * t.element_size()
+        entries.append(dict(dtype=str(t.dtype).split('.')[-1], shape=list(t.shape), offset=offset, nbytes=nbytes))
+        data.append((offset, t))
+        offset = _align(offset + nbytes)
+    header = json.dumps(dict(sections=sections, tensors=entries)).encode('utf-8')
+    data_start = _align(len(FLAT_MAGIC) + 8 + len(header))
+
+    def write(f):
+        f.write(FLAT_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for tensor_offset, t in data:
+            f.seek(data_start + tensor_offset)
+            if t.numel() > 0:
+                f.write(t.reshape(-1).view(torch.uint8).numpy().data)
+        f.truncate(data_start + offset)
+    _atomic_write(path, write)
+
+
+def is_flat(path: Union[str, pathlib.Path]) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(FLAT_MAGIC)) == FLAT_MAGIC
+
+
+def load_flat(path: Union[str, pathlib.Path], sections: Optional[Sequence[str]] = None) -> Checkpoint:
+    """
+    Loads a checkpoint saved by `save_flat`. The tensors are views of a (copy-on-write) memory mapping of the file,
+    hence they are read from the disk on the first access.
+    :param sections: the fields of the checkpoint to load (default: all); the other ones are set to None
+    """
+    path = pathlib.Path(path)
+    with open(path, 'rb') as f:
+        assert f.read(len(FLAT_MAGIC)) == FLAT_MAGIC, f'{path} is not a flat checkpoint'
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    data_start = _align(len(FLAT_MAGIC) + 8 + header_size)
+    storage = torch.UntypedStorage.from_file(str(path), False, os.path.getsize(path))
+    data = torch.empty(0, dtype=torch.uint8).set_(storage)
+
+    def tensor(i):
+        entry = header['tensors'][i]
+        start = data_start + entry['offset']
+        return data[start:start + entry['nbytes']].view(getattr(torch, entry['dtype'])).view(entry['shape'])
+
+    sections = header['sections'].keys() if sections is None else sections
+    return Checkpoint(**{name: _decode(header['sections'][name], tensor) if name in sections else None
+                         for name in header['sections']})
+
+
+def save_checkpoint(checkpoint: Checkpoint, path: Union[str, pathlib.Path], format: str = 'torch') -> None:
+    """
+    Saves a checkpoint atomically, either with torch.save ('torch') or in the flat format ('flat', see `save_flat`).
+    """
+    assert format in CHECKPOINT_SUFFIXES, f'Unknown checkpoint format {format}'
+    if format == 'flat':
+        save_flat(checkpoint, path)
+    else:
+        atomic_save(checkpoint, path)
+
+
+def load_checkpoint(path: Union[str, pathlib.Path], sections: Optional[Sequence[str]] = None) -> Checkpoint:
+    """
+    Loads a checkpoint in either format. Only flat checkpoints can skip the `sections` that are not asked for; the
+    torch ones are memory-mapped when possible, so that the tensors of the other sections are never read.
+    """
+    if is_flat(path):
+        return load_flat(path, sections)
+    try:
+        checkpoint = torch.load(path, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError):
+        # torch < 2.1, or a checkpoint in the legacy (non-zip) format, cannot be memory-mapped
+        checkpoint = torch.load(path, map_location='cpu')
+    return checkpoint
+
+
+def convert_checkpoint(path: Union[str, pathlib.Path], output_path: Optional[Union[str, pathlib.Path]] = None) \
+        -> pathlib.Path:
+    """
+    Converts a checkpoint saved with torch.save into the flat format.
+    :param output_path: default: `path` with the `.flat` suffix
+    :return: the path of the converted checkpoint
+    """
+    path = pathlib.Path(path)
+    output_path = path.with_suffix(CHECKPOINT_SUFFIXES['flat']) if output_path is None else pathlib.Path(output_path)
+    checkpoint = load_checkpoint(path)
+    save_flat(Checkpoint(*checkpoint), output_path)
+    return output_path
+
+
+def write_manifest(checkpoint_dir: Union[str, pathlib.Path], manifest: Dict[str, Any]) -> None:
+    _atomic_write(pathlib.Path(checkpoint_dir) / MANIFEST_NAME, lambda f: json.dump(manifest, f, indent=1), mode='w')
+
+
+def read_manifest(checkpoint_dir: Union[str, pathlib.Path]) -> Optional[Dict[str, Any]]:
+    """
+    :return: the manifest of the checkpoints in `checkpoint_dir`, or None if there is no (readable) manifest
+    """
+    try:
+        with open(pathlib.Path(checkpoint_dir) / MANIFEST_NAME) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _map_tensors(x: Any, fn: Callable[[torch.Tensor], torch.Tensor]) -> Any:
+    if torch.is_tensor(x):
+        return fn(x)
+    if isinstance(x, dict):
+        # a shallow copy preserves the type and the attributes, such as the `_metadata` of the state dicts
+        y = copy.copy(x)
+        for k, v in x.items():
+            y[k] = _map_tensors(v, fn)
+        return y
+    if isinstance(x, tuple) and hasattr(x, '_fields'):
+        return type(x)(*[_map_tensors(v, fn) for v in x])
+    if isinstance(x, (list, tuple)):
+        return type(x)(_map_tensors(v, fn) for v in x)
+    return copy.deepcopy(x)
+
+
+def _collect_tensors(x: Any, tensors: List[torch.Tensor]) -> List[torch.Tensor]:
+    # visits the tensors in the same order as _map_tensors
+    if torch.is_tensor(x):
+        tensors.append(x)
+    elif isinstance(x, dict):
+        for v in x.values():
+            _collect_tensors(v, tensors)
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            _collect_tensors(v, tensors)
+    return tensors
+
+
+class StateSnapshotter:
+    """
+    Copies the tensors of a (nested) state, e.g. a Checkpoint with the model and optimizer state dicts, to host memory,
+    so that the copy can be serialized while the training goes on. The host buffers are re-used by the following
+    snapshots once they are released; for CUDA tensors, the buffers are pinned and the copies are asynchronous, with
+    a single synchronization per snapshot.
+
+    >>> snapshotter = StateSnapshotter()
+    >>> weight = torch.ones(2)
+    >>> snapshot, buffers = snapshotter.snapshot({'weight': weight, 'step': 1})
+    >>> _ = weight.add_(1)
+    >>> snapshot
+    {'weight': tensor([1., 1.]), 'step': 1}
+    >>> snapshotter.release(buffers)
+    >>> snapshot, reused_buffers = snapshotter.snapshot({'weight': weight, 'step': 2})
+    >>> snapshot['weight'], reused_buffers is buffers
+    (tensor([2., 2.]), True)
+    """
+    def __init__(self):
+        self._free_buffers: List[List[torch.Tensor]] = []
+        self._lock = threading.Lock()
+
+    def snapshot(self, state: Any):
+        """
+        :return: a tuple of (a copy of `state` with all tensors on CPU, the buffers backing it); the buffers have to be
+            released with `release` once the copy is not used any more
+        """
+        tensors = _collect_tensors(state, [])
+
+        buffers = self._get_buffers(tensors)
+        has_cuda = False
+        for src, dst in zip(tensors, buffers):
+            has_cuda = has_cuda or src.is_cuda
+            dst.copy_(src.detach(), non_blocking=src.is_cuda)
+        if has_cuda:
+            torch.cuda.synchronize()
+
+        buffer_iter = iter(buffers)
+        return _map_tensors(state, lambda _: next(buffer_iter)), buffers
+
+    def release(self, buffers: List[torch.Tensor]) -> None:
+        with self._lock:
+            self._free_buffers.append(buffers)
+
+    def _get_buffers(self, tensors: List[torch.Tensor]) -> List[torch.Tensor]:
+        signature = [(t.shape, t.dtype) for t in tensors]
+        with self._lock:
+            for i, buffers in enumerate(self._free_buffers):
+                if [(b.shape, b.dtype) for b in buffers] == signature:
+                    return self._free_buffers.pop(i)
+
+        return [torch.empty(t.shape, dtype=t.dtype, device='cpu', pin_memory=t.is_cuda) for t in tensors]
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints with `save_checkpoint` from a background thread. At most `max_pending` writes can be in flight:
+    when submitting another one, the training thread blocks until the oldest is complete. The errors raised while
+    writing are re-raised in the training thread, by the following `submit` or `flush`.
+    `last_write_seconds` holds the time the last completed write took.
+    """
+    def __init__(self, max_pending: int = 1):
+        assert max_pending > 0, 'At least one write has to be allowed'
+        self.max_pending = max_pending
+        self.snapshotter = StateSnapshotter()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: List[Future] = []
+        self.last_write_seconds = 0.0
+
+    def submit(self, state: Any, path: Union[str, pathlib.Path], format: str = 'torch') -> None:
+        while len(self._pending) >= self.max_pending:
+            self._pending.pop(0).result()
+
+        snapshot, buffers = self.snapshotter.snapshot(state)
+
+        def write():
+            try:
+                start = time.perf_counter()
+                save_checkpoint(snapshot, path, format)
+                self.last_write_seconds = time.perf_counter() - start
+            finally:
+                self.snapshotter.release(buffers)
+
+        self._pending.append(self._executor.submit(write))
+
+    def run(self, fn: Callable[[], None]) -> None:
+        """
+        Runs `fn` in the background thread after all the previously submitted writes are done.
+        """
+        self._pending.append(self._executor.submit(fn))
+
+    def flush(self) -> None:
+        """
+        Blocks until all the submitted checkpoints are written.
+        """
+        while self._pending:
+            self._pending.pop(0).result()
@@ -0,0 +1,74 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from typing import Optional
+
+import os
+import pathlib
+
+import torch
+import torch.nn as nn
+
+
+def is_lstm_cell(cell: nn.Module) -> bool:
+    """
+    Checks if a (possibly TorchScript-scripted) cell is an LSTM cell, i.e. it has a tuple of (h, c) as its state.
+
+    >>> is_lstm_cell(nn.LSTMCell(2, 2)), is_lstm_cell(torch.jit.script(nn.LSTMCell(2, 2))), is_lstm_cell(nn.GRUCell(2, 2))
+    (True, True, False)
+    """
+    return isinstance(cell, nn.LSTMCell) or getattr(cell, 'original_name', None) == 'LSTMCell'
+
+
+def set_compile_cache_dir(cache_dir: str) -> None:
+    """
+    Makes torch.compile store the compiled artifacts (FX graphs and the generated kernels) in `cache_dir`, so that
+    they are re-used by the following runs of the same game, e.g. by other jobs of a hyperparameter sweep.
+    Has to be called before the first compilation.
+    """
+    cache_dir = str(pathlib.Path(cache_dir).absolute())
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+    os.environ['TORCHINDUCTOR_FX_GRAPH_CACHE'] = '1'
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except ImportError:
+        pass
+
+
+def script_cells(module: nn.Module) -> nn.Module:
+    """
+    Replaces, in-place, the RNN cells within `module` by their TorchScript-scripted versions. The scripted cells share
+    the parameters with the original ones, hence the optimizer and the state dict are not affected.
+
+    >>> sender = nn.Sequential(nn.Linear(2, 2), nn.GRUCell(2, 2))
+    >>> weight = sender[1].weight_ih
+    >>> sender = script_cells(sender)
+    >>> isinstance(sender[1], torch.jit.ScriptModule), sender[1].weight_ih is weight
+    (True, True)
+    """
+    for name, child in list(module.named_children()):
+        if isinstance(child, nn.RNNCellBase):
+            setattr(module, name, torch.jit.script(child))
+        elif not isinstance(child, torch.jit.ScriptModule):
+            script_cells(child)
+    return module
+
+
+def compile_game(game: nn.Module, cache_dir: Optional[str] = None) -> nn.Module:
+    """
+    Compiles the game with torch.compile, so that the per-step unrolls of the RNN agents are fused into a few
+    kernels. The returned module shares the parameters with `game`. On torch versions that do not have
+    torch.compile, falls back to scripting the RNN cells with TorchScript (in-place) and returns `game` itself.
+    :param game: game (or any other module) to be compiled
+    :param cache_dir: optional directory to store the compiled artifacts in, see `set_compile_cache_dir`
+    """
+    if not hasattr(torch, 'compile'):
+        return script_cells(game)
+
+    if cache_dir is not None:
+        set_compile_cache_dir(cache_dir)
+    return torch.compile(game)
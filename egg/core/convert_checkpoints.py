@@ -0,0 +1,33 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Converts checkpoints saved with torch.save (`.tar`) into the flat format (`.flat`), next to the original files:
+
+    python -m egg.core.convert_checkpoints checkpoints/*.tar
+"""
+
+import os
+import argparse
+
+from egg.core.checkpointing import convert_checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='the checkpoints to convert')
+    parser.add_argument('--remove', default=False, action='store_true',
+                        help='If the flag is set, the original checkpoints are removed once converted')
+    args = parser.parse_args()
+
+    for path in args.paths:
+        output_path = convert_checkpoint(path)
+        if args.remove:
+            os.remove(path)
+        print(f'{path} -> {output_path}')
+
+
+if __name__ == '__main__':
+    main()
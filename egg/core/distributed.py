@@ -0,0 +1,81 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from typing import Tuple
+
+import os
+import torch
+import torch.distributed as dist
+
+
+def is_distributed() -> bool:
+    """
+    :return: True if the process is a part of an initialized distributed process group
+    """
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def maybe_init_distributed(backend: str = 'gloo') -> bool:
+    """
+    Initializes the default process group if the process is launched by `torchrun` (or any other launcher that sets
+    the `RANK`, `WORLD_SIZE`, `MASTER_ADDR`, and `MASTER_PORT` environment variables) with more than one process.
+    :param backend: torch.distributed backend to be used (default: gloo, which works on CPU)
+    :return: True if the process is running in a distributed mode
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False
+    if not is_distributed():
+        dist.init_process_group(backend=backend)
+    return True
+
+
+def get_local_rank() -> int:
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def all_reduce_sum(tensor: torch.Tensor) -> torch.Tensor:
+    """
+    Sums the tensor over all the processes, in-place. A no-op if not running distributed.
+    """
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def sum_and_count(value: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns the sum of the elements of `value` and their number, aggregated over all the processes. Both are tensors
+    on the device of `value`, hence there is no host synchronisation.
+
+    >>> sum_and_count(torch.tensor([1.0, 2.0, 3.0]))
+    (tensor(6.), tensor(3.))
+    """
+    total = value.detach().float().sum()
+    count = torch.full_like(total, value.numel())
+    if not is_distributed():
+        return total, count
+
+    stats = all_reduce_sum(torch.stack([total, count]))
+    return stats[0], stats[1]
+
+
+def barrier() -> None:
+    """
+    Blocks until all the processes reach the barrier. A no-op if not running distributed.
+    """
+    if is_distributed():
+        dist.barrier()
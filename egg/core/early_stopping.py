@@ -3,28 +3,75 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-from typing import Dict, Any, List, Tuple
+from typing import Dict, Any, List, Optional, Tuple
+
+import time
+
+import torch
 
 from .callbacks import Callback
 
 
 class BaseEarlyStopper(Callback):
     """
-    A base class, supports the running statistic which is could be used for early stopping
+    A base class, supports the running statistic which is could be used for early stopping.
+    With `unit='step'`, the training statistics are recorded after each training batch instead of each epoch, and the
+    stopping criterion is checked after each batch, too; as the per-batch statistics have to be transferred to the
+    host, this synchronizes with the device at every step.
+    With `full_validation_only`, the validation runs that only use a subset of the validation data (see
+    `--validation_max_batches`) are ignored.
+    The statistics are passed to `observe()`, which appends them to `train_stats` and `validation_stats`; subclasses
+    that only need a summary of them override it to keep constant memory. The stopping criterion is checked after each
+    observation, and once it is met, the training stops even if the other early stoppers would continue.
     """
-    def __init__(self):
+    def __init__(self, unit: str = 'epoch', full_validation_only: bool = False):
         super(BaseEarlyStopper, self).__init__()
+        assert unit in ('epoch', 'step'), f'Unknown unit {unit}'
+        self.unit = unit
+        self.full_validation_only = full_validation_only
         self.train_stats: List[Tuple[float, Dict[str, Any]]] = []
         self.validation_stats: List[Tuple[float, Dict[str, Any]]] = []
         self.epoch: int = 0
+        self.step: int = 0
+
+    def state_dict(self) -> Dict[str, Any]:
+        return dict(train_stats=self.train_stats, validation_stats=self.validation_stats, epoch=self.epoch,
+                    step=self.step)
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self.train_stats = list(state['train_stats'])
+        self.validation_stats = list(state['validation_stats'])
+        self.epoch = state['epoch']
+        self.step = state['step']
 
     def on_epoch_end(self, loss: float, logs: Dict[str, Any] = None) -> None:
         self.epoch += 1
-        self.train_stats.append((loss, logs))
+        if self.unit == 'epoch':
+            self.observe(loss, logs, validation=False)
+            self._check()
+
+    def on_batch_end(self, batch: Any, loss: torch.Tensor, logs: Dict[str, Any], batch_id: int) -> None:
+        self.step += 1
+        if self.unit == 'step':
+            logs = {k: v.float().mean().item() if torch.is_tensor(v) else v for k, v in logs.items()}
+            self.observe(loss.item(), logs, validation=False)
+            self._check()
 
     def on_test_end(self, loss: float, logs: Dict[str, Any] = None) -> None:
-        self.validation_stats.append((loss, logs))
-        self.trainer.should_stop = self.should_stop()
+        if self.full_validation_only and not self.trainer.validation_full:
+            return
+        self.observe(loss, logs, validation=True)
+        self._check()
+
+    def observe(self, loss: float, logs: Dict[str, Any], validation: bool) -> None:
+        """
+        Records the statistics of a training epoch (step) or of a validation run.
+        """
+        (self.validation_stats if validation else self.train_stats).append((loss, logs))
+
+    def _check(self) -> None:
+        if self.should_stop():
+            self.trainer.should_stop = True
 
     def should_stop(self) -> bool:
         raise NotImplementedError()
@@ -35,17 +82,174 @@ class EarlyStopperAccuracy(BaseEarlyStopper):
     Implements early stopping logic that stops training when a threshold on a metric
     is achieved.
     """
-    def __init__(self, threshold: float, field_name: str = 'acc') -> None:
+    def __init__(self, threshold: float, field_name: str = 'acc', validation: bool = True, unit: str = 'epoch',
+                 full_validation_only: bool = False) -> None:
         """
         :param threshold: early stopping threshold for the validation set accuracy
             (assumes that the loss function returns the accuracy under name `field_name`)
         :param field_name: the name of the metric return by loss function which should be evaluated against stopping
             criterion (default: "acc")
+        :param validation: if set to False, the threshold is checked against the training statistics instead
+            (e.g. per step, when `unit='step'`) (default: True)
+        :param unit: 'epoch' or 'step', see BaseEarlyStopper
+        :param full_validation_only: if set, the threshold is only checked after the validation runs that use all the
+            validation data, see BaseEarlyStopper
         """
-        super(EarlyStopperAccuracy, self).__init__()
+        super(EarlyStopperAccuracy, self).__init__(unit=unit, full_validation_only=full_validation_only)
         self.threshold = threshold
         self.field_name = field_name
+        self.validation = validation
 
     def should_stop(self) -> bool:
-        assert self.trainer.validation_data is not None, 'Validation data must be provided for early stooping to work'
+        if not self.validation:
+            return self.train_stats[-1][1][self.field_name] > self.threshold
+        # the threshold is also checked at the end of the training epochs (steps), i.e. before the first validation
+        # run, or without validation data at all
+        if not self.validation_stats:
+            return False
         return self.validation_stats[-1][1][self.field_name] > self.threshold
+
+
+class EarlyStopperPlateau(BaseEarlyStopper):
+    """
+    Stops the training once a metric has not improved for `patience` consecutive observations, i.e. validation runs
+    (or training epochs/steps, with `validation=False`). An observation counts as an improvement if it is better
+    than the best one so far by more than `min_delta`. Only the best value and the number of observations since it
+    are kept.
+
+    >>> stopper = EarlyStopperPlateau(patience=2, min_delta=0.1)
+    >>> for loss in [1.0, 0.5, 0.45, 0.42]:
+    ...     stopper.observe(loss, {}, validation=True)
+    ...     print(stopper.best, stopper.bad_observations, stopper.should_stop())
+    1.0 0 False
+    0.5 0 False
+    0.5 1 False
+    0.5 2 True
+    """
+    def __init__(self, field_name: str = 'loss', mode: str = 'min', patience: int = 5, min_delta: float = 0.0,
+                 validation: bool = True, unit: str = 'epoch', full_validation_only: bool = False) -> None:
+        """
+        :param field_name: the metric to be monitored: `loss` or the name of a metric returned by the game
+        :param mode: 'min' or 'max', whether a lower or a higher value of the metric is better
+        :param patience: the number of observations without an improvement after which the training is stopped
+        :param min_delta: the minimal change of the metric that counts as an improvement
+        :param validation: whether the validation or the training statistics are monitored
+        :param unit: 'epoch' or 'step', see BaseEarlyStopper
+        :param full_validation_only: see BaseEarlyStopper
+        """
+        super(EarlyStopperPlateau, self).__init__(unit=unit, full_validation_only=full_validation_only)
+        assert mode in ('min', 'max'), f'Unknown mode {mode}'
+        assert patience > 0, 'patience must be positive'
+        self.field_name = field_name
+        self.mode = mode
+        self.patience = patience
+        self.min_delta = min_delta
+        self.validation = validation
+        self.best: Optional[float] = None
+        self.bad_observations = 0
+
+    def state_dict(self) -> Dict[str, Any]:
+        state = super(EarlyStopperPlateau, self).state_dict()
+        state.update(best=self.best, bad_observations=self.bad_observations)
+        return state
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        super(EarlyStopperPlateau, self).load_state_dict(state)
+        self.best = state['best']
+        self.bad_observations = state['bad_observations']
+
+    def _value(self, value: float) -> float:
+        return value
+
+    def observe(self, loss: float, logs: Dict[str, Any], validation: bool) -> None:
+        if validation != self.validation:
+            return
+        value = loss if self.field_name == 'loss' else logs[self.field_name]
+        value = self._value(float(value))
+
+        if self.best is None or \
+                (value < self.best - self.min_delta if self.mode == 'min' else value > self.best + self.min_delta):
+            self.best = value
+            self.bad_observations = 0
+        else:
+            self.bad_observations += 1
+
+    def should_stop(self) -> bool:
+        return self.bad_observations >= self.patience
+
+
+class EarlyStopperMovingAverage(EarlyStopperPlateau):
+    """
+    Like EarlyStopperPlateau, but monitors the exponential moving average of the metric, hence the training is not
+    stopped (or continued) by a single noisy observation, e.g. of the per-step training statistics.
+
+    >>> stopper = EarlyStopperMovingAverage(smoothing=0.5, patience=1)
+    >>> for loss in [1.0, 0.0, 1.0]:
+    ...     stopper.observe(loss, {}, validation=True)
+    ...     print(stopper.average, stopper.should_stop())
+    1.0 False
+    0.5 False
+    0.75 True
+    """
+    def __init__(self, smoothing: float = 0.9, **kwargs) -> None:
+        """
+        :param smoothing: the weight of the previous average, in [0, 1); 0 amounts to EarlyStopperPlateau
+        :param kwargs: passed to EarlyStopperPlateau
+        """
+        super(EarlyStopperMovingAverage, self).__init__(**kwargs)
+        assert 0.0 <= smoothing < 1.0, 'smoothing must be in [0, 1)'
+        self.smoothing = smoothing
+        self.average: Optional[float] = None
+
+    def state_dict(self) -> Dict[str, Any]:
+        state = super(EarlyStopperMovingAverage, self).state_dict()
+        state.update(average=self.average)
+        return state
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        super(EarlyStopperMovingAverage, self).load_state_dict(state)
+        self.average = state['average']
+
+    def _value(self, value: float) -> float:
+        if self.average is None:
+            self.average = value
+        else:
+            self.average = self.smoothing * self.average + (1.0 - self.smoothing) * value
+        return self.average
+
+
+class EarlyStopperWallClock(BaseEarlyStopper):
+    """
+    Stops the training once it has run for `max_seconds` of wall-clock time, checked after each training epoch (or
+    step, with `unit='step'`). The time is accumulated over the resumed runs, as it is a part of the state saved in the
+    checkpoints.
+    """
+    def __init__(self, max_seconds: float, unit: str = 'epoch') -> None:
+        super(EarlyStopperWallClock, self).__init__(unit=unit)
+        self.max_seconds = max_seconds
+        self.elapsed = 0.0  # the time spent in the previous runs
+        self._start: Optional[float] = None
+
+    def on_train_begin(self, trainer_instance: 'Trainer'):
+        super(EarlyStopperWallClock, self).on_train_begin(trainer_instance)
+        self._start = time.monotonic()
+
+    def elapsed_seconds(self) -> float:
+        return self.elapsed + (time.monotonic() - self._start if self._start is not None else 0.0)
+
+    def state_dict(self) -> Dict[str, Any]:
+        state = super(EarlyStopperWallClock, self).state_dict()
+        state.update(elapsed=self.elapsed_seconds())
+        return state
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        super(EarlyStopperWallClock, self).load_state_dict(state)
+        self.elapsed = state['elapsed']
+        if self._start is not None:
+            self._start = time.monotonic()
+
+    def observe(self, loss: float, logs: Dict[str, Any], validation: bool) -> None:
+        pass
+
+    def should_stop(self) -> bool:
+        return self.elapsed_seconds() >= self.max_seconds
@@ -0,0 +1,145 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from typing import Callable, Dict, Sequence, Tuple
+
+import copy
+
+import torch
+import torch.nn as nn
+from torch.func import functional_call, stack_module_state, vmap
+
+
+def _set_tensor(module: nn.Module, name: str, value: torch.Tensor, is_parameter: bool) -> None:
+    prefix, _, leaf = name.rpartition('.')
+    module = module.get_submodule(prefix)
+    if is_parameter:
+        setattr(module, leaf, nn.Parameter(value))
+    else:
+        module._buffers[leaf] = value
+
+
+class EnsembleGame(nn.Module):
+    """
+    Trains N independent replicas of a game in a single process, with a single Trainer. The parameters (and buffers)
+    of the replicas are stacked along a new leading dimension, and all replicas are run at once with `vmap`, each with
+    its own random stream (e.g. its own Gumbel-Softmax noise); for small games, whose steps are dominated by the
+    per-operation overheads, that costs a fraction of running the replicas one by one.
+
+    The returned loss is the sum of the losses of the replicas, hence each replica gets the gradients of its own loss;
+    as Adam, Adagrad, RMSprop and SGD update every parameter independently, an optimizer over the stacked parameters
+    behaves as N independent optimizers (gradient clipping by norm, however, would couple the replicas).
+    The auxiliary metrics are averaged over the replicas; the metrics of the i-th replica are also reported under
+    `{name}_{i}`, and its loss under `loss_{i}`.
+
+    `vmap` requires the game to be free of host-side effects and data-dependent shapes (e.g. the packed sequences of
+    RnnEncoder, used by the recurrent REINFORCE Receivers); such games can be run with `vectorized=False`, where the
+    replicas are run one after another, which only saves the per-process overhead. Recurrent cells are supported by
+    `vmap`, but run one replica after another internally. The running-mean baselines of REINFORCE games are buffers,
+    hence each replica keeps its own.
+
+    >>> from .gs_wrappers import GumbelSoftmaxWrapper, SymbolGameGS, SymbolReceiverWrapper
+    >>> class Receiver(nn.Module):
+    ...     def __init__(self):
+    ...         super(Receiver, self).__init__()
+    ...         self.fc = nn.Linear(5, 4)
+    ...     def forward(self, message, _input=None):
+    ...         return self.fc(message)
+    >>> def loss(sender_input, _message, _receiver_input, receiver_output, _labels):
+    ...     correct = (receiver_output.argmax(dim=1) == sender_input.argmax(dim=1)).float()
+    ...     return -(receiver_output.log_softmax(dim=1) * sender_input).sum(dim=1), {'acc': correct}
+    >>> def make_game():
+    ...     sender = GumbelSoftmaxWrapper(nn.Linear(4, 5))
+    ...     return SymbolGameGS(sender, SymbolReceiverWrapper(Receiver(), vocab_size=5, agent_input_size=5), loss)
+    >>> ensemble = build_ensemble(make_game, n_replicas=3, seed=0)
+    >>> ensemble.game.sender.agent.weight.size()
+    torch.Size([3, 5, 4])
+    >>> loss, aux = ensemble(torch.eye(4), None)
+    >>> sorted(aux.keys())
+    ['acc', 'acc_0', 'acc_1', 'acc_2', 'loss_0', 'loss_1', 'loss_2']
+    >>> torch.allclose(loss, aux['loss_0'] + aux['loss_1'] + aux['loss_2'])
+    True
+    >>> replica = ensemble.replica(1)
+    >>> torch.equal(replica.sender.agent.weight, ensemble.game.sender.agent.weight[1])
+    True
+    """
+    def __init__(self, games: Sequence[nn.Module], vectorized: bool = True):
+        """
+        :param games: the replicas, identical up to the values of their parameters
+        :param vectorized: if set, the replicas are run at once with `vmap`; otherwise, one after another
+        """
+        super(EnsembleGame, self).__init__()
+        assert len(games) > 0, 'an ensemble needs at least one game'
+        self.n_replicas = len(games)
+        self.vectorized = vectorized
+
+        if vectorized:
+            params, buffers = stack_module_state(list(games))
+            # a copy of the first replica holds the stacked tensors; it is only run through functional_call
+            self.game = copy.deepcopy(games[0])
+            for name, value in params.items():
+                _set_tensor(self.game, name, value.detach(), is_parameter=True)
+            for name, value in buffers.items():
+                _set_tensor(self.game, name, value, is_parameter=False)
+        else:
+            self.games = nn.ModuleList(games)
+
+    def _vectorized_forward(self, *batch) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        def replica_forward(params, buffers, *batch):
+            return functional_call(self.game, (params, buffers), batch)
+
+        params = dict(self.game.named_parameters())
+        buffers = dict(self.game.named_buffers())
+        return vmap(replica_forward, in_dims=(0, 0) + (None,) * len(batch),
+                    randomness='different')(params, buffers, *batch)
+
+    def _sequential_forward(self, *batch) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        outputs = [game(*batch) for game in self.games]
+        losses = torch.stack([loss for loss, _ in outputs])
+        rest = {name: torch.stack([torch.as_tensor(aux[name], device=losses.device) for _, aux in outputs])
+                for name in outputs[0][1]}
+        return losses, rest
+
+    def forward(self, *batch):
+        if self.vectorized:
+            losses, rest = self._vectorized_forward(*batch)
+        else:
+            losses, rest = self._sequential_forward(*batch)
+
+        aux = {}
+        for name, value in rest.items():
+            aux[name] = value.float().mean(dim=0)
+            for i in range(self.n_replicas):
+                aux[f'{name}_{i}'] = value[i]
+        for i in range(self.n_replicas):
+            aux[f'loss_{i}'] = losses[i].detach()
+        return losses.sum(), aux
+
+    def replica(self, i: int) -> nn.Module:
+        """
+        :return: the i-th replica as a standalone game, e.g. to evaluate or analyse it separately; in the vectorized
+            mode, it is a copy that holds the current values of the parameters of the replica
+        """
+        if not self.vectorized:
+            return self.games[i]
+        game = copy.deepcopy(self.game)
+        for name, value in self.game.named_parameters():
+            _set_tensor(game, name, value[i].detach().clone(), is_parameter=True)
+        for name, value in self.game.named_buffers():
+            _set_tensor(game, name, value[i].clone(), is_parameter=False)
+        return game
+
+
+def build_ensemble(make_game: Callable[[], nn.Module], n_replicas: int, seed: int = 0,
+                   vectorized: bool = True) -> EnsembleGame:
+    """
+    Builds an ensemble of `n_replicas` games, the i-th one initialised with the random seed `seed + i`.
+    :param make_game: builds a new game
+    """
+    games = []
+    for i in range(n_replicas):
+        torch.manual_seed(seed + i)
+        games.append(make_game())
+    return EnsembleGame(games, vectorized=vectorized)
@@ -0,0 +1,134 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import torch
+import torch.nn as nn
+
+
+class Interaction(NamedTuple):
+    """
+    What happened in a game over an evaluation batch: the inputs, the messages sent, and the outputs of Receiver, as
+    well as the loss and the auxiliary metrics returned by the game. Under REINFORCE, `message` and `receiver_output`
+    are the first elements of the tuples returned by the agents (i.e. the messages and the outputs themselves); under
+    Gumbel-Softmax, the messages are one-hot encoded.
+    """
+    sender_input: Any
+    labels: Any
+    receiver_input: Any
+    message: Optional[torch.Tensor]
+    receiver_output: Optional[torch.Tensor]
+    loss: torch.Tensor
+    aux: Dict[str, Any]
+
+
+def _first(output: Any) -> Any:
+    return output[0] if isinstance(output, tuple) else output
+
+
+class InteractionCapture:
+    """
+    Records the outputs of the `sender` and `receiver` of a game while the game is run, with forward hooks; hence the
+    messages and the outputs of Receiver are obtained from the same forward pass that computes the loss, rather than
+    by running the agents again. The hooks are only installed within the `with` block, hence they do not affect the
+    other calls (e.g. the training steps of a compiled game).
+
+    >>> class Game(nn.Module):
+    ...     def __init__(self):
+    ...         super(Game, self).__init__()
+    ...         self.sender, self.receiver = nn.Linear(2, 3), nn.Linear(3, 1)
+    ...     def forward(self, sender_input, labels):
+    ...         output = self.receiver(self.sender(sender_input))
+    ...         return (output - labels).pow(2).mean(), {}
+    >>> game = Game()
+    >>> capture = InteractionCapture(game)
+    >>> batch = (torch.ones(4, 2), torch.zeros(4, 1))
+    >>> with capture:
+    ...     loss, aux = game(*batch)
+    >>> interaction = capture.interaction(batch, loss, aux)
+    >>> interaction.message.size(), interaction.receiver_output.size(), interaction.receiver_input is None
+    (torch.Size([4, 3]), torch.Size([4, 1]), True)
+    """
+    def __init__(self, game: nn.Module):
+        self.game = game
+        self._outputs = {}
+        self._handles = []
+
+    def _hook(self, name: str):
+        def hook(_module, _input, output):
+            self._outputs[name] = _first(output)
+        return hook
+
+    def __enter__(self):
+        self._outputs = {}
+        for name in ('sender', 'receiver'):
+            agent = getattr(self.game, name, None)
+            if isinstance(agent, nn.Module):
+                self._handles.append(agent.register_forward_hook(self._hook(name)))
+        return self
+
+    def __exit__(self, *args):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def interaction(self, batch: Any, loss: torch.Tensor, aux: Dict[str, Any]) -> Interaction:
+        """
+        :param batch: by agreement, (sender_input, labels) plus an optional receiver_input
+        """
+        return Interaction(sender_input=batch[0], labels=batch[1] if len(batch) > 1 else None,
+                           receiver_input=batch[2] if len(batch) > 2 else None,
+                           message=self._outputs.get('sender'), receiver_output=self._outputs.get('receiver'),
+                           loss=loss, aux=aux)
+
+
+class AsyncEvaluator:
+    """
+    Runs evaluation functions in a background thread, one after another, while the training thread goes on. Each
+    submitted function comes with a `tag` (e.g. the epoch it evaluates), returned together with its result by
+    `completed()` in the submission order. The errors raised by the functions are re-raised by `completed()`.
+    On CUDA, the functions run on a separate stream, so that their kernels can overlap with those of the training.
+
+    >>> evaluator = AsyncEvaluator('cpu')
+    >>> evaluator.submit(lambda: 2 + 2, tag='epoch 1')
+    >>> evaluator.completed(block=True)
+    [('epoch 1', 4)]
+    """
+    def __init__(self, device: torch.device):
+        device = torch.device(device)
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: List[Tuple[Future, Any]] = []
+
+    def submit(self, fn: Callable[[], Any], tag: Any) -> None:
+        if self.stream is not None:
+            # the inputs of `fn` are prepared on the current stream of the training thread
+            self.stream.wait_stream(torch.cuda.current_stream(self.stream.device))
+        self._pending.append((self._executor.submit(self._run, fn), tag))
+
+    def _run(self, fn: Callable[[], Any]) -> Any:
+        if self.stream is None:
+            return fn()
+        with torch.cuda.stream(self.stream):
+            result = fn()
+        self.stream.synchronize()
+        return result
+
+    @property
+    def n_pending(self) -> int:
+        return len(self._pending)
+
+    def completed(self, block: bool = False) -> List[Tuple[Any, Any]]:
+        """
+        :param block: if set, waits for all the submitted functions to complete
+        :return: a list of (tag, result) of the functions completed since the previous call, in the submission order
+        """
+        results = []
+        while self._pending and (block or self._pending[0][0].done()):
+            future, tag = self._pending.pop(0)
+            results.append((tag, future.result()))
+        return results
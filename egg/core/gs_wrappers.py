@@ -6,7 +6,9 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.distributions import RelaxedOneHotCategorical
+
+from .compilation import is_lstm_cell
+from .sampling import greedy_one_hot, gumbel_softmax_sample
 
 
 class GumbelSoftmaxWrapper(nn.Module):
@@ -32,12 +34,13 @@ class GumbelSoftmaxWrapper(nn.Module):
             self.temperature = torch.nn.Parameter(torch.tensor([temperature]), requires_grad=True)
 
     def forward(self, *args, **kwargs):
-        logits = self.agent(*args, **kwargs)
+        # sampling is done in fp32, even if the agent runs under reduced precision
+        logits = self.agent(*args, **kwargs).float()
 
         if self.training:
-            return RelaxedOneHotCategorical(logits=logits, temperature=self.temperature).rsample()
+            return gumbel_softmax_sample(logits, self.temperature)
         else:
-            return torch.zeros_like(logits).scatter_(-1, logits.argmax(dim=-1, keepdim=True), 1.0)
+            return greedy_one_hot(logits)
 
 
 class SymbolGameGS(nn.Module):
@@ -85,7 +88,7 @@ class SymbolGameGS(nn.Module):
         loss, rest_info = self.loss(sender_input, message, receiver_input, receiver_output, labels)
         for k, v in rest_info.items():
             if hasattr(v, 'mean'):
-                rest_info[k] = v.mean().item()
+                rest_info[k] = v.mean()
 
         return loss.mean(), rest_info
 
@@ -199,18 +202,18 @@ class RnnSenderGS(nn.Module):
         sequence = []
 
         for step in range(self.max_len):
-            if isinstance(self.cell, nn.LSTMCell):
+            if is_lstm_cell(self.cell):
                 h_t, prev_c = self.cell(e_t, (prev_hidden, prev_c))
             else:
                 h_t = self.cell(e_t, prev_hidden)
 
-            step_logits = F.log_softmax(self.hidden_to_output(h_t), dim=1)
-            distr = RelaxedOneHotCategorical(logits=step_logits, temperature=self.temperature)
+            # the Gumbel-Softmax sample does not depend on the normalisation of the logits
+            step_logits = self.hidden_to_output(h_t).float()
 
             if self.training:
-                x = distr.rsample()
+                x = gumbel_softmax_sample(step_logits, self.temperature)
             else:
-                x = torch.zeros_like(step_logits).scatter_(-1, step_logits.argmax(dim=-1, keepdim=True), 1.0)
+                x = greedy_one_hot(step_logits)
 
             prev_hidden = h_t
             e_t = self.embedding(x)
@@ -262,7 +265,7 @@ class RnnReceiverGS(nn.Module):
         # to get an access to the hidden states, we have to unroll the cell ourselves
         for step in range(message.size(1)):
             e_t = emb[:, step, ...]
-            if isinstance(self.cell, nn.LSTMCell):
+            if is_lstm_cell(self.cell):
                 h_t, prev_c = self.cell(e_t, (prev_hidden, prev_c)) if prev_hidden is not None else \
                     self.cell(e_t)
             else:
@@ -303,7 +306,7 @@ class SenderReceiverRnnGS(nn.Module):
     >>> output[0].item() > 0
     True
     """
-    def __init__(self, sender, receiver, loss, length_cost=0.0):
+    def __init__(self, sender, receiver, loss, length_cost=0.0, sequence_loss=False):
         """
         :param sender: sender agent
         :param receiver: receiver agent
@@ -318,48 +321,55 @@ class SenderReceiverRnnGS(nn.Module):
           all batches in the dataset.
 
         :param length_cost: the penalty applied to Sender for each symbol produced
+        :param sequence_loss: if set, `loss` is called once for all the steps of the messages: it gets the whole
+          messages, (batch size, max_len, vocab size), and the outputs of Receiver at all steps, (batch size, max_len,
+          ...), and returns the losses and the auxiliary information of each step, (batch size, max_len); otherwise,
+          it is called once per step, with the symbols and the outputs of that step
         """
         super(SenderReceiverRnnGS, self).__init__()
         self.sender = sender
         self.receiver = receiver
         self.loss = loss
         self.length_cost = length_cost
+        self.sequence_loss = sequence_loss
 
-    def forward(self, sender_input, labels, receiver_input=None):
-        message = self.sender(sender_input)
-        receiver_output = self.receiver(message, receiver_input)
-
-        loss = 0
-        not_eosed_before = torch.ones(receiver_output.size(0)).to(receiver_output.device)
-        expected_length = 0.0
-
-        rest = {}
-        z = 0.0
+    def _step_losses(self, sender_input, message, receiver_input, receiver_output, labels):
+        # calls the per-step loss at every step, and stacks the results as (batch size, max_len)
+        batch_size = receiver_output.size(0)
+        losses, rest = [], {}
         for step in range(receiver_output.size(1)):
-            step_loss, step_rest = self.loss(sender_input, message[:, step, ...], receiver_input, receiver_output[:, step, ...], labels)
-            eos_mask = message[:, step, 0]  # always eos == 0
-
-            add_mask = eos_mask * not_eosed_before
-            z += add_mask
-            loss += step_loss * add_mask + self.length_cost * (1.0 + step) * add_mask
-            expected_length += add_mask.detach() * (1.0 + step)
-
+            step_loss, step_rest = self.loss(sender_input, message[:, step, ...], receiver_input,
+                                             receiver_output[:, step, ...], labels)
+            losses.append(step_loss.expand(batch_size))
             for name, value in step_rest.items():
-                rest[name] = value * add_mask + rest.get(name, 0.0)
-
-            not_eosed_before = not_eosed_before * (1.0 - eos_mask)
+                value = torch.as_tensor(value, device=receiver_output.device).expand(batch_size)
+                rest.setdefault(name, []).append(value)
+        return torch.stack(losses, dim=1), {name: torch.stack(values, dim=1) for name, values in rest.items()}
+
+    @staticmethod
+    def _eos_weights(message):
+        # the probability that the message ends at each step: it has EOS (always 0) there and none before; the
+        # remainder of the probability mass, of the messages without EOS, goes to the last step
+        eos_probs = message[:, :, 0]
+        not_eosed = torch.cumprod(1.0 - eos_probs, dim=1)
+        not_eosed_before = torch.cat([torch.ones_like(not_eosed[:, :1]), not_eosed[:, :-1]], dim=1)
+        weights = eos_probs * not_eosed_before
+        return torch.cat([weights[:, :-1], weights[:, -1:] + not_eosed[:, -1:]], dim=1)
 
-        # the remainder of the probability mass
-        loss += step_loss * not_eosed_before + self.length_cost * (step + 1.0) * not_eosed_before
-        expected_length += (step + 1) * not_eosed_before
+    def forward(self, sender_input, labels, receiver_input=None):
+        message = self.sender(sender_input)
+        receiver_output = self.receiver(message, receiver_input)
 
-        z += not_eosed_before
-        assert z.allclose(torch.ones_like(z)), f"lost probability mass, {z.min()}, {z.max()}"
+        if self.sequence_loss:
+            step_losses, step_rest = self.loss(sender_input, message, receiver_input, receiver_output, labels)
+        else:
+            step_losses, step_rest = self._step_losses(sender_input, message, receiver_input, receiver_output,
+                                                       labels)
 
-        for name, value in step_rest.items():
-            rest[name] = value * not_eosed_before + rest.get(name, 0.0)
-        for name, value in rest.items():
-            rest[name] = value.mean()
+        weights = self._eos_weights(message)
+        lengths = torch.arange(1, weights.size(1) + 1, device=weights.device, dtype=weights.dtype)
 
-        rest['mean_length'] = expected_length.mean()
+        loss = ((step_losses + self.length_cost * lengths) * weights).sum(dim=1)
+        rest = {name: (value * weights).sum(dim=1).mean() for name, value in step_rest.items()}
+        rest['mean_length'] = (weights.detach() * lengths).sum(dim=1).mean()
         return loss.mean(), rest
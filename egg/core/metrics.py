@@ -0,0 +1,100 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from typing import Any, Dict, Optional, Tuple, Union
+
+import torch
+
+from . import distributed
+
+
+def _accumulate(total: Optional[Union[torch.Tensor, float]], value: Any, n_samples: int) \
+        -> Union[torch.Tensor, float]:
+    if torch.is_tensor(value):
+        value = value.detach()
+        if value.dim() > 0:
+            value = value.float().mean()
+        weighted = value.float() * n_samples
+        if total is None:
+            return weighted
+        if torch.is_tensor(total):
+            return total.add_(weighted)
+        return weighted.add_(total)
+
+    weighted = float(value) * n_samples
+    return weighted if total is None else total + weighted
+
+
+class MetricsAccumulator:
+    """
+    Aggregates the loss and the auxiliary metrics returned by a game over a sequence of batches. Each batch is weighted
+    by the number of samples it contains, hence a smaller trailing batch does not skew the average. Running sums are kept
+    as tensors on the device where the metrics are produced and are transferred to the host only once, in `result()`.
+
+    >>> accumulator = MetricsAccumulator()
+    >>> accumulator.update(torch.tensor(1.0), {'acc': torch.tensor([1.0, 0.0]), 'aux': 5.0}, n_samples=2)
+    >>> accumulator.update(torch.tensor(4.0), {'acc': torch.tensor([1.0, 1.0]), 'aux': 5.0}, n_samples=2)
+    >>> loss, rest = accumulator.result()
+    >>> loss
+    2.5
+    >>> rest['acc'], rest['aux']
+    (0.75, 5.0)
+    """
+    def __init__(self):
+        self.n_samples = 0
+        self.loss = None
+        self.metrics = {}
+
+    def update(self, loss: Union[torch.Tensor, float], rest: Dict[str, Any], n_samples: int) -> None:
+        """
+        :param loss: the (mean) loss over the batch
+        :param rest: a dict of auxiliary metrics; tensors with more than zero dimensions are averaged first
+        :param n_samples: the number of samples in the batch
+        """
+        self.n_samples += n_samples
+        self.loss = _accumulate(self.loss, loss, n_samples)
+        for k, v in rest.items():
+            self.metrics[k] = _accumulate(self.metrics.get(k), v, n_samples)
+
+    def state_dict(self) -> Dict[str, Any]:
+        def _copy(x):
+            return x.clone() if torch.is_tensor(x) else x
+        return dict(n_samples=self.n_samples, loss=_copy(self.loss), metrics={k: _copy(v) for k, v in self.metrics.items()})
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self.n_samples = state['n_samples']
+        self.loss = state['loss']
+        self.metrics = dict(state['metrics'])
+
+    def means(self) -> Tuple[Union[torch.Tensor, float], Dict[str, Union[torch.Tensor, float]]]:
+        """
+        :return: a tuple of (mean loss, dict of mean metrics) of this process, without transferring the tensor-valued
+            ones to the host
+        """
+        return self.loss / self.n_samples, {k: v / self.n_samples for k, v in self.metrics.items()}
+
+    def result(self) -> Tuple[float, Dict[str, float]]:
+        """
+        :return: a tuple of (mean loss, dict of mean metrics), with all values converted to python floats
+        """
+        names = sorted(self.metrics.keys()) if distributed.is_distributed() else list(self.metrics.keys())
+        values = [self.n_samples, self.loss] + [self.metrics[k] for k in names]
+
+        tensor_ids = [i for i, v in enumerate(values) if torch.is_tensor(v)]
+        if distributed.is_distributed():
+            # the sums are aggregated over all the workers, hence every worker gets the same averages
+            device = values[tensor_ids[0]].device if tensor_ids else 'cpu'
+            values = [torch.as_tensor(v, dtype=torch.float32, device=device) for v in values]
+            values = distributed.all_reduce_sum(torch.stack(values)).tolist()
+        elif tensor_ids:
+            device = values[tensor_ids[0]].device
+            # a single host transfer for all the tensor-valued metrics
+            materialized = torch.stack([values[i].to(device) for i in tensor_ids]).tolist()
+            for i, v in zip(tensor_ids, materialized):
+                values[i] = v
+
+        n_samples = values[0]
+        values = [v / n_samples for v in values[1:]]
+        return values[0], dict(zip(names, values[1:]))
@@ -0,0 +1,74 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from typing import Optional, Sequence
+
+import signal
+import sys
+import threading
+
+# the signals sent by Slurm (and submitit) before a job is preempted or hits its time limit
+DEFAULT_SIGNALS = tuple(getattr(signal, name) for name in ('SIGTERM', 'SIGUSR1') if hasattr(signal, name))
+
+
+class PreemptionHandler:
+    """
+    Records the preemption signals instead of letting them kill the process, so that the training loop can finish
+    the current step, save a checkpoint, and only then exit (see `exit()`).
+
+    >>> import os
+    >>> handler = PreemptionHandler(signals=[signal.SIGUSR1])
+    >>> handler.install()
+    True
+    >>> handler.requested
+    False
+    >>> os.kill(os.getpid(), signal.SIGUSR1)
+    >>> handler.requested, handler.signum == signal.SIGUSR1
+    (True, True)
+    >>> handler.uninstall()
+    """
+    def __init__(self, signals: Sequence[int] = DEFAULT_SIGNALS):
+        self.signals = list(signals)
+        self.signum: Optional[int] = None
+        self._previous = {}
+
+    @property
+    def requested(self) -> bool:
+        return self.signum is not None
+
+    def install(self) -> bool:
+        """
+        Installs the handlers, remembering the previous ones. Python only allows that in the main thread.
+        :return: True if the handlers were installed
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return False
+        for signum in self.signals:
+            self._previous[signum] = signal.signal(signum, self._handle)
+        return True
+
+    def uninstall(self) -> None:
+        """
+        Restores the handlers that were installed before `install()`.
+        """
+        for signum, previous in self._previous.items():
+            signal.signal(signum, previous if previous is not None else signal.SIG_DFL)
+        self._previous = {}
+
+    def _handle(self, signum, _frame) -> None:
+        self.signum = signum
+
+    def exit(self) -> None:
+        """
+        To be called once the state is saved: hands the received signal over to the handler that was installed before
+        (e.g. submitit requeues the job on SIGUSR1); if there was none, or it returned, exits with the status a
+        process killed by the signal would have (128 + the signal number), which schedulers treat as a preemption.
+        """
+        signum = self.signum
+        previous = self._previous.get(signum)
+        self.uninstall()
+        if callable(previous):
+            previous(signum, None)
+        sys.exit(128 + signum)
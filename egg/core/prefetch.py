@@ -0,0 +1,110 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from typing import Any, Iterator
+
+import queue
+import threading
+
+import torch
+
+from .util import move_to
+
+
+class _End:
+    pass
+
+
+class _Failure:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+def _pin_memory(x: Any) -> Any:
+    if torch.is_tensor(x):
+        return x.pin_memory()
+    if isinstance(x, (list, tuple)):
+        return [_pin_memory(i) for i in x]
+    if isinstance(x, dict):
+        return {k: _pin_memory(v) for k, v in x.items()}
+    return x
+
+
+class PrefetchIterator:
+    """
+    Runs an iterator over batches in a background thread, keeping at most `n_batches` ready batches in a bounded queue.
+    When the target device is a GPU, the host tensors are pinned in the background thread, so that the copy to the
+    device can be issued with `non_blocking=True` and overlap with the computation.
+    If the wrapped iterator has a `state_dict()` method, `state_dict()` returns its state as of the last batch returned
+    to the consumer (rather than the last batch prefetched).
+
+    >>> batches = [(torch.ones(2, 3) * i, torch.zeros(2)) for i in range(5)]
+    >>> iterator = PrefetchIterator(iter(batches), n_batches=2, device='cpu')
+    >>> [b[0][0, 0].item() for b in iterator]
+    [0.0, 1.0, 2.0, 3.0, 4.0]
+    """
+    def __init__(self, iterator: Iterator, n_batches: int, device: torch.device):
+        assert n_batches > 0, 'At least one batch has to be prefetched'
+        self.device = torch.device(device)
+        self.pin_memory = self.device.type == 'cuda'
+        self._has_state = hasattr(iterator, 'state_dict')
+        self._state = iterator.state_dict() if self._has_state else None
+
+        self._queue = queue.Queue(maxsize=n_batches)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker, args=(iterator,), daemon=True)
+        self._thread.start()
+
+    def _put(self, item: Any) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self, iterator: Iterator) -> None:
+        try:
+            for batch in iterator:
+                if self.pin_memory:
+                    batch = _pin_memory(batch)
+                state = iterator.state_dict() if self._has_state else None
+                if not self._put((batch, state)):
+                    return
+        except Exception as e:
+            self._put(_Failure(e))
+            return
+        self._put(_End())
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._stop.is_set():
+            raise StopIteration()
+
+        item = self._queue.get()
+        if isinstance(item, _End):
+            self.close()
+            raise StopIteration()
+        if isinstance(item, _Failure):
+            self.close()
+            raise item.exception
+        batch, self._state = item
+        return move_to(batch, self.device, non_blocking=True)
+
+    def state_dict(self) -> Any:
+        return self._state
+
+    def close(self) -> None:
+        """
+        Stops the background thread; the remaining prefetched batches are dropped.
+        """
+        self._stop.set()
+
+    def __del__(self):
+        self.close()
+
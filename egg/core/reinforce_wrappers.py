@@ -3,18 +3,55 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+from typing import Dict, Optional
+
 import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.distributions import Categorical
-from collections import defaultdict
 import numpy as np
 
 
 from .transformer import TransformerEncoder, TransformerDecoder
 from .rnn import RnnEncoder
 from .util import find_lengths
+from .distributed import sum_and_count
+from .compilation import is_lstm_cell
+from .sampling import sample_categorical
+
+
+class RunningMeanBaseline(nn.Module):
+    """
+    A running mean of the values (e.g. the losses) of all samples seen so far, used as the REINFORCE baseline. It is a
+    mean over samples rather than batches, hence it does not depend on how the data is split into (micro-)batches;
+    under distributed training, it is aggregated over all workers. The mean and the number of samples are kept as
+    (double precision) buffers, hence they are saved with the state dict, follow the game across devices, and are
+    updated on the device, without synchronising with the host.
+
+    >>> baseline = RunningMeanBaseline()
+    >>> baseline.update(torch.tensor([1.0, 2.0]))
+    >>> baseline.update(torch.tensor([6.0]))
+    >>> baseline.mean.item(), baseline.n_points.item()
+    (3.0, 3.0)
+    """
+    def __init__(self):
+        super(RunningMeanBaseline, self).__init__()
+        self.register_buffer('mean', torch.zeros((), dtype=torch.float64))
+        self.register_buffer('n_points', torch.zeros((), dtype=torch.float64))
+
+    def update(self, value: torch.Tensor) -> None:
+        total, n = sum_and_count(value)
+        self.n_points.add_(n)
+        self.mean.add_((total - n * self.mean) / self.n_points)
+
+    def set_values(self, state_dict, prefix: str, mean: Optional[float] = None, n_points: Optional[float] = None):
+        """
+        Puts the given values (by default, the current ones) to `state_dict`, unless it has them already
+        """
+        mean = self.mean if mean is None else torch.tensor(mean, dtype=torch.float64)
+        n_points = self.n_points if n_points is None else torch.tensor(n_points, dtype=torch.float64)
+        state_dict.setdefault(prefix + 'mean', mean)
+        state_dict.setdefault(prefix + 'n_points', n_points)
 
 
 class ReinforceWrapper(nn.Module):
@@ -39,18 +76,10 @@ class ReinforceWrapper(nn.Module):
         self.agent = agent
 
     def forward(self, *args, **kwargs):
-        logits = self.agent(*args, **kwargs)
+        # sampling is done in fp32, even if the agent runs under reduced precision
+        logits = self.agent(*args, **kwargs).float()
 
-        distr = Categorical(logits=logits)
-        entropy = distr.entropy()
-
-        if self.training:
-            sample = distr.sample()
-        else:
-            sample = logits.argmax(dim=1)
-        log_prob = distr.log_prob(sample)
-
-        return sample, log_prob, entropy
+        return sample_categorical(F.log_softmax(logits, dim=-1), greedy=not self.training)
 
 
 class ReinforceDeterministicWrapper(nn.Module):
@@ -105,32 +134,46 @@ class SymbolGameReinforce(nn.Module):
         self.receiver_entropy_coeff = receiver_entropy_coeff
         self.sender_entropy_coeff = sender_entropy_coeff
 
-        self.mean_baseline = 0.0
-        self.n_points = 0.0
+        self.baseline = RunningMeanBaseline()
+
+    @property
+    def mean_baseline(self) -> float:
+        return self.baseline.mean.item()
+
+    @property
+    def n_points(self) -> float:
+        return self.baseline.n_points.item()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the baseline used to be saved as an extra state; the earliest state dicts have none, the current one is kept
+        extra_state = state_dict.pop(prefix + '_extra_state', None)
+        if extra_state is not None:
+            self.baseline.set_values(state_dict, prefix + 'baseline.', extra_state['mean_baseline'],
+                                     extra_state['n_points'])
+        self.baseline.set_values(state_dict, prefix + 'baseline.')
+        super(SymbolGameReinforce, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, sender_input, labels, receiver_input=None):
         message, sender_log_prob, sender_entropy = self.sender(sender_input)
         receiver_output, receiver_log_prob, receiver_entropy = self.receiver(message, receiver_input)
 
         loss, rest_info = self.loss(sender_input, message, receiver_input, receiver_output, labels)
-        policy_loss = ((loss.detach() - self.mean_baseline) * (sender_log_prob + receiver_log_prob)).mean()
+        policy_loss = ((loss.detach() - self.baseline.mean) * (sender_log_prob + receiver_log_prob)).mean()
         entropy_loss = -(sender_entropy.mean() * self.sender_entropy_coeff + receiver_entropy.mean() * self.receiver_entropy_coeff)
 
         if self.training:
-            self.n_points += 1.0
-            self.mean_baseline += (loss.detach().mean().item() -
-                                   self.mean_baseline) / self.n_points
+            self.baseline.update(loss)
 
         full_loss = policy_loss + entropy_loss + loss.mean()
 
         for k, v in rest_info.items():
             if hasattr(v, 'mean'):
-                rest_info[k] = v.mean().item()
+                rest_info[k] = v.mean()
 
-        rest_info['baseline'] = self.mean_baseline
-        rest_info['loss'] = loss.mean().item()
-        rest_info['sender_entropy'] = sender_entropy.mean()
-        rest_info['receiver_entropy'] = receiver_entropy.mean()
+        rest_info['baseline'] = self.baseline.mean.detach().clone()
+        rest_info['loss'] = loss.detach().mean()
+        rest_info['sender_entropy'] = sender_entropy.detach().mean()
+        rest_info['receiver_entropy'] = receiver_entropy.detach().mean()
 
         return full_loss, rest_info
 
@@ -152,8 +195,21 @@ class RnnSenderReinforce(nn.Module):
     1
     >>> message.size()  # batch size x max_len
     torch.Size([16, 10])
+
+    With `early_exit`, the unrolling stops once every message has an EOS; the symbols after EOS are then EOS, with
+    zero log-probs and entropies (the games ignore them in any case), and the outputs have the same sizes as without it.
+
+    >>> agent = RnnSenderReinforce(nn.Linear(10, 3), vocab_size=5, embed_dim=5, hidden_size=3, max_len=10,
+    ...                            early_exit=True, compact_batch=True)
+    >>> message, logprob, entropy = agent(input)
+    >>> message.size(), logprob.size(), entropy.size()
+    (torch.Size([16, 10]), torch.Size([16, 10]), torch.Size([16, 10]))
+    >>> after_eos = torch.cumsum(message == 0, dim=1) - (message == 0).long() > 0
+    >>> message[after_eos].eq(0).all().item(), logprob[after_eos].eq(0).all().item()
+    (True, True)
     """
-    def __init__(self, agent, vocab_size, embed_dim, hidden_size, max_len, num_layers=1, cell='rnn', force_eos=True):
+    def __init__(self, agent, vocab_size, embed_dim, hidden_size, max_len, num_layers=1, cell='rnn', force_eos=True,
+                 early_exit=False, compact_batch=False):
         """
         :param agent: the agent to be wrapped
         :param vocab_size: the communication vocabulary size
@@ -163,11 +219,19 @@ class RnnSenderReinforce(nn.Module):
         :param cell: type of the cell used (rnn, gru, lstm)
         :param force_eos: if set to True, each message is extended by an EOS symbol. To ensure that no message goes
         beyond `max_len`, Sender only generates `max_len - 1` symbols from an RNN cell and appends EOS.
+        :param early_exit: if set to True, the unrolling stops once all messages of the batch have an EOS symbol,
+            which takes a host synchronisation per step
+        :param compact_batch: if set to True (together with `early_exit`), the finished messages are removed from the
+            batch that is unrolled, hence they take no compute at the following steps. The samples of the remaining
+            messages are drawn from a smaller batch, which changes them w.r.t. the same random seed
         """
         super(RnnSenderReinforce, self).__init__()
         self.agent = agent
 
         self.force_eos = force_eos
+        assert early_exit or not compact_batch, 'compact_batch requires early_exit'
+        self.early_exit = early_exit
+        self.compact_batch = compact_batch
 
         self.max_len = max_len
         if force_eos:
@@ -203,15 +267,20 @@ class RnnSenderReinforce(nn.Module):
 
         prev_c = [torch.zeros_like(prev_hidden[0]) for _ in range(self.num_layers)]  # only used for LSTM
 
-        input = torch.stack([self.sos_embedding] * x.size(0))
+        batch_size = x.size(0)
+        input = torch.stack([self.sos_embedding] * batch_size)
 
         sequence = []
         logits = []
         entropy = []
 
+        # under early exit: whether each message has an EOS, and (under batch compaction) the unrolled rows
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=input.device) if self.early_exit else None
+        active = torch.arange(batch_size, device=input.device) if self.compact_batch else None
+
         for step in range(self.max_len):
             for i, layer in enumerate(self.cells):
-                if isinstance(layer, nn.LSTMCell):
+                if is_lstm_cell(layer):
                     h_t, c_t = layer(input, (prev_hidden[i], prev_c[i]))
                     prev_c[i] = c_t
                 else:
@@ -219,23 +288,49 @@ class RnnSenderReinforce(nn.Module):
                 prev_hidden[i] = h_t
                 input = h_t
 
-            step_logits = F.log_softmax(self.hidden_to_output(h_t), dim=1)
-            distr = Categorical(logits=step_logits)
-            entropy.append(distr.entropy())
+            step_logits = F.log_softmax(self.hidden_to_output(h_t).float(), dim=1)
+            x, step_log_prob, step_entropy = sample_categorical(step_logits, greedy=not self.training)
+
+            if self.compact_batch:
+                # the finished rows are EOS with zero log-prob and entropy
+                x = x.new_zeros(batch_size).index_put((active,), x)
+                step_log_prob = step_log_prob.new_zeros(batch_size).index_put((active,), step_log_prob)
+                step_entropy = step_entropy.new_zeros(batch_size).index_put((active,), step_entropy)
+            elif self.early_exit:
+                x = x.masked_fill(finished, 0)
+                step_log_prob = step_log_prob.masked_fill(finished, 0.0)
+                step_entropy = step_entropy.masked_fill(finished, 0.0)
+
+            entropy.append(step_entropy)
+            logits.append(step_log_prob)
+            sequence.append(x)
+
+            if self.early_exit:
+                finished = finished | (x == 0)
+                if finished.all():
+                    break
 
-            if self.training:
-                x = distr.sample()
-            else:
-                x = step_logits.argmax(dim=1)
-            logits.append(distr.log_prob(x))
+            if self.compact_batch:
+                keep = torch.nonzero(~finished[active], as_tuple=True)[0]
+                if keep.size(0) < active.size(0):
+                    active = active[keep]
+                    prev_hidden = [h[keep] for h in prev_hidden]
+                    prev_c = [c[keep] for c in prev_c]
+                x = x[active]
 
             input = self.embedding(x)
-            sequence.append(x)
 
         sequence = torch.stack(sequence).permute(1, 0)
         logits = torch.stack(logits).permute(1, 0)
         entropy = torch.stack(entropy).permute(1, 0)
 
+        if sequence.size(1) < self.max_len:
+            # all messages have ended, the remaining steps are EOS
+            padding = torch.zeros((sequence.size(0), self.max_len - sequence.size(1)), device=sequence.device)
+            sequence = torch.cat([sequence, padding.long()], dim=1)
+            logits = torch.cat([logits, padding], dim=1)
+            entropy = torch.cat([entropy, padding], dim=1)
+
         if self.force_eos:
             zeros = torch.zeros((sequence.size(0), 1)).to(sequence.device)
 
@@ -367,8 +462,27 @@ class SenderReceiverRnnReinforce(nn.Module):
         self.loss = loss
         self.length_cost = length_cost
 
-        self.mean_baseline = defaultdict(float)
-        self.n_points = defaultdict(float)
+        self.baselines = nn.ModuleDict({'loss': RunningMeanBaseline(), 'length': RunningMeanBaseline()})
+
+    @property
+    def mean_baseline(self) -> Dict[str, float]:
+        return {name: baseline.mean.item() for name, baseline in self.baselines.items()}
+
+    @property
+    def n_points(self) -> Dict[str, float]:
+        return {name: baseline.n_points.item() for name, baseline in self.baselines.items()}
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the baselines used to be saved as an extra state; the earliest state dicts have none, the current ones are
+        # kept
+        extra_state = state_dict.pop(prefix + '_extra_state', None)
+        for name, baseline in self.baselines.items():
+            baseline_prefix = f'{prefix}baselines.{name}.'
+            if extra_state is not None and name in extra_state['n_points']:
+                baseline.set_values(state_dict, baseline_prefix, extra_state['mean_baseline'][name],
+                                    extra_state['n_points'][name])
+            baseline.set_values(state_dict, baseline_prefix)
+        super(SenderReceiverRnnReinforce, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, sender_input, labels, receiver_input=None):
         message, log_prob_s, entropy_s = self.sender(sender_input)
@@ -377,17 +491,11 @@ class SenderReceiverRnnReinforce(nn.Module):
 
         loss, rest = self.loss(sender_input, message, receiver_input, receiver_output, labels)
 
-        # the entropy of the outputs of S before and including the eos symbol - as we don't care about what's after
-        effective_entropy_s = torch.zeros_like(entropy_r)
-
-        # the log prob of the choices made by S before and including the eos symbol - again, we don't
-        # care about the rest
-        effective_log_prob_s = torch.zeros_like(log_prob_r)
-
-        for i in range(message.size(1)):
-            not_eosed = (i < message_lengths).float()
-            effective_entropy_s += entropy_s[:, i] * not_eosed
-            effective_log_prob_s += log_prob_s[:, i] * not_eosed
+        # the entropy of the outputs of S and the log prob of its choices before and including the eos symbol - as we
+        # don't care about what's after; both are summed at once, with a mask of the positions within the messages
+        not_eosed = torch.arange(message.size(1), device=message.device).unsqueeze(0) < message_lengths.unsqueeze(1)
+        effective_entropy_s, effective_log_prob_s = \
+            (torch.stack([entropy_s, log_prob_s]) * not_eosed).sum(dim=2)
         effective_entropy_s = effective_entropy_s / message_lengths.float()
 
         weighted_entropy = effective_entropy_s.mean() * self.sender_entropy_coeff + \
@@ -397,8 +505,8 @@ class SenderReceiverRnnReinforce(nn.Module):
 
         length_loss = message_lengths.float() * self.length_cost
 
-        policy_length_loss = ((length_loss.float() - self.mean_baseline['length']) * effective_log_prob_s).mean()
-        policy_loss = ((loss.detach() - self.mean_baseline['loss']) * log_prob).mean()
+        policy_length_loss = ((length_loss.float() - self.baselines['length'].mean) * effective_log_prob_s).mean()
+        policy_loss = ((loss.detach() - self.baselines['loss'].mean) * log_prob).mean()
 
         optimized_loss = policy_length_loss + policy_loss - weighted_entropy
         # if the receiver is deterministic/differentiable, we apply the actual loss
@@ -409,18 +517,17 @@ class SenderReceiverRnnReinforce(nn.Module):
             self.update_baseline('length', length_loss)
 
         for k, v in rest.items():
-            rest[k] = v.mean().item() if hasattr(v, 'mean') else v
-        rest['loss'] = optimized_loss.detach().item()
-        rest['sender_entropy'] = entropy_s.mean().item()
-        rest['receiver_entropy'] = entropy_r.mean().item()
-        rest['original_loss'] = loss.mean().item()
-        rest['mean_length'] = message_lengths.float().mean().item()
+            rest[k] = v.mean() if hasattr(v, 'mean') else v
+        rest['loss'] = optimized_loss.detach()
+        rest['sender_entropy'] = entropy_s.detach().mean()
+        rest['receiver_entropy'] = entropy_r.detach().mean()
+        rest['original_loss'] = loss.detach().mean()
+        rest['mean_length'] = message_lengths.float().mean()
 
         return optimized_loss, rest
 
     def update_baseline(self, name, value):
-        self.n_points[name] += 1
-        self.mean_baseline[name] += (value.detach().mean().item() - self.mean_baseline[name]) / self.n_points[name]
+        self.baselines[name].update(value)
 
 
 class TransformerReceiverDeterministic(nn.Module):
@@ -496,72 +603,68 @@ class TransformerSenderReinforce(nn.Module):
         nn.init.normal_(self.embed_tokens.weight, mean=0, std=self.embed_dim ** -0.5)
         self.embed_scale = math.sqrt(embed_dim)
 
+    def _sample(self, output, sequence, logits, entropy):
+        step_logits = F.log_softmax(self.embedding_to_vocab(output).float(), dim=1)
+
+        symbols, log_prob, step_entropy = sample_categorical(step_logits, greedy=not self.training)
+        entropy.append(step_entropy)
+        logits.append(log_prob)
+        sequence.append(symbols)
+
+        return (self.embed_tokens(symbols) * self.embed_scale).unsqueeze(dim=1)
+
     def generate_standard(self, encoder_state):
         batch_size = encoder_state.size(0)
-        device = encoder_state.device
 
         sequence = []
         logits = []
         entropy = []
 
-        special_symbol = self.special_symbol_embedding.expand(batch_size, -1).unsqueeze(1).to(device)
-        input = special_symbol
+        special_symbol = self.special_symbol_embedding.expand(batch_size, -1).unsqueeze(1).to(encoder_state.device)
 
+        if self.causal:
+            # the prefix does not change, hence only the new symbol is fed at each step
+            cache = self.transformer.init_cache()
+            input = special_symbol
+            for step in range(self.max_len):
+                output = self.transformer(embedded_input=input, encoder_out=encoder_state, cache=cache)
+                input = self._sample(output[:, -1, :], sequence, logits, entropy)
+            return sequence, logits, entropy
+
+        input = special_symbol
         for step in range(self.max_len):
-            if self.causal:
-                attn_mask = torch.triu(torch.ones(step+1, step+1).byte(), diagonal=1).to(device)
-                attn_mask = attn_mask.float().masked_fill(attn_mask == 1, float('-inf'))
-            else:
-                attn_mask = None
-            output = self.transformer(embedded_input=input, encoder_out=encoder_state, attn_mask=attn_mask)
-            step_logits = F.log_softmax(self.embedding_to_vocab(output[:, -1, :]), dim=1)
-
-            distr = Categorical(logits=step_logits)
-            entropy.append(distr.entropy())
-            if self.training:
-                symbols = distr.sample()
-            else:
-                symbols = step_logits.argmax(dim=1)
-            logits.append(distr.log_prob(symbols))
-            sequence.append(symbols)
-
-            new_embedding = self.embed_tokens(symbols) * self.embed_scale
-            input = torch.cat([input, new_embedding.unsqueeze(dim=1)], dim=1)
+            output = self.transformer(embedded_input=input, encoder_out=encoder_state)
+            new_embedding = self._sample(output[:, -1, :], sequence, logits, entropy)
+            input = torch.cat([input, new_embedding], dim=1)
 
         return sequence, logits, entropy
 
     def generate_inplace(self, encoder_state):
         batch_size = encoder_state.size(0)
-        device = encoder_state.device
 
         sequence = []
         logits = []
         entropy = []
 
         special_symbol = self.special_symbol_embedding.expand(batch_size, -1).unsqueeze(1).to(encoder_state.device)
+
+        if self.causal:
+            # at each step, the placeholder of the previous step is replaced by the sampled symbol: both the symbol and
+            # the new placeholder are fed, and the placeholder is dropped from the cache afterwards
+            cache = self.transformer.init_cache()
+            input = special_symbol
+            for step in range(self.max_len):
+                embedded = self.transformer(embedded_input=input, encoder_out=encoder_state, cache=cache)
+                self.transformer.truncate_cache(cache, step)
+                new_embedding = self._sample(embedded[:, -1, :], sequence, logits, entropy)
+                input = torch.cat([new_embedding, special_symbol], dim=1)
+            return sequence, logits, entropy
+
         output = []
         for step in range(self.max_len):
             input = torch.cat(output + [special_symbol], dim=1)
-            if self.causal:
-                attn_mask = torch.triu(torch.ones(step+1, step+1).byte(), diagonal=1).to(device)
-                attn_mask = attn_mask.float().masked_fill(attn_mask == 1, float('-inf'))
-            else:
-                attn_mask = None
-
-            embedded = self.transformer(embedded_input=input, encoder_out=encoder_state, attn_mask=attn_mask)
-            step_logits = F.log_softmax(self.embedding_to_vocab(embedded[:, -1, :]), dim=1)
-
-            distr = Categorical(logits=step_logits)
-            entropy.append(distr.entropy())
-            if self.training:
-                symbols = distr.sample()
-            else:
-                symbols = step_logits.argmax(dim=1)
-            logits.append(distr.log_prob(symbols))
-            sequence.append(symbols)
-
-            new_embedding = self.embed_tokens(symbols) * self.embed_scale
-            output.append(new_embedding.unsqueeze(dim=1))
+            embedded = self.transformer(embedded_input=input, encoder_out=encoder_state)
+            output.append(self._sample(embedded[:, -1, :], sequence, logits, entropy))
 
         return sequence, logits, entropy
 
@@ -0,0 +1,73 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from typing import Tuple, Union
+
+import torch
+
+# Sampling primitives used by the agent wrappers at every step of the message generation. They are equivalent to
+# creating a torch.distributions object per step and calling its methods, but without the per-step construction,
+# argument validation, and re-normalisation of the log-probabilities, which dominate the steps of small agents.
+
+
+def sample_categorical(log_probs: torch.Tensor, greedy: bool = False) \
+        -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Samples from categorical distributions given by normalised log-probabilities, as `Categorical(logits=log_probs)`
+    would, and returns the samples with their log-probabilities and the entropies of the distributions.
+
+    :param log_probs: normalised log-probabilities over the last dimension, e.g. the output of `log_softmax`
+    :param greedy: if set, the most probable outcomes are returned instead of samples (e.g. for evaluation)
+    :return: a tuple of (samples, log-probs of the samples, entropies)
+
+    >>> log_probs = torch.tensor([[0.0, -float('inf')], [-0.5, -1.0]]).log_softmax(dim=1)
+    >>> sample, log_prob, entropy = sample_categorical(log_probs, greedy=True)
+    >>> sample, log_prob.exp()
+    (tensor([0, 0]), tensor([1.0000, 0.6225]))
+    >>> torch.allclose(entropy, torch.distributions.Categorical(logits=log_probs).entropy())
+    True
+    >>> sample, log_prob, _ = sample_categorical(log_probs)
+    >>> torch.equal(log_prob, log_probs.gather(1, sample.unsqueeze(1)).squeeze(1))
+    True
+    """
+    probs = log_probs.exp()
+    # as in Categorical, the impossible outcomes contribute zeros rather than NaNs to the entropy
+    entropy = -(log_probs.clamp(min=torch.finfo(log_probs.dtype).min) * probs).sum(dim=-1)
+
+    if greedy:
+        log_prob, sample = log_probs.max(dim=-1)
+    else:
+        sample = torch.multinomial(probs.reshape(-1, probs.size(-1)), 1, True).reshape(probs.shape[:-1])
+        log_prob = log_probs.gather(-1, sample.unsqueeze(-1)).squeeze(-1)
+    return sample, log_prob, entropy
+
+
+def gumbel_softmax_sample(logits: torch.Tensor, temperature: Union[float, torch.Tensor]) -> torch.Tensor:
+    """
+    Draws a reparameterised sample from the Gumbel-Softmax (relaxed one-hot categorical) distribution, as
+    `RelaxedOneHotCategorical(logits=logits, temperature=temperature).rsample()` would.
+
+    :param logits: (possibly unnormalised) log-probabilities over the last dimension
+    :param temperature: the temperature of the distribution, a float or a (trainable) tensor
+
+    >>> sample = gumbel_softmax_sample(torch.zeros(2, 3), temperature=0.5)
+    >>> sample.size(), torch.allclose(sample.sum(dim=1), torch.ones(2))
+    (torch.Size([2, 3]), True)
+    """
+    eps = torch.finfo(logits.dtype).eps
+    uniforms = torch.rand_like(logits).clamp(min=eps, max=1 - eps)
+    gumbels = -(-uniforms.log()).log()
+    return ((logits + gumbels) / temperature).softmax(dim=-1)
+
+
+def greedy_one_hot(logits: torch.Tensor) -> torch.Tensor:
+    """
+    :return: the one-hot encodings of the most probable outcomes, e.g. the eval-time messages of the Gumbel-Softmax
+        agents
+
+    >>> greedy_one_hot(torch.tensor([[0.1, 0.7, 0.2]]))
+    tensor([[0., 1., 0.]])
+    """
+    return torch.zeros_like(logits).scatter_(-1, logits.argmax(dim=-1, keepdim=True), 1.0)
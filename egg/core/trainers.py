@@ -4,35 +4,107 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
+import copy
+import time
 import uuid
 import pathlib
-from typing import List, Optional
+import contextlib
+import itertools
+from typing import Any, Dict, List, Optional
 
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
 
-from .util import get_opts, move_to
-from .callbacks import Callback, ConsoleLogger, Checkpoint, CheckpointSaver
+from . import distributed
+from .util import get_opts, move_to, autocast, get_rng_state, set_rng_state, derive_rng_state
+from .callbacks import Callback, ConsoleLogger, Checkpoint, CheckpointSaver, CheckpointManager, StepTimer
+from .checkpointing import CHECKPOINT_SUFFIXES, load_checkpoint, read_manifest
+from .metrics import MetricsAccumulator
+from .prefetch import PrefetchIterator
+from .compilation import compile_game
+from .preemption import PreemptionHandler
+from .evaluation import AsyncEvaluator, InteractionCapture
 
 
-def _add_dicts(a, b):
-    result = dict(a)
-    for k, v in b.items():
-        result[k] = result.get(k, 0) + v
-    return result
+def _get_batch_size(batch) -> int:
+    """
+    Finds the number of samples in a batch, which is assumed to be the leading dimension of the first tensor found in it.
+
+    >>> _get_batch_size([(torch.zeros(5, 3), torch.zeros(5)), torch.zeros(1)])
+    5
+    >>> _get_batch_size([None, 1.0])
+    1
+    """
+    if torch.is_tensor(batch):
+        return batch.size(0) if batch.dim() > 0 else 1
+    if isinstance(batch, (list, tuple)):
+        for x in batch:
+            if torch.is_tensor(x) or isinstance(x, (list, tuple)):
+                return _get_batch_size(x)
+    return 1
+
+
+def _split_batch(batch, batch_size: int, micro_batch_size: int) -> list:
+    """
+    Splits a batch into micro-batches of at most `micro_batch_size` samples. Only the tensors whose leading dimension
+    equals `batch_size` are sliced, everything else is shared by all micro-batches.
+
+    >>> batch = [(torch.arange(5), torch.arange(5)), torch.zeros(1)]
+    >>> chunks = _split_batch(batch, 5, 2)
+    >>> [c[0][0].tolist() for c in chunks]
+    [[0, 1], [2, 3], [4]]
+    >>> chunks[-1][1].size()
+    torch.Size([1])
+    """
+    def _slice(x, start, end):
+        if torch.is_tensor(x) and x.dim() > 0 and x.size(0) == batch_size:
+            return x[start:end]
+        if isinstance(x, (list, tuple)):
+            return [_slice(i, start, end) for i in x]
+        return x
 
+    return [_slice(batch, start, start + micro_batch_size) for start in range(0, batch_size, micro_batch_size)]
 
-def _div_dict(d, n):
-    result = dict(d)
-    for k in result:
-        result[k] /= n
-    return result
+
+def _overrides(callback: Callback, event: str) -> bool:
+    """
+    >>> class Printer(Callback):
+    ...     def on_batch_end(self, *args): print(args)
+    >>> _overrides(Printer(), 'on_batch_end'), _overrides(Printer(), 'on_batch_begin')
+    (True, False)
+    """
+    method = getattr(callback, event)
+    return getattr(method, '__func__', method) is not getattr(Callback, event)
 
 
 class Trainer:
     """
     Implements the training logic. Some common configuration (checkpointing frequency, path, validation frequency)
     is done by checking util.common_opts that is set via the CL.
+
+    When launched with several processes (e.g. `torchrun --nproc_per_node=4 -m egg.zoo.channel.train ...`), the game is
+    wrapped in DistributedDataParallel; each process trains on its own batches and the gradients, the reported metrics,
+    and the REINFORCE baselines are averaged over the processes. Callbacks that write to the console, to Tensorboard, or
+    checkpoints are only run by the process with rank 0.
+
+    The training runs for `n_epochs` epochs or, if `--max_steps` or `--max_wall_time` is set, until that many training
+    batches are done or that time is about to run out (the final checkpoint is given the time the slowest checkpoint
+    has taken so far); when the budget runs out within an epoch, the final checkpoint resumes from the next batch.
+    The validation is run every `--validation_freq` epochs or, if `--validation_every_steps` or
+    `--validation_every_seconds` is set, every that many training batches or seconds. With `--validation_max_batches`, a validation run only uses that many batches (the first ones,
+    or a fixed random subset with `--validation_random_subset`), except for every `--validation_full_every`-th run,
+    which uses all of them; `validation_full` tells the callbacks which kind of run has just ended.
+    With `--async_validation`, the validation runs in a background thread on a replica of the game that holds a copy of
+    the weights, while the training goes on; the results are dispatched to `on_test_end` once they are ready, with
+    `validation_epoch` and `validation_step` telling the epoch and the step of the evaluated weights.
+
+    With `--preemptable`, Trainer catches SIGTERM and SIGUSR1, which Slurm sends before preempting a job: the
+    current training step is completed, a checkpoint is saved, and the process exits with the status 128 + the
+    signal number (or hands the signal over to the previously installed handler, e.g. that of submitit, which requeues
+    the job). The following run resumes from that checkpoint, hence the routine checkpoints
+    (`--preemptable_checkpoint_freq`) can be rare or disabled.
     """
     def __init__(
             self,
@@ -59,15 +131,76 @@ class Trainer:
         self.validation_data = validation_data
         common_opts = get_opts()
         self.validation_freq = common_opts.validation_freq
+        self.validation_every_steps = common_opts.validation_every_steps
+        self.validation_every_seconds = common_opts.validation_every_seconds
+        self._last_validation_time = None
+        self.max_steps = common_opts.max_steps
+        self.max_wall_time = common_opts.max_wall_time
+        self._train_start_time = None
+        self._train_start_step = 0
+        # the state of the epoch interrupted when the training budget ran out, see state_dict()
+        self._interrupted_epoch_state = None
+        self.validation_max_batches = common_opts.validation_max_batches
+        self.validation_random_subset = common_opts.validation_random_subset
+        self.validation_full_every = common_opts.validation_full_every
+        self._validation_seed = common_opts.random_seed
+        self._validation_subset = None
+        self.n_validations = 0  # the number of validation runs so far
+        self.validation_full = True  # whether the last validation run used all the validation batches
+        # the epoch (as counted by Trainer.epoch) and the training step of the weights evaluated by the last validation
+        self.validation_epoch = 0
+        self.validation_step = 0
+        self._eval_replica = None
+        self.prefetch_batches = common_opts.prefetch_batches
+        self.grad_accumulation_steps = common_opts.grad_accumulation_steps
+        self.micro_batch_size = common_opts.micro_batch_size
+        assert self.grad_accumulation_steps >= 1, 'grad_accumulation_steps must be positive'
         self.device = common_opts.device if device is None else device
+        self.precision = common_opts.precision
         self.game.to(self.device)
         # NB: some optimizers pre-allocate buffers before actually doing any steps
         # since model is placed on GPU within Trainer, this leads to having optimizer's state and model parameters
         # on different devices. Here, we protect from that by moving optimizer's internal state to the proper device
         self.optimizer.state = move_to(self.optimizer.state, self.device)
+
+        self.distributed = distributed.is_distributed()
+        if self.distributed:
+            device_ids = [self.device] if torch.device(self.device).type == 'cuda' else None
+            # games are free to have parameters that are not used at every step (e.g. by a deterministic agent)
+            self._train_game = DistributedDataParallel(self.game, device_ids=device_ids,
+                                                       find_unused_parameters=True)
+        else:
+            self._train_game = self.game
+        self._eval_game = self.game
+
+        self._async_evaluator = None
+        if common_opts.async_validation:
+            # the validation metrics would be aggregated over the workers concurrently with the gradients
+            assert not self.distributed, 'Asynchronous validation is not supported in the distributed mode'
+            self._async_evaluator = AsyncEvaluator(self.device)
+
+        if common_opts.compile:
+            # the compiled modules share the parameters with self.game, which is kept as is for checkpointing
+            self._train_game = compile_game(self._train_game)
+            self._eval_game = compile_game(self.game)
+
         self.should_stop = False
         self.start_epoch = 0  # Can be overwritten by checkpoint loader
+        self.global_step = 0  # the number of training batches processed so far
+        self.epoch = 0  # the current epoch
+        self.batch_id = 0  # the number of batches of the current epoch that are already trained
+        # the state of the training loop to be restored, see load_state_dict()
+        self._resume_state = None
+        self._callback_states = None
+        self._train_batches = None
+        self._train_accumulator = None
+        self._epoch_rng_state = None
+        # the number of samples the gradients of the current accumulation window are weighted for, and the number of
+        # samples accumulated so far, see train_epoch()
+        self._window_reference = self._window_samples = 0
         self.callbacks = callbacks
+        self.preemption = None
+        self._preemption_checkpointer = None
 
         if common_opts.load_from_checkpoint is not None:
             print(f"# Initializing model, trainer, and optimizer from {common_opts.load_from_checkpoint}")
@@ -78,8 +211,14 @@ class Trainer:
             d = self._get_preemptive_checkpoint_dir(common_opts.checkpoint_dir)
             self.checkpoint_path = d
             self.load_from_latest(d)
-            checkpointer = CheckpointSaver(self.checkpoint_path)
-            self.callbacks.append(checkpointer)
+            checkpointer = CheckpointManager(self.checkpoint_path,
+                                             checkpoint_freq=common_opts.preemptable_checkpoint_freq,
+                                             keep_last=common_opts.keep_last_checkpoints or None,
+                                             async_write=common_opts.async_checkpointing,
+                                             format=common_opts.checkpoint_format)
+            self.callbacks = (self.callbacks or []) + [checkpointer]
+            self.preemption = PreemptionHandler()
+            self._preemption_checkpointer = checkpointer
         else:
             self.checkpoint_path = None if common_opts.checkpoint_dir is None \
                 else pathlib.Path(common_opts.checkpoint_dir)
@@ -89,6 +228,62 @@ class Trainer:
                 ConsoleLogger(print_train_loss=False, as_json=False),
             ]
 
+        if not distributed.is_main_process():
+            self.callbacks = [c for c in self.callbacks if not c.main_process_only]
+
+        self._update_listeners()
+
+    def _update_listeners(self):
+        # the batch-level events are only dispatched to the callbacks that implement them; similarly, the per-phase
+        # timing is only done when requested. Otherwise, the training loop has no extra overhead
+        self._batch_begin_callbacks = [c for c in self.callbacks if _overrides(c, 'on_batch_begin')]
+        # checkpoints are saved once all the other callbacks are updated
+        self._epoch_end_callbacks = sorted(self.callbacks, key=lambda c: isinstance(c, CheckpointSaver))
+        self._batch_end_callbacks = [c for c in self._epoch_end_callbacks if _overrides(c, 'on_batch_end')]
+        self._test_batch_callbacks = [c for c in self.callbacks if _overrides(c, 'on_test_batch_end')]
+        self.step_timer = next((c for c in self.callbacks if isinstance(c, StepTimer)), None)
+
+    def _any_worker(self, flag: bool) -> bool:
+        if not self.distributed:
+            return flag
+        # the workers take the same decisions (e.g. to stop), even if the condition is only met by some of them
+        flag = torch.tensor([float(flag)], device=self.device)
+        return distributed.all_reduce_sum(flag).item() > 0
+
+    def _preempted(self) -> bool:
+        if self.preemption is None:
+            return False
+        return self._any_worker(self.preemption.requested)
+
+    def _out_of_budget(self) -> bool:
+        if self.max_steps > 0 and self.global_step >= self.max_steps:
+            return True
+        if self.max_wall_time <= 0:
+            return False
+        elapsed = time.monotonic() - self._train_start_time
+        # the time left has to fit another step and the final checkpoint
+        step_time = elapsed / max(self.global_step - self._train_start_step, 1)
+        save_time = max((c.save_seconds for c in self.callbacks if isinstance(c, CheckpointSaver)), default=0.0)
+        return self._any_worker(elapsed + step_time + save_time >= self.max_wall_time)
+
+    def _validation_due(self) -> bool:
+        if self.validation_every_steps > 0 and self.global_step % self.validation_every_steps == 0:
+            return True
+        if self.validation_every_seconds <= 0:
+            return False
+        return self._any_worker(time.monotonic() - self._last_validation_time >= self.validation_every_seconds)
+
+    def _checkpoint_and_exit(self):
+        checkpointer = self._preemption_checkpointer
+        if checkpointer in self.callbacks:
+            print(f'# preempted at epoch {self.epoch}, step {self.global_step}; saving a checkpoint', flush=True)
+            checkpointer.save_checkpoint(filename=f'step_{self.global_step}')
+            if checkpointer.writer is not None:
+                checkpointer.writer.flush()
+        # the other workers wait for the checkpoint to be written before exiting
+        distributed.barrier()
+        self.preemption.exit()
+
     def _get_preemptive_checkpoint_dir(self, checkpoint_root):
         if 'SLURM_JOB_ID' not in os.environ:
             print('Preemption flag set, but I am not running under SLURM?')
@@ -101,88 +296,442 @@ class Trainer:
 
         return d
 
-    def eval(self):
-        mean_loss = 0.0
-        mean_rest = {}
-
-        n_batches = 0
+    def _validation_batches(self, full: bool):
+        if full or self.validation_max_batches <= 0:
+            return iter(self.validation_data)
+        if not self.validation_random_subset:
+            return itertools.islice(self.validation_data, self.validation_max_batches)
+
+        if self._validation_subset is None:
+            try:
+                n_batches = len(self.validation_data)
+            except (TypeError, AttributeError):
+                # e.g. the DataLoader subclasses of the zoo that generate their batches, whose __len__ fails
+                return itertools.islice(self.validation_data, self.validation_max_batches)
+            rng = np.random.RandomState(self._validation_seed)
+            chosen = rng.choice(n_batches, size=min(self.validation_max_batches, n_batches), replace=False)
+            self._validation_subset = set(chosen.tolist())
+        # the batches are still generated up to the last chosen one, but only the chosen ones are evaluated
+        last = max(self._validation_subset)
+        return (batch for i, batch in itertools.islice(enumerate(self.validation_data), last + 1)
+                if i in self._validation_subset)
+
+    def eval(self, full: bool = True, timed: bool = True):
+        """
+        :param full: if False, only the subset of the validation batches set by `--validation_max_batches` is used
+        :param timed: if False, the evaluation steps are not measured by the StepTimer callback
+        """
         self.game.eval()
+        # the interactions are recorded with hooks, which are only supported by the non-compiled game
+        game = self.game if self._test_batch_callbacks else self._eval_game
+        return self._evaluate(game, full, self.step_timer if timed else None)
+
+    def _evaluate(self, game: torch.nn.Module, full: bool, timer: Optional[StepTimer]):
+        """
+        A single pass over the validation batches: the metrics are accumulated and, if some callbacks implement
+        `on_test_batch_end`, the interactions are published to them.
+        """
+        accumulator = MetricsAccumulator()
+        consumers = self._test_batch_callbacks
+        capture = InteractionCapture(game) if consumers else None
         with torch.no_grad():
-            for batch in self.validation_data:
+            if timer is not None:
+                timer.begin('test', self.device)
+            for batch_id, batch in enumerate(self._validation_batches(full)):
+                if timer is not None:
+                    timer.mark('data')
                 batch = move_to(batch, self.device)
-                optimized_loss, rest = self.game(*batch)
-                mean_loss += optimized_loss
-                mean_rest = _add_dicts(mean_rest, rest)
-                n_batches += 1
-        mean_loss /= n_batches
-        mean_rest = _div_dict(mean_rest, n_batches)
-
-        return mean_loss.item(), mean_rest
+                if timer is not None:
+                    timer.mark('move_to')
+                with autocast(self.device, self.precision), capture or contextlib.nullcontext():
+                    optimized_loss, rest = game(*batch)
+                accumulator.update(optimized_loss, rest, _get_batch_size(batch))
+                if timer is not None:
+                    timer.mark('forward')
+                if consumers:
+                    interaction = capture.interaction(batch, optimized_loss, rest)
+                    for callback in consumers:
+                        callback.on_test_batch_end(game, interaction, batch_id)
+                    if timer is not None:
+                        timer.mark('callbacks')
+                if timer is not None:
+                    timer.end_step(_get_batch_size(batch))
+
+        mean_loss, mean_rest = accumulator.result()
+        if timer is not None:
+            mean_rest.update(timer.summary())
+        return mean_loss, mean_rest
 
     def train_epoch(self):
-        mean_loss = 0
-        mean_rest = {}
-        n_batches = 0
+        accumulator = MetricsAccumulator()
         self.game.train()
-        for batch in self.train_data:
-            self.optimizer.zero_grad()
-            batch = move_to(batch, self.device)
-            optimized_loss, rest = self.game(*batch)
-            mean_rest = _add_dicts(mean_rest, rest)
-            optimized_loss.backward()
-            self.optimizer.step()
 
-            n_batches += 1
-            mean_loss += optimized_loss
+        resume, self._resume_state = self._resume_state, None
+        if resume is not None:
+            # the data iterator is re-created as it was at the beginning of the interrupted epoch
+            set_rng_state(resume['epoch_rng_state'])
+        self._epoch_rng_state = get_rng_state()
+        iterator = iter(self.train_data)
 
-        mean_loss /= n_batches
-        mean_rest = _div_dict(mean_rest, n_batches)
-        return mean_loss.item(), mean_rest
+        n_batches = 0
+        if resume is not None:
+            n_batches = resume['batch_id']
+            if resume['iterator'] is not None and hasattr(iterator, 'load_state_dict'):
+                iterator.load_state_dict(resume['iterator'])
+            else:
+                # the iterator cannot be restored directly, hence the batches that were already used are skipped
+                for _ in range(n_batches):
+                    next(iterator)
+            accumulator.load_state_dict(resume['metrics'])
+            set_rng_state(resume['rng_state'])
+        self.batch_id = n_batches
+
+        if self.prefetch_batches > 0:
+            batches = PrefetchIterator(iterator, n_batches=self.prefetch_batches, device=self.device)
+        else:
+            batches = iterator
+        self._train_batches, self._train_accumulator = batches, accumulator
+
+        timer = self.step_timer
+        if timer is not None:
+            timer.begin('train', self.device)
+
+        self.optimizer.zero_grad()
+        self._window_reference = self._window_samples = 0
+        if resume is not None and resume.get('grads') is not None:
+            for p, grad in zip(self._parameters(), resume['grads']):
+                p.grad = grad.to(p.device).clone() if grad is not None else None
+            self._window_reference, self._window_samples = resume['window']
+        # the time spent waiting for the batches, either generated in the loop or prefetched
+        data_wait_time = 0.0
+        data_start = time.perf_counter()
+        try:
+            for batch in batches:
+                data_wait_time += time.perf_counter() - data_start
+                if timer is not None:
+                    timer.mark('data')
+                batch = move_to(batch, self.device)
+                if timer is not None:
+                    timer.mark('move_to')
+                batch_size = _get_batch_size(batch)
+                for callback in self._batch_begin_callbacks:
+                    callback.on_batch_begin(batch, n_batches)
+
+                if 0 < self.micro_batch_size < batch_size:
+                    micro_batches = _split_batch(batch, batch_size, self.micro_batch_size)
+                else:
+                    micro_batches = [batch]
+                batch_accumulator = MetricsAccumulator() if self._batch_end_callbacks and len(micro_batches) > 1 \
+                    else None
+
+                step_follows = (n_batches + 1) % self.grad_accumulation_steps == 0
+                if self._window_samples == 0:
+                    # the losses are weighted as if all batches of the window had the size of its first one; the
+                    # gradients are corrected before the optimizer step if they do not
+                    self._window_reference = batch_size * self.grad_accumulation_steps
+                for i, micro_batch in enumerate(micro_batches):
+                    n_samples = _get_batch_size(micro_batch)
+                    # gradients are only synchronized between workers before an optimizer step
+                    if self.distributed and not (step_follows and i == len(micro_batches) - 1):
+                        sync_context = self._train_game.no_sync()
+                    else:
+                        sync_context = contextlib.nullcontext()
+
+                    with sync_context:
+                        with autocast(self.device, self.precision):
+                            optimized_loss, rest = self._train_game(*micro_batch)
+                        if timer is not None:
+                            timer.mark('forward')
+                        # each micro-batch loss is a mean over its samples; re-weight so that the accumulated gradient
+                        # equals that of the mean loss over all samples between two optimizer steps
+                        scale = n_samples / self._window_reference
+                        (optimized_loss * scale if scale != 1.0 else optimized_loss).backward()
+
+                    accumulator.update(optimized_loss, rest, n_samples)
+                    if batch_accumulator is not None:
+                        batch_accumulator.update(optimized_loss, rest, n_samples)
+                    if timer is not None:
+                        timer.mark('backward')
+
+                n_batches += 1
+                self._window_samples += batch_size
+                if n_batches % self.grad_accumulation_steps == 0:
+                    self._optimizer_step()
+                    if timer is not None:
+                        timer.mark('optimizer')
+
+                self.global_step += 1
+                self.batch_id = n_batches
+                if self._batch_end_callbacks:
+                    if batch_accumulator is not None:
+                        batch_loss, batch_rest = batch_accumulator.means()
+                    else:
+                        batch_loss, batch_rest = optimized_loss.detach(), rest
+                    for callback in self._batch_end_callbacks:
+                        callback.on_batch_end(batch, batch_loss, batch_rest, n_batches - 1)
+                if timer is not None:
+                    timer.end_step(batch_size)
+                if self._validation_due():
+                    self._validate_within_epoch()
+                    if timer is not None:
+                        timer.skip()
+                if self._async_evaluator is not None and self._async_evaluator.n_pending:
+                    self._end_async_validations()
+                if self._preempted():
+                    self._checkpoint_and_exit()
+                # the budget is only checked at the end of the gradient accumulation windows, which are not resumed
+                if n_batches % self.grad_accumulation_steps == 0 and self._out_of_budget():
+                    # the epoch is only interrupted if batches remain, hence its state is saved before looking for one
+                    state = self._epoch_state()
+                    if next(batches, None) is not None:
+                        self._interrupted_epoch_state = state
+                    break
+                if self.should_stop:
+                    break
+                data_start = time.perf_counter()
+        finally:
+            if self.prefetch_batches > 0:
+                batches.close()
+            self._train_batches, self._train_accumulator = None, None
+
+        if n_batches % self.grad_accumulation_steps != 0:
+            # the last accumulation window of the epoch is incomplete, and its gradients were not synchronized between
+            # the workers yet
+            self._optimizer_step(synchronize=True)
+
+        mean_loss, mean_rest = accumulator.result()
+        mean_rest['data_wait_time'] = data_wait_time
+        if timer is not None:
+            mean_rest.update(timer.summary())
+        return mean_loss, mean_rest
+
+    def _optimizer_step(self, synchronize: bool = False):
+        # the losses were weighted for self._window_reference samples, which differs from the number of accumulated
+        # samples with uneven batches or an incomplete window
+        scale = self._window_reference / self._window_samples
+        if synchronize:
+            scale /= distributed.get_world_size()
+        for p in self._parameters():
+            if synchronize and self.distributed:
+                if p.grad is None:
+                    # a parameter that got no gradient on this worker may have one on the others, and all the workers
+                    # have to issue the same collectives
+                    p.grad = torch.zeros_like(p)
+                distributed.all_reduce_sum(p.grad)
+            if p.grad is not None and scale != 1.0:
+                p.grad.mul_(scale)
+        self.optimizer.step()
+        self.optimizer.zero_grad()
+        self._window_samples = 0
+
+    def _validate(self, timed: bool = True):
+        if self.validation_data is None:
+            return
+        self.n_validations += 1
+        self._last_validation_time = time.monotonic()
+        full = self.validation_max_batches <= 0 or \
+            (self.validation_full_every > 0 and self.n_validations % self.validation_full_every == 0)
+
+        for callback in self.callbacks:
+            callback.on_test_begin()
+        if self._async_evaluator is not None:
+            self._start_async_validation(full)
+            return
+        validation_loss, rest = self.eval(full=full, timed=timed)
+        self._end_validation(full, self.epoch, self.global_step, validation_loss, rest)
+
+    def _end_validation(self, full: bool, epoch: int, step: int, loss: float, rest: Dict[str, Any]):
+        self.validation_full = full
+        self.validation_epoch, self.validation_step = epoch, step
+        for callback in self.callbacks:
+            callback.on_test_end(loss, rest)
+
+    def _start_async_validation(self, full: bool):
+        # the replica is only updated once the previous validation, which uses it, is complete
+        self._end_async_validations(block=True)
+        if self._eval_replica is None:
+            self._eval_replica = copy.deepcopy(self.game)
+            self._eval_replica.eval()
+        self._eval_replica.load_state_dict(self.game.state_dict())
+
+        replica = self._eval_replica
+        self._async_evaluator.submit(lambda: self._evaluate(replica, full, timer=None),
+                                     tag=(full, self.epoch, self.global_step))
+
+    def _end_async_validations(self, block: bool = False):
+        for (full, epoch, step), (loss, rest) in self._async_evaluator.completed(block=block):
+            self._end_validation(full, epoch, step, loss, rest)
+
+    def _validate_within_epoch(self):
+        # the validation does not change the random state of the training, hence the training is the same regardless
+        # of the validation schedule, and the checkpoints saved before the validation can be resumed exactly
+        rng_state = get_rng_state()
+        self._validate(timed=False)
+        set_rng_state(rng_state)
+        self.game.train()
 
     def train(self, n_epochs):
+        self._update_listeners()
+        if self._callback_states is not None:
+            self._load_callback_states(self._callback_states)
+            self._callback_states = None
         for callback in self.callbacks:
             callback.on_train_begin(self)
 
-        for epoch in range(self.start_epoch, n_epochs):
+        if self._interrupted_epoch_state is not None:
+            # continues the epoch interrupted when the budget of the previous call ran out
+            self._resume_state = dict(self._interrupted_epoch_state, batch_id=self.batch_id)
+            self.start_epoch, self._interrupted_epoch_state = self.epoch, None
+        self._train_start_time = self._last_validation_time = time.monotonic()
+        self._train_start_step = self.global_step
+        if self.preemption is not None and not self.preemption.install():
+            print('# not running in the main thread, preemption signals are not handled')
+            self.preemption = None
+        try:
+            self._train(n_epochs)
+        finally:
+            if self.preemption is not None:
+                self.preemption.uninstall()
+
+        if self._async_evaluator is not None:
+            self._end_async_validations(block=True)
+
+        for callback in self.callbacks:
+            callback.on_train_end()
+
+    def _train(self, n_epochs):
+        if self.max_steps > 0 or self.max_wall_time > 0:
+            epochs = itertools.count(self.start_epoch)
+        else:
+            epochs = range(self.start_epoch, n_epochs)
+
+        for epoch in epochs:
+            if self._out_of_budget():
+                break
+            self.epoch = epoch
             for callback in self.callbacks:
                 callback.on_epoch_begin()
 
             train_loss, train_rest = self.train_epoch()
+            if self._interrupted_epoch_state is not None:
+                # the budget ran out within the epoch, which is not complete
+                break
+            # the epoch is complete, the checkpoints saved from now on resume from the next one
+            self.epoch, self.batch_id = epoch + 1, 0
 
-            for callback in self.callbacks:
+            for callback in self._epoch_end_callbacks:
                 callback.on_epoch_end(train_loss, train_rest)
 
-            if self.validation_data is not None and self.validation_freq > 0 and epoch % self.validation_freq == 0:
-                for callback in self.callbacks:
-                    callback.on_test_begin()
-                validation_loss, rest = self.eval()
-                for callback in self.callbacks:
-                    callback.on_test_end(validation_loss, rest)
+            if self.validation_every_steps <= 0 and self.validation_every_seconds <= 0 and self.validation_freq > 0 \
+                    and epoch % self.validation_freq == 0:
+                self._validate()
+            if self._async_evaluator is not None and self._async_evaluator.n_pending:
+                self._end_async_validations()
 
+            if self._preempted():
+                self._checkpoint_and_exit()
             if self.should_stop:
                 break
 
+    def _keyed_callbacks(self):
+        # callbacks are matched by their type and their order among the callbacks of the same type
+        counts = {}
         for callback in self.callbacks:
-            callback.on_train_end()
+            name = type(callback).__name__
+            counts[name] = counts.get(name, -1) + 1
+            yield f'{name}_{counts[name]}', callback
+
+    def _load_callback_states(self, states: Dict[str, Any]):
+        for key, callback in self._keyed_callbacks():
+            if states.get(key) is not None:
+                callback.load_state_dict(states[key])
+
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        Returns the state of the training loop, such that the training can be resumed from the same point: the current
+        epoch and the number of its batches already used, the number of training steps, and the states of the callbacks.
+        When called within an epoch, the state also holds the states of the random number generators, of the
+        training data iterator, and the partial metrics of the epoch, as well as the gradients accumulated so far when
+        called within a gradient accumulation window.
+        The training data iterator is restored with its `load_state_dict()` method if it has one, otherwise the
+        used batches are re-generated and skipped. Resuming is exact (the following batches, samples, and updates are the
+        same as if the training was not interrupted) when running in a single process without prefetching.
+        Under distributed training, the checkpoints are saved by the process with rank 0, hence they hold its random and
+        iterator states; the process with rank r > 0 resumes from states derived from those of rank 0 and r instead of
+        its own (see `derive_rng_state`), so the processes keep drawing different data and samples, but only the
+        process with rank 0 resumes exactly.
+        """
+        state = dict(epoch=self.epoch, batch_id=self.batch_id, global_step=self.global_step,
+                     validations=self.n_validations,
+                     callbacks={key: callback.state_dict() for key, callback in self._keyed_callbacks()})
+        if self.batch_id > 0 and self._train_batches is not None:
+            state.update(self._epoch_state())
+        elif self.batch_id > 0 and self._interrupted_epoch_state is not None:
+            state.update(self._interrupted_epoch_state)
+        return state
+
+    def _epoch_state(self) -> Dict[str, Any]:
+        batches = self._train_batches
+        state = dict(rng_state=get_rng_state(), epoch_rng_state=self._epoch_rng_state,
+                     iterator=batches.state_dict() if hasattr(batches, 'state_dict') else None,
+                     metrics=self._train_accumulator.state_dict())
+        if self.batch_id % self.grad_accumulation_steps != 0:
+            # the gradients accumulated so far in the current window
+            state['grads'] = [p.grad.detach().clone() if p.grad is not None else None for p in self._parameters()]
+            state['window'] = (self._window_reference, self._window_samples)
+        return state
+
+    def _parameters(self) -> List[torch.nn.Parameter]:
+        return [p for group in self.optimizer.param_groups for p in group['params']]
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        self.start_epoch = self.epoch = state['epoch']
+        self.global_step = state['global_step']
+        self.n_validations = state.get('validations', 0)
+        self.batch_id = state['batch_id']
+        self._resume_state = state if 'rng_state' in state else None
+        rank = distributed.get_rank()
+        if self._resume_state is not None and rank > 0:
+            # the checkpoints hold the random state of the process with rank 0 only; the other processes derive theirs
+            # from it, so that they keep drawing different data and samples, and skip the used batches of the derived
+            # data iterator; the gradients accumulated by rank 0 are not theirs either
+            self._resume_state = dict(state, iterator=None, grads=None,
+                                      rng_state=derive_rng_state(state['rng_state'], rank),
+                                      epoch_rng_state=derive_rng_state(state['epoch_rng_state'], rank))
+        # the callbacks are not necessarily set up yet
+        self._callback_states = state['callbacks']
 
     def load(self, checkpoint: Checkpoint):
         self.game.load_state_dict(checkpoint.model_state_dict)
         self.optimizer.load_state_dict(checkpoint.optimizer_state_dict)
-        self.starting_epoch = checkpoint.epoch
+        self.start_epoch = self.epoch = checkpoint.epoch
+        if checkpoint.trainer_state is not None:
+            self.load_state_dict(checkpoint.trainer_state)
 
     def load_from_checkpoint(self, path):
         """
-        Loads the game, agents, and optimizer state from a file
+        Loads the game, agents, and optimizer state from a file, saved in either checkpoint format
         :param path: Path to the file
         """
         print(f'# loading trainer state from {path}')
-        checkpoint = torch.load(path)
+        checkpoint = load_checkpoint(path)
         self.load(checkpoint)
 
     def load_from_latest(self, path):
+        """
+        Loads the most recent checkpoint in the directory `path`, as indexed by the manifest of CheckpointManager;
+        without a manifest, the checkpoint file with the latest creation time is used.
+        """
+        path = pathlib.Path(path)
+        manifest = read_manifest(path)
+        if manifest is not None and (path / manifest['latest']).exists():
+            self.load_from_checkpoint(path / manifest['latest'])
+            return
+
         latest_file, latest_time = None, None
 
-        for file in path.glob('*.tar'):
+        files = itertools.chain.from_iterable(path.glob(f'*{suffix}') for suffix in CHECKPOINT_SUFFIXES.values())
+        for file in files:
             creation_time = os.stat(file).st_ctime
             if latest_time is None or creation_time > latest_time:
                 latest_file, latest_time = file, creation_time
@@ -3,7 +3,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-from typing import Optional
+from typing import Dict, List, Optional
 
 import math
 import torch
@@ -26,14 +26,15 @@ class SinusoidalPositionEmbedding(nn.Module):
         pos[:, 1::2] = torch.cos(pos[:, 1::2])
         self.register_buffer('pe', pos.unsqueeze(0))
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, offset: int = 0) -> torch.Tensor:
         """Updates the input embedding with positional embedding
         Arguments:
             x {torch.Tensor} -- Input tensor
+            offset {int} -- Position of the first element of the input, e.g. under incremental decoding
         Returns:
             torch.Tensor -- Input updated with positional embeddings
         """
-        t = self.pe[:, :x.size(1), :]
+        t = self.pe[:, offset:offset + x.size(1), :]
         return x + t
 
 
@@ -227,6 +228,21 @@ class TransformerDecoder(torch.nn.Module):
     """
     Does not handle the masking w.r.t. message lengths, left-to-right order, etc.
     This is supposed to be done on a higher level.
+
+    Supports incremental (left-to-right) decoding: when a `cache` (see `init_cache`) is passed, the input holds only
+    the positions that follow the cached ones, each layer attends to the cached keys and values of the previous
+    positions and appends those of the new ones. Hence, generating a sequence of length T takes O(T) position
+    evaluations instead of O(T^2). The new positions attend causally to each other, with a mask sliced from the one
+    precomputed for `max_len`.
+
+    >>> decoder = TransformerDecoder(embed_dim=8, max_len=5, num_layers=2, num_heads=2, hidden_size=16).eval()
+    >>> x, encoder_out = torch.randn(3, 5, 8), torch.randn(3, 8)
+    >>> full = decoder(x, encoder_out, attn_mask=decoder.causal_mask[:5, :5])
+    >>> cache = decoder.init_cache()
+    >>> steps = [decoder(x[:, :2], encoder_out, cache=cache)] + [decoder(x[:, i:i + 1], encoder_out, cache=cache)
+    ...                                                          for i in range(2, 5)]
+    >>> torch.allclose(full, torch.cat(steps, dim=1), atol=1e-5), decoder.cache_length(cache)
+    (True, 5)
     """
 
     def __init__(self, embed_dim, max_len, num_layers,
@@ -245,9 +261,41 @@ class TransformerDecoder(torch.nn.Module):
 
         self.layer_norm = torch.nn.LayerNorm(embed_dim)
 
-    def forward(self, embedded_input, encoder_out, key_mask=None, attn_mask=None):
+        mask = torch.triu(torch.ones(max_len, max_len, dtype=torch.bool), diagonal=1)
+        self.register_buffer('causal_mask', torch.zeros(max_len, max_len).masked_fill(mask, float('-inf')),
+                             persistent=False)
+
+    def init_cache(self) -> List[Dict[str, torch.Tensor]]:
+        """
+        :return: an empty cache for incremental decoding: the keys and values of the self-attention of each layer (and
+            the output of its attention over the encoder state, when the latter is a single vector)
+        """
+        return [{} for _ in self.layers]
+
+    @staticmethod
+    def cache_length(cache: List[Dict[str, torch.Tensor]]) -> int:
+        return cache[0]['k'].size(0) if cache and 'k' in cache[0] else 0
+
+    @staticmethod
+    def truncate_cache(cache: List[Dict[str, torch.Tensor]], length: int) -> None:
+        """
+        Drops the cached positions starting from `length`, e.g. those that are to be re-evaluated with another input.
+        """
+        for layer_cache in cache:
+            for name in ('k', 'v'):
+                if name in layer_cache:
+                    layer_cache[name] = layer_cache[name][:length]
+
+    def forward(self, embedded_input, encoder_out, key_mask=None, attn_mask=None, cache=None):
+        offset = 0
+        if cache is not None:
+            assert key_mask is None and attn_mask is None, 'the masks are not supported under incremental decoding'
+            offset = self.cache_length(cache)
+            n_new = embedded_input.size(1)
+            attn_mask = self.causal_mask[offset:offset + n_new, :offset + n_new] if n_new > 1 else None
+
         # embed positions
-        embedded_input = self.embed_positions(embedded_input)
+        embedded_input = self.embed_positions(embedded_input, offset)
 
         x = F.dropout(embedded_input, p=self.dropout, training=self.training)
 
@@ -255,9 +303,9 @@ class TransformerDecoder(torch.nn.Module):
         x = x.transpose(0, 1)
 
         # decoder layers
-        for layer in self.layers:
+        for i, layer in enumerate(self.layers):
             x, attn = layer(x, encoder_out, key_mask=key_mask,
-                            attn_mask=attn_mask)
+                            attn_mask=attn_mask, cache=cache[i] if cache is not None else None)
 
         x = self.layer_norm(x)
 
@@ -309,32 +357,69 @@ class TransformerDecoderLayer(nn.Module):
         nn.init.xavier_uniform_(self.fc2.weight)
         nn.init.constant_(self.fc2.bias, 0.)
 
+    def _cached_self_attention(self, x, attn_mask, cache):
+        """
+        Self-attention of the new positions `x` (T x B x C) over the cached positions and themselves; the keys and the
+        values of the new positions are appended to `cache`.
+        """
+        attention = self.self_attn
+        length, batch_size, embed_dim = x.size()
+        num_heads, head_dim = attention.num_heads, embed_dim // attention.num_heads
+
+        q, k, v = F.linear(x, attention.in_proj_weight, attention.in_proj_bias).chunk(3, dim=-1)
+        if 'k' in cache:
+            k, v = torch.cat([cache['k'], k]), torch.cat([cache['v'], v])
+        cache['k'], cache['v'] = k, v
+
+        def split_heads(t):
+            # T x B x C -> B x H x T x D
+            return t.reshape(t.size(0), batch_size, num_heads, head_dim).permute(1, 2, 0, 3)
+
+        if attn_mask is not None:
+            attn_mask = attn_mask.to(q.dtype)
+        x = F.scaled_dot_product_attention(split_heads(q), split_heads(k), split_heads(v), attn_mask=attn_mask,
+                                           dropout_p=attention.dropout if self.training else 0.0)
+        x = x.permute(2, 0, 1, 3).reshape(length, batch_size, embed_dim)
+        return attention.out_proj(x), None
+
     def forward(self, 
                 x,
                 encoder_out,
                 key_mask=None,
-                attn_mask=None):
+                attn_mask=None,
+                cache=None):
         residual = x
         x = self.self_attn_layer_norm(x)
-        x, attn = self.self_attn(
-            query=x,
-            key=x,
-            value=x,
-            key_padding_mask=key_mask,
-            attn_mask=attn_mask)
+        if cache is not None:
+            x, attn = self._cached_self_attention(x, attn_mask, cache)
+        else:
+            x, attn = self.self_attn(
+                query=x,
+                key=x,
+                value=x,
+                key_padding_mask=key_mask,
+                attn_mask=attn_mask)
 
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = residual + x
 
         residual = x
         x = self.encoder_attn_layer_norm(x)
-        # would be a single vector, so no point in attention at all
-        x, attn = self.encoder_attn(
-            query=x,
-            key=encoder_out,
-            value=encoder_out,
-            static_kv=True,
-        )
+        # the encoder state is a single vector (B x C), i.e. a sequence of length one
+        if encoder_out.dim() == 2:
+            encoder_out = encoder_out.unsqueeze(0)
+        if cache is not None and encoder_out.size(0) == 1:
+            # a single key gets all the attention, hence the output does not depend on the query and is computed once
+            if 'encoder' not in cache:
+                cache['encoder'], _ = self.encoder_attn(query=x[:1], key=encoder_out, value=encoder_out)
+            x = cache['encoder'].expand_as(x)
+        else:
+            # would be a single vector, so no point in attention at all
+            x, attn = self.encoder_attn(
+                query=x,
+                key=encoder_out,
+                value=encoder_out,
+            )
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = residual + x
 
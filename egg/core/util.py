@@ -3,16 +3,20 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-from typing import Union, Iterable, List, Optional, Any
+from typing import Union, Iterable, List, Optional, Any, Dict
 
 import sys
 import random
 import argparse
+import contextlib
 import torch
 import numpy as np
 
 from collections import defaultdict
 
+from . import distributed
+from . import compilation
+
 common_opts = None
 optimizer = None
 summary_writer = None
@@ -30,16 +34,72 @@ def _populate_cl_params(arg_parser: argparse.ArgumentParser) -> argparse.Argumen
 
     arg_parser.add_argument('--checkpoint_freq', type=int, default=0,
                         help='How often the checkpoints are saved')
+    arg_parser.add_argument('--preemptable_checkpoint_freq', type=int, default=1,
+                        help='How often the checkpoints are saved with --preemptable; 0 disables the routine '
+                             'checkpoints, leaving those saved on preemption signals (default: 1, every epoch)')
+    arg_parser.add_argument('--keep_last_checkpoints', type=int, default=0,
+                        help='If positive, only this number of the most recent checkpoints are retained when running '
+                             'with --preemptable (default: 0, all are retained)')
+    arg_parser.add_argument('--async_checkpointing', default=False, action='store_true',
+                        help='If the flag is set, the checkpoints are written to the disk by a background thread')
+    arg_parser.add_argument('--checkpoint_format', type=str, default='torch', choices=['torch', 'flat'],
+                        help='The format of the checkpoints saved by Trainer: torch.save (`.tar`) or a memory-mappable '
+                             'flat file (`.flat`), whose weights can be loaded without the rest (default: torch)')
     arg_parser.add_argument('--validation_freq', type=int, default=1,
                         help='The validation would be run every `validation_freq` epochs')
+    arg_parser.add_argument('--validation_every_steps', type=int, default=0,
+                        help='If positive, the validation is run every `validation_every_steps` training batches '
+                             'instead of every `validation_freq` epochs (default: 0)')
+    arg_parser.add_argument('--validation_every_seconds', type=float, default=0.0,
+                        help='If positive, the validation is run once this number of seconds has passed since the '
+                             'previous one, instead of every `validation_freq` epochs (default: 0)')
+    arg_parser.add_argument('--validation_max_batches', type=int, default=0,
+                        help='If positive, each validation run uses at most this number of validation batches '
+                             '(default: 0, all batches are used)')
+    arg_parser.add_argument('--validation_random_subset', default=False, action='store_true',
+                        help='If the flag is set, the batches used under --validation_max_batches are a fixed random '
+                             'subset of the validation batches, rather than the first ones')
+    arg_parser.add_argument('--async_validation', default=False, action='store_true',
+                        help='If the flag is set, the validation runs in a background thread on a copy of the weights, '
+                             'while the training goes on')
+    arg_parser.add_argument('--validation_full_every', type=int, default=0,
+                        help='If positive, every `validation_full_every`-th validation run uses all the validation '
+                             'batches, regardless of --validation_max_batches (default: 0)')
     arg_parser.add_argument('--n_epochs', type=int, default=10,
                         help='Number of epochs to train (default: 10)')
+    arg_parser.add_argument('--max_steps', type=int, default=0,
+                        help='If positive, the training stops after this number of training batches, regardless of '
+                             'the number of epochs (default: 0)')
+    arg_parser.add_argument('--max_wall_time', type=float, default=0.0,
+                        help='If positive, the training stops before this number of seconds elapses, leaving time for '
+                             'the final checkpoint, regardless of the number of epochs (default: 0)')
+    arg_parser.add_argument('--prefetch_batches', type=int, default=0,
+                        help='If positive, the training batches are generated in a background thread and up to '
+                             '`prefetch_batches` batches are kept ready (default: 0, no prefetching)')
+    arg_parser.add_argument('--grad_accumulation_steps', type=int, default=1,
+                        help='Number of batches the gradients are accumulated over before an optimizer step '
+                             '(default: 1)')
+    arg_parser.add_argument('--micro_batch_size', type=int, default=0,
+                        help='If positive, each batch is split into micro-batches of at most this size, processed '
+                             'sequentially before an optimizer step (default: 0, no splitting)')
     arg_parser.add_argument('--load_from_checkpoint', type=str, default=None,
                         help='If the parameter is set, model, trainer, and optimizer states are loaded from the '
                              'checkpoint (default: None)')
     # cuda setup
     arg_parser.add_argument('--no_cuda', default=False, help='disable cuda',
                         action='store_true')
+    arg_parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                        help='Precision of the forward passes of the game; under bf16, torch.autocast is used while '
+                             'sampling, baselines, and the optimizer state are kept in fp32 (default: fp32)')
+    arg_parser.add_argument('--compile', default=False, action='store_true',
+                        help='If the flag is set, the game is compiled with torch.compile (with older versions of '
+                             'PyTorch, the RNN cells are scripted with TorchScript instead)')
+    arg_parser.add_argument('--compile_cache_dir', type=str, default=None,
+                        help='Directory where the compiled artifacts are cached and re-used across runs '
+                             '(default: None, the torch.compile default)')
+    arg_parser.add_argument('--distributed_backend', type=str, default='gloo',
+                        help='torch.distributed backend used when launched with several processes, e.g. by torchrun '
+                             '(default: gloo)')
     # dataset
     arg_parser.add_argument('--batch_size', type=int, default=32,
                         help='Input batch size for training (default: 32)')
@@ -99,9 +159,24 @@ def init(arg_parser:Optional[argparse.ArgumentParser] = None, params:Optional[Li
         params = sys.argv[1:]
     common_opts = _get_params(arg_parser, params)
 
+    if common_opts.compile and common_opts.compile_cache_dir is not None:
+        # has to be set before anything gets compiled
+        compilation.set_compile_cache_dir(common_opts.compile_cache_dir)
+
+    common_opts.distributed = distributed.maybe_init_distributed(common_opts.distributed_backend)
+    if common_opts.distributed and common_opts.cuda:
+        common_opts.device = f'cuda:{distributed.get_local_rank()}'
+        torch.cuda.set_device(common_opts.device)
+
     if common_opts.random_seed is None:
         common_opts.random_seed = random.randint(0, 2**31)
-    _set_seed(common_opts.random_seed)
+        if common_opts.distributed:
+            seed = [common_opts.random_seed]
+            torch.distributed.broadcast_object_list(seed, src=0)
+            common_opts.random_seed = seed[0]
+    # each process gets its own seed, so that the synthetic data generated by different workers is different; the
+    # model parameters are synchronized when the game is wrapped in DistributedDataParallel
+    _set_seed(common_opts.random_seed + distributed.get_rank())
 
     optimizers = {'adam': torch.optim.Adam,
                  'sgd': torch.optim.SGD,
@@ -149,6 +224,32 @@ def get_summary_writer() -> 'torch.utils.SummaryWriter':
     return summary_writer
 
 
+def autocast(device: Optional[torch.device] = None, precision: Optional[str] = None):
+    """
+    Returns a context manager that runs the enclosed code in the precision specified by the `precision` CL parameter.
+    Under fp32, this is a no-op.
+    :param device: device on which the computation is done (default: the CL-specified one)
+    :param precision: 'fp32' or 'bf16' (default: the CL-specified one)
+
+    >>> with autocast('cpu', 'bf16'):
+    ...     torch.nn.functional.linear(torch.ones(2, 2), torch.ones(2, 2)).dtype
+    torch.bfloat16
+    >>> with autocast('cpu', 'fp32'):
+    ...     torch.nn.functional.linear(torch.ones(2, 2), torch.ones(2, 2)).dtype
+    torch.float32
+    """
+    if precision is None:
+        precision = common_opts.precision if common_opts is not None else 'fp32'
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    if precision != 'bf16':
+        raise NotImplementedError(f'Unknown precision {precision}!')
+
+    if device is None:
+        device = common_opts.device
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+
 def _set_seed(seed) -> None:
     """
     Seeds the RNG in python.random, torch {cpu/cuda}, numpy.
@@ -169,6 +270,87 @@ def _set_seed(seed) -> None:
         torch.cuda.manual_seed_all(seed)
 
 
+def get_rng_state() -> Dict[str, Any]:
+    """
+    :return: the states of the python, numpy, torch, and (if available) CUDA random number generators
+    """
+    state = dict(python=random.getstate(), numpy=np.random.get_state(), torch=torch.get_rng_state())
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: Dict[str, Any]) -> None:
+    """
+    Restores the states of the random number generators, as returned by `get_rng_state`.
+
+    >>> state = get_rng_state()
+    >>> x = random.random(), np.random.rand(), torch.rand(1).item()
+    >>> set_rng_state(state)
+    >>> x == (random.random(), np.random.rand(), torch.rand(1).item())
+    True
+    """
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def derive_rng_state(state: Dict[str, Any], offset: int) -> Dict[str, Any]:
+    """
+    Derives a new state of the random number generators from a state returned by `get_rng_state`, as
+    `_set_seed(seed + offset)` would, with the seed drawn from `state`. The current state is not changed.
+
+    >>> state = get_rng_state()
+    >>> derive_rng_state(state, 1)['python'] == derive_rng_state(state, 1)['python']
+    True
+    >>> derive_rng_state(state, 1)['python'] == derive_rng_state(state, 2)['python']
+    False
+    >>> get_rng_state()['python'] == state['python']
+    True
+    """
+    current = get_rng_state()
+    set_rng_state(state)
+    _set_seed(torch.randint(2**31, ()).item() + offset)
+    derived = get_rng_state()
+    set_rng_state(current)
+    return derived
+
+
+class RandomStateIterator:
+    """
+    A base class for the iterators that generate the batches of an epoch with their own numpy random state, e.g. the
+    data iterators of the zoo games. Their position within the epoch is saved and restored with `state_dict()` and
+    `load_state_dict()`, hence Trainer resumes a mid-epoch checkpoint without re-generating the used batches.
+    Subclasses implement `__next__`, drawing from `self.random_state` and counting `self.batches_generated`.
+
+    >>> class Iterator(RandomStateIterator):
+    ...     def __next__(self):
+    ...         self.batches_generated += 1
+    ...         return self.random_state.randint(100)
+    >>> it = Iterator(seed=1)
+    >>> _ = next(it)
+    >>> resumed = Iterator()
+    >>> resumed.load_state_dict(it.state_dict())
+    >>> next(resumed) == next(it), resumed.batches_generated
+    (True, 2)
+    """
+    def __init__(self, seed: Optional[int] = None):
+        self.batches_generated = 0
+        self.random_state = np.random.RandomState(seed)
+
+    def __iter__(self):
+        return self
+
+    def state_dict(self) -> Dict[str, Any]:
+        return dict(batches_generated=self.batches_generated, random_state=self.random_state.get_state())
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self.batches_generated = state['batches_generated']
+        self.random_state.set_state(state['random_state'])
+
+
 def dump_sender_receiver(game: torch.nn.Module,
                          dataset: 'torch.utils.data.DataLoader',
                          gs: bool, variable_length: bool,
@@ -196,14 +378,20 @@ def dump_sender_receiver(game: torch.nn.Module,
             sender_input = move_to(batch[0], device)
             receiver_input = None if len(batch) == 2 else move_to(batch[2], device)
 
-            message = game.sender(sender_input)
+            with autocast(device):
+                message = game.sender(sender_input)
+
+                # Under GS, the only output is a message; under Reinforce, two additional tensors are returned.
+                # We don't need them.
+                if not gs: message = message[0]
 
-            # Under GS, the only output is a message; under Reinforce, two additional tensors are returned.
-            # We don't need them.
-            if not gs: message = message[0]
+                output = game.receiver(message, receiver_input)
+                if not gs: output = output[0]
 
-            output = game.receiver(message, receiver_input)
-            if not gs: output = output[0]
+            if output.is_floating_point():
+                output = output.float()
+            if gs:
+                message = message.float()
 
             if batch[1] is not None:
                 labels.extend(batch[1])
@@ -245,21 +433,22 @@ def dump_sender_receiver(game: torch.nn.Module,
     return sender_inputs, messages, receiver_inputs, receiver_outputs, labels
 
 
-def move_to(x: Any, device: torch.device) \
+def move_to(x: Any, device: torch.device, non_blocking: bool = False) \
         -> Any:
     """
     Simple utility function that moves a tensor or a dict/list/tuple of (dict/list/tuples of ...) tensors to a specified device, recursively.
     :param x: tensor, list, tuple, or dict with values that are lists, tuples or dicts with values of ...
     :param device: device to be moved to
+    :param non_blocking: if set, the copies are asynchronous wrt the host when possible (i.e. from pinned memory to GPU)
     :return: Same as input, but with all tensors placed on device. Non-tensors are not affected. For dicts, the changes are done in-place!
     """
     if hasattr(x, 'to'):
-        return x.to(device)
+        return x.to(device, non_blocking=non_blocking)
     if isinstance(x, list) or isinstance(x, tuple):
-        return [move_to(i, device) for i in x]
+        return [move_to(i, device, non_blocking) for i in x]
     if isinstance(x, dict) or isinstance(x, defaultdict):
         for k, v in x.items():
-            x[k] = move_to(v, device)
+            x[k] = move_to(v, device, non_blocking)
         return x
     return x
 
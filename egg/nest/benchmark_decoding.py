@@ -0,0 +1,81 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import json
+import time
+
+import torch
+
+import egg.core as core
+
+
+def build_sender(kind, max_len, causal, opts):
+    agent = torch.nn.Linear(opts.n_features, opts.embed_dim)
+    if kind == 'rnn':
+        return core.RnnSenderReinforce(agent, vocab_size=opts.vocab_size, embed_dim=opts.embed_dim,
+                                       hidden_size=opts.embed_dim, max_len=max_len, cell='gru')
+    return core.TransformerSenderReinforce(agent, vocab_size=opts.vocab_size, embed_dim=opts.embed_dim,
+                                           max_len=max_len, num_layers=opts.num_layers, num_heads=opts.num_heads,
+                                           hidden_size=opts.embed_dim * 2, generate_style=kind, causal=causal)
+
+
+def measure(sender, x, repeats):
+    """
+    Returns the mean time of a forward and a backward pass of the sender, in milliseconds.
+    """
+    def step():
+        sequence, log_prob, entropy = sender(x)
+        (log_prob.sum() + entropy.sum()).backward()
+
+    step()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmark_decoding: measures the forward and backward time of the "
+                                                 "REINFORCE senders across message lengths; the transformer senders "
+                                                 "decode incrementally when causal, and re-run the whole prefix at each "
+                                                 "step otherwise")
+    parser.add_argument("--senders", type=str, nargs='+', default=['standard', 'in-place', 'rnn'],
+                        choices=['standard', 'in-place', 'rnn'],
+                        help="The generate styles of TransformerSenderReinforce and/or `rnn` for RnnSenderReinforce "
+                             "(default: standard in-place rnn)")
+    parser.add_argument("--max_len", type=int, nargs='+', default=[5, 10, 20, 40],
+                        help="Message lengths (default: 5 10 20 40)")
+    parser.add_argument("--batch_size", type=int, default=32, help="Batch size (default: 32)")
+    parser.add_argument("--n_features", type=int, default=16, help="Size of the sender input (default: 16)")
+    parser.add_argument("--vocab_size", type=int, default=10, help="Vocabulary size (default: 10)")
+    parser.add_argument("--embed_dim", type=int, default=64, help="Embedding size (default: 64)")
+    parser.add_argument("--num_layers", type=int, default=2, help="Transformer layers (default: 2)")
+    parser.add_argument("--num_heads", type=int, default=4, help="Transformer attention heads (default: 4)")
+    parser.add_argument("--repeats", type=int, default=10, help="Timed passes per measurement (default: 10)")
+    parser.add_argument("--threads", type=int, default=1, help="torch threads (default: 1)")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    x = torch.randn(args.batch_size, args.n_features)
+
+    results = {}
+    for kind in args.senders:
+        for max_len in args.max_len:
+            torch.manual_seed(0)
+            incremental = measure(build_sender(kind, max_len, True, args), x, args.repeats)
+            # the non-causal transformer senders re-run the whole prefix at each step, like the decoding did before
+            # the cache; the rnn sender has a single decoding
+            full = measure(build_sender(kind, max_len, False, args), x, args.repeats) if kind != 'rnn' else None
+            results[kind, max_len] = incremental, full
+            print(json.dumps({'sender': kind, 'max_len': max_len, 'incremental_ms': incremental, 'full_ms': full}),
+                  flush=True)
+
+    print(f'# {"sender":>10} {"max_len":>8} {"full ms":>10} {"cached ms":>10} {"speedup":>8}')
+    for kind in args.senders:
+        for max_len in args.max_len:
+            incremental, full = results[kind, max_len]
+            full_str, speedup = ('-', '-') if full is None else (f'{full:.1f}', f'{full / incremental:.1f}x')
+            print(f'# {kind:>10} {max_len:>8} {full_str:>10} {incremental:10.1f} {speedup:>8}')
@@ -0,0 +1,70 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+
+def run(game, params):
+    """
+    Runs a game in a new process (hence the common options are parsed anew) and returns its wall-clock time and the
+    JSON lines it printed.
+    """
+    start = time.monotonic()
+    completed = subprocess.run([sys.executable, '-m', game] + params, stdout=subprocess.PIPE,
+                               universal_newlines=True, check=True)
+    elapsed = time.monotonic() - start
+
+    logs = []
+    for line in completed.stdout.splitlines():
+        if line.startswith('{'):
+            try:
+                logs.append(json.loads(line))
+            except ValueError:
+                pass
+    return elapsed, logs
+
+
+def last_value(logs, metric):
+    for log in reversed(logs):
+        if metric in log and log.get('mode', 'test') == 'test':
+            return log[metric]
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmark_precision: compares the speed and the outcome of a game "
+                                                 "trained with --precision=fp32 and --precision=bf16")
+    parser.add_argument("--game", type=str, required=True,
+                        help="Game's full classpath to run, e.g. egg.zoo.channel.train")
+    parser.add_argument("--metric", type=str, default='loss',
+                        help="The metric reported by the game, taken from the last JSON line that has it, e.g. `unif` "
+                             "for egg.zoo.channel.train (default: loss)")
+    parser.add_argument("--seeds", type=int, nargs='+', default=[1, 2, 3], help="Random seeds (default: 1 2 3)")
+
+    args, game_params = parser.parse_known_args()
+    # the parameters of the game can be separated by `--`
+    if game_params[:1] == ['--']:
+        game_params = game_params[1:]
+
+    results = {}
+    for precision in ['fp32', 'bf16']:
+        for seed in args.seeds:
+            params = game_params + [f'--precision={precision}', f'--random_seed={seed}']
+            elapsed, logs = run(args.game, params)
+            value = last_value(logs, args.metric)
+            results[precision, seed] = elapsed, value
+            print(json.dumps({'precision': precision, 'seed': seed, 'time': elapsed, args.metric: value}), flush=True)
+
+    fp32_time = sum(results['fp32', seed][0] for seed in args.seeds)
+    bf16_time = sum(results['bf16', seed][0] for seed in args.seeds)
+    print(f'# {"seed":>6} {"fp32 " + args.metric:>16} {"bf16 " + args.metric:>16} {"fp32 s":>8} {"bf16 s":>8}')
+    for seed in args.seeds:
+        (fp32_elapsed, fp32_value), (bf16_elapsed, bf16_value) = results['fp32', seed], results['bf16', seed]
+        print(f'# {seed:>6} {str(fp32_value):>16} {str(bf16_value):>16} {fp32_elapsed:8.1f} {bf16_elapsed:8.1f}')
+    print(f'# bf16 speedup: {fp32_time / bf16_time:.2f}x')
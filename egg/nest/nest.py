@@ -27,7 +27,8 @@ if __name__ == '__main__':
     parser.add_argument("--partition", type=str, default="dev", help="Partition requested")
     parser.add_argument("--time", type=int, default=4320, help="Job timeout")
     parser.add_argument("--checkpoint_freq", type=int, default=1,
-            help="Checkpoint frequency, imposed on an EGG game, in epochs (used to survive preemption). Disabled if set to 0.")
+            help="Checkpoint frequency, imposed on an EGG game, in epochs. Disabled if set to 0, then the checkpoints "
+                 "are only saved when the job is signalled before preemption.")
     parser.add_argument("--no_preemption", action="store_true", help="")
     parser.add_argument("--comment", type=str, help="")
 
@@ -11,7 +11,8 @@ import torch
 
 class SlurmWrapper:
     """
-    We assume that checkpointing is done within trainer, each epoch.
+    We assume that checkpointing is done within trainer: each `checkpoint_freq` epochs and when the job is signalled
+    before preemption.
     """
     def __init__(self, runnable):
         self.runnable = runnable
@@ -8,8 +8,10 @@ import torch.nn.parallel
 import torch
 import numpy as np
 
+import egg.core as core
 
-class _OneHotIterator:
+
+class _OneHotIterator(core.RandomStateIterator):
     """
     >>> it_1 = _OneHotIterator(n_features=128, n_batches_per_epoch=2, batch_size=64, probs=np.ones(128)/128, seed=1)
     >>> it_2 = _OneHotIterator(n_features=128, n_batches_per_epoch=2, batch_size=64, probs=np.ones(128)/128, seed=1)
@@ -33,6 +35,13 @@ class _OneHotIterator:
     256.0
     >>> batch[:, 2:].sum().item()
     0.0
+    >>> it = _OneHotIterator(n_features=8, n_batches_per_epoch=3, batch_size=4, probs=np.ones(8)/8, seed=1)
+    >>> _ = next(it)
+    >>> state = it.state_dict()
+    >>> resumed = _OneHotIterator(n_features=8, n_batches_per_epoch=3, batch_size=4, probs=np.ones(8)/8)
+    >>> resumed.load_state_dict(state)
+    >>> all(a[0].equal(b[0]) for a, b in zip(it, resumed)), resumed.batches_generated
+    (True, 3)
     """
     def __init__(self, n_features, n_batches_per_epoch, batch_size, probs, seed=None):
         self.n_batches_per_epoch = n_batches_per_epoch
@@ -40,11 +49,7 @@ class _OneHotIterator:
         self.batch_size = batch_size
 
         self.probs = probs
-        self.batches_generated = 0
-        self.random_state = np.random.RandomState(seed)
-
-    def __iter__(self):
-        return self
+        super(_OneHotIterator, self).__init__(seed)
 
     def __next__(self):
         if self.batches_generated >= self.n_batches_per_epoch:
@@ -74,8 +74,13 @@ def get_params(params):
 
 
 def loss(sender_input, _message, _receiver_input, receiver_output, _labels):
-    acc = (receiver_output.argmax(dim=1) == sender_input.argmax(dim=1)).detach().float()
-    loss = F.cross_entropy(receiver_output, sender_input.argmax(dim=1), reduction="none")
+    # receiver_output is either (batch size, n_features) or, for all the steps of the messages at once,
+    # (batch size, max_len, n_features)
+    target = sender_input.argmax(dim=1)
+    if receiver_output.dim() == 3:
+        target = target.unsqueeze(1).expand(-1, receiver_output.size(1))
+    acc = (receiver_output.argmax(dim=-1) == target).detach().float()
+    loss = F.cross_entropy(receiver_output.movedim(-1, 1), target, reduction="none")
     return loss, {'acc': acc}
 
 
@@ -104,7 +109,7 @@ def dump(game, n_features, device, gs_mode):
 
     print(f'Mean accuracy wrt uniform distribution is {unif_acc}')
     print(f'Mean accuracy wrt powerlaw distribution is {powerlaw_acc}')
-    print(json.dumps({'powerlaw': powerlaw_acc, 'unif': unif_acc}))
+    print(json.dumps({'powerlaw': float(powerlaw_acc), 'unif': unif_acc}))
 
 
 def main(params):
@@ -4,7 +4,8 @@
 # LICENSE file in the root directory of this source tree.
 
 import torch.nn as nn
-from torch.distributions import Categorical
+
+import egg.core as core
 
 
 class ReinforceReceiver(nn.Module):
@@ -14,16 +15,7 @@ class ReinforceReceiver(nn.Module):
 
     def forward(self, x, _input):
         logits = self.output(x).log_softmax(dim=1)
-        distr = Categorical(logits=logits)
-        entropy = distr.entropy()
-
-        if self.training:
-            sample = distr.sample()
-        else:
-            sample = logits.argmax(dim=1)
-        log_prob = distr.log_prob(sample)
-
-        return sample, log_prob, entropy
+        return core.sample_categorical(logits, greedy=not self.training)
 
 
 class Receiver(nn.Module):
@@ -89,9 +89,10 @@ def dump(game, dataset, device, is_gs):
 
 
 def differentiable_loss(_sender_input, _message, _receiver_input, receiver_output, labels):
-    labels = labels.squeeze(1)
-    acc = (receiver_output.argmax(dim=1) == labels).detach().float()
-    loss = F.cross_entropy(receiver_output, labels, reduction="none")
+    # the outputs of all the steps of the messages at once, (batch size, max_len, n_classes)
+    labels = labels.expand(-1, receiver_output.size(1))
+    acc = (receiver_output.argmax(dim=-1) == labels).detach().float()
+    loss = F.cross_entropy(receiver_output.movedim(-1, 1), labels, reduction="none")
     return loss, {'acc': acc}
 
 
@@ -169,7 +170,7 @@ if __name__ == "__main__":
         receiver = core.RnnReceiverGS(receiver, opts.vocab_size, opts.receiver_embedding,
                     opts.receiver_hidden, cell=opts.receiver_cell)
 
-        game = core.SenderReceiverRnnGS(sender, receiver, differentiable_loss)
+        game = core.SenderReceiverRnnGS(sender, receiver, differentiable_loss, sequence_loss=True)
     else:
         raise NotImplementedError(f'Unknown training mode, {opts.mode}')
 
@@ -8,6 +8,8 @@ import torch.nn.parallel
 import torch
 import numpy as np
 
+import egg.core as core
+
 
 def sender_receiver_examples(examples, n_bits, bits_s, bits_r):
     sender_examples = np.copy(examples)
@@ -23,7 +25,7 @@ def sender_receiver_examples(examples, n_bits, bits_s, bits_r):
     return sender_examples, examples, receiver_examples
 
 
-class _OneHotIterator:
+class _OneHotIterator(core.RandomStateIterator):
     """
     >>> it = _OneHotIterator(n_bits=8, bits_s=4, bits_r=4, n_batches_per_epoch=1, batch_size=128)
     >>> batch = list(it)[0]
@@ -54,11 +56,7 @@ class _OneHotIterator:
         self.bits_r = bits_r
         self.batch_size = batch_size
 
-        self.batches_generated = 0
-        self.random_state = np.random.RandomState(seed)
-
-    def __iter__(self):
-        return self
+        super(_OneHotIterator, self).__init__(seed)
 
     def __next__(self):
         if self.batches_generated >= self.n_batches_per_epoch:
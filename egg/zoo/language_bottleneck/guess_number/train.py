@@ -117,8 +117,7 @@ def main(params):
 
     loss = game.loss
 
-    intervention = CallbackEvaluator(test_loader, device=device, is_gs=opts.mode == 'gs', loss=loss, var_length=False,
-                                     input_intervention=True)
+    intervention = CallbackEvaluator(is_gs=opts.mode == 'gs', loss=loss, var_length=False, input_intervention=True)
 
     trainer = core.Trainer(
         game=game, optimizer=optimizer,
@@ -79,82 +79,87 @@ def _find_lengths(messages):
 
 
 class CallbackEvaluator(core.Callback):
-    def __init__(self, dataset, device, is_gs, loss, var_length, input_intervention=False):
-        self.dataset = dataset
+    """
+    After each validation run of Trainer, reports the accuracy under message and input interventions, and the
+    entropy/mutual information of the messages. The statistics are collected from the interactions of the validation
+    pass itself: only Receiver is run again, on the permuted messages (inputs).
+    """
+    def __init__(self, is_gs, loss, var_length, input_intervention=False):
         self.is_gs = is_gs
-        self.device = device
         self.loss = loss
         self.var_length = var_length
         self.input_intervention = input_intervention
         self.epoch = 0
+        self._reset()
 
-    def intervention_message(self, game):
-        mean_acc = 0.0
-        scaler = 0.0
+    def _reset(self):
+        self.message_stats = dict(mean_acc=0.0, scaler=0.0, corresponding_labels=[], original_messages=[],
+                                  bob_inputs=[], alice_inputs=[])
+        self.input_stats = dict(mean_acc=0.0, scaler=0.0)
+        self.symbols, self.labels = [], []
 
-        bob_label_mi = 0.
+    def on_test_begin(self):
+        self._reset()
 
-        corresponding_labels = []
-        original_messages = []
-        bob_inputs = []
-        alice_inputs = []
-
-        for batch in self.dataset:
-            batch = [x.to(self.device) for x in batch]
-            if len(batch) == 3:
-                sender_input, labels, receiver_input = batch
-            else:
-                sender_input, labels = batch
-                receiver_input = None
-
-            original_message = game.sender(sender_input)
-            # if Reinforce, agents return tuples
-            if not self.is_gs: original_message = original_message[0]
-
-            if receiver_input is not None:
-                bob_inputs.extend(receiver_input)
-            alice_inputs.extend(sender_input)
-
-            permutation = torch.randperm(original_message.size(0)).to(original_message.device)
-            message = torch.index_select(original_message, 0, permutation)
-            output = game.receiver(message, receiver_input)
-
-            if not self.is_gs: output = output[0]
-
-            if not self.var_length:
-                l, rest = self.loss(None, None, None, output, labels)
-                mean_acc += rest['acc'].mean().item()
-                scaler += 1
-
-                original_messages.extend(original_message)
-            else:
-                lengths = _find_lengths(message.argmax(dim=-1))
-                for i in range(lengths.size(0)):
-                    if lengths[i] >= output.size(1):
-                        ind = -1
-                    else:
-                        ind = lengths[i]
-                    _, _rest = self.loss(None, None, None, output[i, ind, :].unsqueeze(0), labels[i].unsqueeze(0))
+    def on_test_batch_end(self, game, interaction, batch_id):
+        self.intervention_message(game, interaction)
+        if self.input_intervention:
+            self.intervention_input(game, interaction)
+        self.validation(interaction)
+
+    def intervention_message(self, game, interaction):
+        stats = self.message_stats
+        sender_input, labels, receiver_input = interaction.sender_input, interaction.labels, interaction.receiver_input
+        original_message = interaction.message
 
-                    mean_acc += _rest['acc'].sum().item()
-                    scaler += _rest['acc'].size(0)
+        if receiver_input is not None:
+            stats['bob_inputs'].extend(receiver_input)
+        stats['alice_inputs'].extend(sender_input)
+
+        permutation = torch.randperm(original_message.size(0)).to(original_message.device)
+        message = torch.index_select(original_message, 0, permutation)
+        output = game.receiver(message, receiver_input)
+
+        if not self.is_gs: output = output[0]
+
+        if not self.var_length:
+            l, rest = self.loss(None, None, None, output, labels)
+            stats['mean_acc'] += rest['acc'].mean().item()
+            stats['scaler'] += 1
+
+            stats['original_messages'].extend(original_message)
+        else:
+            lengths = _find_lengths(message.argmax(dim=-1))
+            for i in range(lengths.size(0)):
+                if lengths[i] >= output.size(1):
+                    ind = -1
+                else:
+                    ind = lengths[i]
+                _, _rest = self.loss(None, None, None, output[i, ind, :].unsqueeze(0), labels[i].unsqueeze(0))
+
+                stats['mean_acc'] += _rest['acc'].sum().item()
+                stats['scaler'] += _rest['acc'].size(0)
+
+                message = original_message.argmax(dim=-1)
+                lengths = _find_lengths(message)
+                for i in range(lengths.size(0)):
+                    l = lengths[i]
+                    stats['original_messages'].append(message[i, :l])
 
-                    message = original_message.argmax(dim=-1)
-                    lengths = _find_lengths(message)
-                    for i in range(lengths.size(0)):
-                        l = lengths[i]
-                        original_messages.append(message[i, :l])
+        stats['corresponding_labels'].extend(labels)
 
-            corresponding_labels.extend(labels)
+    def message_intervention_result(self):
+        stats = self.message_stats
+        bob_label_mi = 0.
 
-        label_entropy = entropy(corresponding_labels)
+        label_entropy = entropy(stats['corresponding_labels'])
 
-        message_info = mutual_info(original_messages, corresponding_labels)
-        if bob_inputs:
-            bob_label_mi = mutual_info(bob_inputs, corresponding_labels)
-        alice_label_mi = mutual_info(alice_inputs, corresponding_labels)
+        message_info = mutual_info(stats['original_messages'], stats['corresponding_labels'])
+        if stats['bob_inputs']:
+            bob_label_mi = mutual_info(stats['bob_inputs'], stats['corresponding_labels'])
+        alice_label_mi = mutual_info(stats['alice_inputs'], stats['corresponding_labels'])
 
-        mean_acc /= scaler
+        mean_acc = stats['mean_acc'] / stats['scaler']
 
         s = dict(
             mean_acc=mean_acc,
@@ -166,77 +171,71 @@ class CallbackEvaluator(core.Callback):
 
         return s
 
-    def intervention_input(self, game):
-        mean_acc = 0.0
-        scaler = 0.0
-
-        for batch in self.dataset:
-            batch = [x.to(self.device) for x in batch]
-            sender_input, labels, receiver_input = batch
+    def intervention_input(self, game, interaction):
+        stats = self.input_stats
+        message, labels, receiver_input = interaction.message, interaction.labels, interaction.receiver_input
 
-            message = game.sender(sender_input)
-            # if Reinforce, agents return tuples
-            if not self.is_gs: message = message[0]
+        permutation = torch.randperm(receiver_input.size(0)).to(message.device)
+        receiver_input = torch.index_select(receiver_input, 0, permutation)
+        output = game.receiver(message, receiver_input)
 
-            permutation = torch.randperm(receiver_input.size(0)).to(message.device)
-            receiver_input = torch.index_select(receiver_input, 0, permutation)
-            output = game.receiver(message, receiver_input)
-
-            if not self.is_gs: output = output[0]
-
-            if not self.var_length:
-                l, rest = self.loss(None, None, None, output, labels)
-                mean_acc += rest['acc'].mean().item()
-                scaler += 1.0
-            else:
-                lengths = _find_lengths(message.argmax(dim=-1))
-                mean_acc = 0
-                for i in range(lengths.size(0)):
-                    if lengths[i] >= output.size(1):
-                        ind = -1
-                    else:
-                        ind = lengths[i]
-                    _, _rest = self.loss(None, None, None, output[i, ind, :].unsqueeze(0), labels[i].unsqueeze(0))
+        if not self.is_gs: output = output[0]
 
-                    mean_acc += _rest['acc'].mean().item()
-                    scaler += _rest['acc'].size(0)
-
-        mean_acc /= scaler
+        if not self.var_length:
+            l, rest = self.loss(None, None, None, output, labels)
+            stats['mean_acc'] += rest['acc'].mean().item()
+            stats['scaler'] += 1.0
+        else:
+            lengths = _find_lengths(message.argmax(dim=-1))
+            stats['mean_acc'] = 0
+            for i in range(lengths.size(0)):
+                if lengths[i] >= output.size(1):
+                    ind = -1
+                else:
+                    ind = lengths[i]
+                _, _rest = self.loss(None, None, None, output[i, ind, :].unsqueeze(0), labels[i].unsqueeze(0))
+
+                stats['mean_acc'] += _rest['acc'].mean().item()
+                stats['scaler'] += _rest['acc'].size(0)
+
+    def input_intervention_result(self):
         s = dict(
-            mean_acc=mean_acc,
+            mean_acc=self.input_stats['mean_acc'] / self.input_stats['scaler'],
         )
 
         return s
 
-    def on_epoch_end(self, loss: float, logs: Dict[str, Any] = None):
-        game = self.trainer.game
-        game.eval()
-
-        intervantion_eval = self.intervention_message(game)
-        validation_eval = self.validation(game)
+    def on_test_end(self, loss: float, logs: Dict[str, Any] = None):
+        intervantion_eval = self.message_intervention_result()
+        validation_eval = self.validation_result()
 
         output = dict(epoch=self.epoch, intervention_message=intervantion_eval, validation=validation_eval)
         if self.input_intervention:
-            inp_intervention_eval = self.intervention_input(game)
+            inp_intervention_eval = self.input_intervention_result()
             output.update(dict(input_intervention=inp_intervention_eval))
 
         output_json = json.dumps(output)
         print(output_json, flush=True)
 
-        game.train()
         self.epoch += 1
 
-    def validation(self, game):
-        sender_inputs, messages, _, receiver_outputs, labels = \
-            core.dump_sender_receiver(game, self.dataset, gs=self.is_gs, device=self.device,
-                                      variable_length=self.var_length)
+    def validation(self, interaction):
+        # the same symbols as those dumped by core.dump_sender_receiver, i.e. variable-length messages end with EOS
+        message = interaction.message.argmax(dim=-1) if self.is_gs else interaction.message
+        if self.var_length:
+            self.symbols.extend(m[:length] for m, length in zip(message, _find_lengths(message).tolist()))
+        else:
+            self.symbols.extend(message)
+        self.labels.extend(interaction.labels)
 
+    def validation_result(self):
+        messages, labels = self.symbols, self.labels
         entropy_messages = entropy(messages)
 
         message_mapping = {}
 
         for message, label in zip(messages, labels):
-            message = message.item()
+            message = _hashable_tensor(message)
             label = _hashable_tensor(label)
 
             if not message in message_mapping:
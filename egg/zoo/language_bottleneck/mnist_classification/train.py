@@ -71,7 +71,7 @@ def main(params):
 
     optimizer = core.build_optimizer(game.parameters())
 
-    intervention = CallbackEvaluator(test_loader, device=opts.device, loss=game.loss,
+    intervention = CallbackEvaluator(loss=game.loss,
                                      is_gs=True,
                                      var_length=False,
                                      input_intervention=True)
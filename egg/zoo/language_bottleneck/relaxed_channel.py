@@ -4,7 +4,8 @@
 # LICENSE file in the root directory of this source tree.
 
 from torch import nn
-from torch.distributions import RelaxedOneHotCategorical
+
+import egg.core as core
 
 
 class AlwaysRelaxedWrapper(nn.Module):
@@ -17,6 +18,6 @@ class AlwaysRelaxedWrapper(nn.Module):
         logits = self.agent(*args, **kwargs)
 
         if self.training:
-            return RelaxedOneHotCategorical(logits=logits, temperature=self.temperature).rsample()
+            return core.gumbel_softmax_sample(logits, self.temperature)
         else:
             return (logits / self.temperature).softmax(dim=1)
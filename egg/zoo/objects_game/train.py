@@ -109,8 +109,10 @@ def check_args(args):
         print("| WARNING --dump_msg_folder was set without --evaluate. Evaluation will not be performed nor any results will be dumped. Please set --evaluate")
 
 def loss(_sender_input,  _message, _receiver_input, receiver_output, _labels):
-    acc = (receiver_output.argmax(dim=1) == _labels).detach().float()
-    loss = F.cross_entropy(receiver_output, _labels, reduction="none")
+    # the outputs of all the steps of the messages at once, (batch size, max_len, n_distractors + 1)
+    labels = _labels.unsqueeze(1).expand(-1, receiver_output.size(1))
+    acc = (receiver_output.argmax(dim=-1) == labels).detach().float()
+    loss = F.cross_entropy(receiver_output.movedim(-1, 1), labels, reduction="none")
     return loss, {'acc': acc}
 
 
@@ -167,7 +169,7 @@ if __name__ == "__main__":
                                     cell=opts.receiver_cell
                                     )
 
-        game = core.SenderReceiverRnnGS(sender, receiver, loss)
+        game = core.SenderReceiverRnnGS(sender, receiver, loss, sequence_loss=True)
     else:
         raise NotImplementedError(f'Unknown training mode, {opts.mode}')
 
@@ -10,16 +10,14 @@ import os
 import torch
 import numpy as np
 
+import egg.core as core
 
-class _BatchIterator:
+
+class _BatchIterator(core.RandomStateIterator):
     def __init__(self, loader, n_batches, seed=None):
         self.loader = loader
         self.n_batches = n_batches
-        self.batches_generated = 0
-        self.random_state = np.random.RandomState(seed)
-
-    def __iter__(self):
-        return self
+        super(_BatchIterator, self).__init__(seed)
 
     def __next__(self):
         if self.batches_generated > self.n_batches:
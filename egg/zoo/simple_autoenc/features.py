@@ -10,8 +10,10 @@ import os
 import torch
 import numpy as np
 
+import egg.core as core
 
-class _OneHotIterator:
+
+class _OneHotIterator(core.RandomStateIterator):
     """
     >>> it_1 = _OneHotIterator(n_features=128, n_batches_per_epoch=2, batch_size=64, seed=1)
     >>> it_2 = _OneHotIterator(n_features=128, n_batches_per_epoch=2, batch_size=64, seed=1)
@@ -34,11 +36,7 @@ class _OneHotIterator:
         self.batch_size = batch_size
 
         self.probs = np.ones(n_features) / n_features
-        self.batches_generated = 0
-        self.random_state = np.random.RandomState(seed)
-
-    def __iter__(self):
-        return self
+        super(_OneHotIterator, self).__init__(seed)
 
     def __next__(self):
         if self.batches_generated >= self.n_batches_per_epoch:
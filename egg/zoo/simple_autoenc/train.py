@@ -57,8 +57,13 @@ def get_params():
 
 
 def loss(sender_input, _message, _receiver_input, receiver_output, _labels):
-    acc = (receiver_output.argmax(dim=1) == sender_input.argmax(dim=1)).detach().float()
-    loss = F.cross_entropy(receiver_output, sender_input.argmax(dim=1), reduction="none")
+    # receiver_output is either (batch size, n_features) or, for all the steps of the messages at once,
+    # (batch size, max_len, n_features)
+    target = sender_input.argmax(dim=1)
+    if receiver_output.dim() == 3:
+        target = target.unsqueeze(1).expand(-1, receiver_output.size(1))
+    acc = (receiver_output.argmax(dim=-1) == target).detach().float()
+    loss = F.cross_entropy(receiver_output.movedim(-1, 1), target, reduction="none")
     return loss, {'acc': acc}
 
 
@@ -92,7 +97,7 @@ if __name__ == "__main__":
         receiver = core.RnnReceiverGS(receiver, opts.vocab_size, opts.receiver_embedding,
                     opts.receiver_hidden, cell=opts.receiver_cell)
 
-        game = core.SenderReceiverRnnGS(sender, receiver, loss)
+        game = core.SenderReceiverRnnGS(sender, receiver, loss, sequence_loss=True)
         callbacks = [core.TemperatureUpdater(agent=sender, decay=0.9, minimum=0.1)]
     else:
         raise NotImplementedError(f'Unknown training mode, {opts.mode}')
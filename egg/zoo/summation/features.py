@@ -10,20 +10,18 @@ import os
 import torch
 import numpy as np
 
+import egg.core as core
 
-class _DataIterator:
+
+class _DataIterator(core.RandomStateIterator):
     def __init__(self, max_n, n_batches_per_epoch, batch_size, seed=None):
         self.n_batches_per_epoch = n_batches_per_epoch
         self.max_n = max_n
         self.batch_size = batch_size
 
-        self.batches_generated = 0
-        self.random_state = np.random.RandomState(seed)
+        super(_DataIterator, self).__init__(seed)
         assert batch_size % 2 == 0
 
-    def __iter__(self):
-        return self
-
     def generate_positive_examples(self, n_examples):
         generated_n = self.random_state.randint(1, self.max_n, n_examples)
 
@@ -42,8 +42,10 @@ def get_params():
 
 
 def loss(_sender_input, _message, _receiver_input, receiver_output, labels):
-    acc = (receiver_output.argmax(dim=1) == labels).detach().float()
-    loss = F.cross_entropy(receiver_output, labels)
+    # the outputs of all the steps of the messages at once, (batch size, max_len, 2)
+    labels = labels.unsqueeze(1).expand(-1, receiver_output.size(1))
+    acc = (receiver_output.argmax(dim=-1) == labels).detach().float()
+    loss = F.cross_entropy(receiver_output.movedim(-1, 1), labels, reduction="none")
     return loss, {'acc': acc}
 
 
@@ -66,7 +68,7 @@ if __name__ == "__main__":
     receiver = core.RnnReceiverGS(receiver, opts.vocab_size, opts.receiver_embedding,
                                   opts.receiver_hidden, cell=opts.receiver_cell)
 
-    game = core.SenderReceiverRnnGS(sender, receiver, loss)
+    game = core.SenderReceiverRnnGS(sender, receiver, loss, sequence_loss=True)
 
     optimizer = core.build_optimizer(game.parameters())
 
@@ -139,3 +139,219 @@ def test_symbol_wrapper():
     output_gs = receiver(message_gs)
 
     assert output_rf.eq(output_gs).all().item() == 1
+
+
+def test_scripted_cells():
+    from egg.core.compilation import script_cells
+    core.init(params=[])
+
+    class Receiver(torch.nn.Module):
+        def __init__(self):
+            super(Receiver, self).__init__()
+            self.fc = torch.nn.Linear(5, 8)
+
+        def forward(self, x, _input=None):
+            return self.fc(x)
+
+    sender_gs = core.RnnSenderGS(ToyAgent(), vocab_size=4, embed_dim=3, hidden_size=2, max_len=4,
+                                 temperature=1.0, cell='lstm')
+    receiver_gs = core.RnnReceiverGS(Receiver(), vocab_size=4, embed_dim=3, hidden_size=5, cell='lstm')
+    sender_rf = core.RnnSenderReinforce(ToyAgent(), vocab_size=4, embed_dim=3, hidden_size=2, max_len=4,
+                                        num_layers=2, cell='lstm')
+
+    for agent, args in [(sender_gs, (BATCH_X,)), (receiver_gs, (sender_gs(BATCH_X).detach(),)),
+                        (sender_rf, (BATCH_X,))]:
+        agent.eval()
+        expected = agent(*args)
+        n_parameters = len(list(agent.parameters()))
+
+        script_cells(agent)
+        assert any(isinstance(m, torch.jit.ScriptModule) for m in agent.modules())
+        assert len(list(agent.parameters())) == n_parameters
+
+        output = agent(*args)
+        if torch.is_tensor(expected):
+            expected, output = [expected], [output]
+        for e, o in zip(expected, output):
+            assert torch.allclose(e, o)
+
+
+def test_transformer_sender_incremental_decoding():
+    from torch.distributions import Categorical
+
+    def full_prefix_generation(sender, encoder_state, in_place):
+        # the whole prefix is re-evaluated at every step
+        special_symbol = sender.special_symbol_embedding.expand(encoder_state.size(0), -1).unsqueeze(1)
+        embeddings, symbols, log_probs = [], [], []
+        for step in range(sender.max_len):
+            prefix = [special_symbol] + embeddings if not in_place else embeddings + [special_symbol]
+            output = sender.transformer(torch.cat(prefix, dim=1), encoder_state,
+                                        attn_mask=sender.transformer.causal_mask[:step + 1, :step + 1])
+            distr = Categorical(logits=F.log_softmax(sender.embedding_to_vocab(output[:, -1, :]), dim=1))
+            symbols.append(distr.sample())
+            log_probs.append(distr.log_prob(symbols[-1]))
+            embeddings.append((sender.embed_tokens(symbols[-1]) * sender.embed_scale).unsqueeze(1))
+        return torch.stack(symbols, dim=1), torch.stack(log_probs, dim=1)
+
+    for generate_style in ['standard', 'in-place']:
+        torch.manual_seed(0)
+        sender = core.TransformerSenderReinforce(torch.nn.Linear(8, 16), vocab_size=6, embed_dim=16, max_len=12,
+                                                 num_layers=2, num_heads=4, hidden_size=32,
+                                                 generate_style=generate_style, force_eos=False)
+        torch.manual_seed(1)
+        sequence, log_probs, entropy = sender(BATCH_X)
+        torch.manual_seed(1)
+        expected_sequence, expected_log_probs = full_prefix_generation(sender, sender.agent(BATCH_X),
+                                                                       generate_style == 'in-place')
+        assert torch.equal(sequence, expected_sequence)
+        assert torch.allclose(log_probs, expected_log_probs, atol=1e-5)
+
+
+def test_rnn_sender_early_exit():
+    core.init(params=[])
+
+    class Receiver(torch.nn.Module):
+        def __init__(self):
+            super(Receiver, self).__init__()
+            self.fc = torch.nn.Linear(5, 8)
+
+        def forward(self, x, _input=None):
+            return self.fc(x)
+
+    def loss(sender_input, _message, _receiver_input, receiver_output, labels):
+        return F.cross_entropy(receiver_output, labels, reduction='none'), {}
+
+    def build_game(**kwargs):
+        torch.manual_seed(0)
+        sender = core.RnnSenderReinforce(torch.nn.Linear(8, 6), vocab_size=4, embed_dim=3, hidden_size=6, max_len=10,
+                                         cell='gru', **kwargs)
+        with torch.no_grad():
+            # short messages
+            sender.hidden_to_output.bias[0] = 2.0
+        receiver = core.RnnReceiverDeterministic(Receiver(), vocab_size=4, embed_dim=3, hidden_size=5)
+        return core.SenderReceiverRnnReinforce(sender, receiver, loss, sender_entropy_coeff=0.1,
+                                               receiver_entropy_coeff=0.0, length_cost=0.01)
+
+    x, labels = torch.randn(32, 8), torch.randint(0, 8, (32,))
+    game, early_exit_game = build_game(), build_game(early_exit=True)
+    # the symbols, log-probs, and entropies up to EOS are the same, hence so is the optimized loss
+    torch.manual_seed(1)
+    expected_loss, expected_rest = game(x, labels)
+    torch.manual_seed(1)
+    loss_value, rest = early_exit_game(x, labels)
+    assert torch.allclose(loss_value, expected_loss) and rest['mean_length'] == expected_rest['mean_length']
+
+    sender, compact_sender = game.sender.eval(), build_game(early_exit=True, compact_batch=True).sender.eval()
+    message, log_prob, entropy = sender(x)
+    after_eos = torch.cumsum(message == 0, dim=1) - (message == 0).long() > 0
+    assert after_eos.any() and not after_eos[:, 0].any()
+    compact_message, compact_log_prob, compact_entropy = compact_sender(x)
+    assert compact_message.size() == message.size()
+    assert torch.equal(compact_message[~after_eos], message[~after_eos])
+    assert compact_message[after_eos].eq(0).all() and compact_log_prob[after_eos].eq(0).all()
+    assert torch.allclose(compact_entropy[~after_eos], entropy[~after_eos])
+
+
+def test_reinforce_baselines_are_buffers():
+    core.init(params=[])
+
+    class Receiver(torch.nn.Module):
+        def __init__(self):
+            super(Receiver, self).__init__()
+            self.fc = torch.nn.Linear(5, 8)
+
+        def forward(self, x, _input=None):
+            return self.fc(x)
+
+    def loss(sender_input, _message, _receiver_input, receiver_output, labels):
+        return F.cross_entropy(receiver_output, labels, reduction='none'), {}
+
+    def build_game():
+        torch.manual_seed(0)
+        sender = core.RnnSenderReinforce(torch.nn.Linear(8, 6), vocab_size=4, embed_dim=3, hidden_size=6, max_len=5)
+        receiver = core.RnnReceiverDeterministic(Receiver(), vocab_size=4, embed_dim=3, hidden_size=5)
+        return core.SenderReceiverRnnReinforce(sender, receiver, loss, sender_entropy_coeff=0.1,
+                                               receiver_entropy_coeff=0.0, length_cost=0.1)
+
+    game = build_game()
+    x, labels = torch.eye(8), torch.arange(8)
+    game(x, labels)
+    game(x, labels)
+    assert game.n_points == {'loss': 16.0, 'length': 16.0}
+    assert game.baselines['loss'].mean.dtype == torch.float64
+
+    state = game.state_dict()
+    assert 'baselines.loss.mean' in state and 'baselines.length.n_points' in state
+    restored = build_game()
+    restored.load_state_dict(state)
+    assert restored.mean_baseline == game.mean_baseline and restored.n_points == game.n_points
+
+    # the earlier state dicts kept the baselines as an extra state
+    old_state = {k: v for k, v in state.items() if not k.startswith('baselines.')}
+    old_state['_extra_state'] = dict(mean_baseline={'loss': 1.5, 'length': 2.0}, n_points={'loss': 8.0, 'length': 8.0})
+    restored.load_state_dict(old_state)
+    assert restored.mean_baseline == {'loss': 1.5, 'length': 2.0}
+    assert restored.n_points == {'loss': 8.0, 'length': 8.0}
+
+
+def test_sampling_matches_distributions():
+    log_probs = torch.randn(64, 10).log_softmax(dim=1)
+    log_probs[0, 1:] = -float('inf')
+    log_probs[0, 0] = 0.0
+
+    torch.manual_seed(0)
+    expected = torch.distributions.Categorical(logits=log_probs)
+    expected_sample = expected.sample()
+    torch.manual_seed(0)
+    sample, log_prob, entropy = core.sample_categorical(log_probs)
+    assert torch.equal(sample, expected_sample)
+    assert torch.allclose(log_prob, expected.log_prob(sample))
+    assert torch.allclose(entropy, expected.entropy())
+
+    temperature = torch.tensor([0.5])
+    torch.manual_seed(0)
+    expected_sample = torch.distributions.RelaxedOneHotCategorical(logits=log_probs, temperature=temperature).rsample()
+    torch.manual_seed(0)
+    assert torch.allclose(core.gumbel_softmax_sample(log_probs, temperature), expected_sample, atol=1e-6)
+
+
+def test_sequence_loss():
+    core.init(params=[])
+
+    class Receiver(torch.nn.Module):
+        def __init__(self):
+            super(Receiver, self).__init__()
+            self.fc = torch.nn.Linear(5, 8)
+
+        def forward(self, x, _input=None):
+            return self.fc(x)
+
+    def loss(sender_input, _message, _receiver_input, receiver_output, labels):
+        acc = (receiver_output.argmax(dim=1) == labels).float()
+        return F.cross_entropy(receiver_output, labels, reduction='none'), {'acc': acc}
+
+    def sequence_loss(sender_input, _message, _receiver_input, receiver_output, labels):
+        labels = labels.unsqueeze(1).expand(-1, receiver_output.size(1))
+        acc = (receiver_output.argmax(dim=-1) == labels).float()
+        return F.cross_entropy(receiver_output.movedim(-1, 1), labels, reduction='none'), {'acc': acc}
+
+    def build_game(loss, **kwargs):
+        torch.manual_seed(0)
+        sender = core.RnnSenderGS(torch.nn.Linear(8, 6), vocab_size=4, embed_dim=3, hidden_size=6, max_len=5,
+                                  temperature=1.0, force_eos=True)
+        receiver = core.RnnReceiverGS(Receiver(), vocab_size=4, embed_dim=3, hidden_size=5)
+        return core.SenderReceiverRnnGS(sender, receiver, loss, length_cost=0.1, **kwargs)
+
+    x, labels = torch.eye(8), torch.arange(8)
+    results = []
+    for game in [build_game(loss), build_game(sequence_loss, sequence_loss=True)]:
+        torch.manual_seed(1)
+        loss_value, rest = game(x, labels)
+        loss_value.backward()
+        results.append((loss_value, rest, game.sender.agent.weight.grad))
+
+    (expected_loss, expected_rest, expected_grad), (loss_value, rest, grad) = results
+    assert torch.allclose(loss_value, expected_loss) and torch.allclose(grad, expected_grad)
+    assert rest.keys() == expected_rest.keys()
+    for name, value in rest.items():
+        assert torch.allclose(value, expected_rest[name]), name
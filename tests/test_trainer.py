@@ -4,11 +4,18 @@
 # LICENSE file in the root directory of this source tree.
 
 
+import os
 import sys
+import csv
+import json
+import time
+import signal
 import shutil
 from pathlib import Path
 sys.path.insert(0, Path(__file__).parent.parent.resolve().as_posix())
 
+import numpy as np
+import pytest
 import torch
 from torch.nn import functional as F
 
@@ -89,11 +96,457 @@ def test_snapshoting():
     del trainer
     trainer = core.Trainer(game, optimizer, train_data=data)  # Re-instantiate trainer
     trainer.load_from_latest(CHECKPOINT_PATH)
-    assert trainer.starting_epoch == 2
+    assert trainer.start_epoch == 2
     trainer.train(3)
     shutil.rmtree(CHECKPOINT_PATH)  # Clean-up
 
 
+def test_async_checkpointing():
+    checkpoint_path = Path('./test_async_checkpoints')
+
+    core.init(params=[])
+    game = RegressionGame()
+    optimizer = torch.optim.Adam(game.parameters())
+    data = [(torch.randn(4, 8), torch.randn(4))]
+    saver = core.CheckpointSaver(checkpoint_path=checkpoint_path, async_write=True)
+    trainer = core.Trainer(game, optimizer, train_data=data, callbacks=[saver])
+    trainer.train(3)
+
+    assert sorted(p.name for p in checkpoint_path.iterdir()) == ['0.tar', '1.tar', '2.tar', 'final.tar']
+    checkpoint = torch.load(checkpoint_path / 'final.tar')
+    for name, value in game.state_dict().items():
+        assert torch.equal(checkpoint.model_state_dict[name], value)
+    assert checkpoint.optimizer_state_dict['state'][0]['exp_avg'].equal(optimizer.state_dict()['state'][0]['exp_avg'])
+    # the state at the end of the first epoch is not overwritten by the training that followed
+    assert not torch.equal(torch.load(checkpoint_path / '0.tar').model_state_dict['fc.weight'], game.fc.weight)
+    shutil.rmtree(checkpoint_path)
+
+
+def test_checkpoint_retention():
+    checkpoint_path = Path('./test_managed_checkpoints')
+
+    class ScheduledLossGame(torch.nn.Module):
+        # validation loss per epoch: 3, 1, 4, 1.5, 5, 9
+        def __init__(self):
+            super(ScheduledLossGame, self).__init__()
+            self.param = torch.nn.Parameter(torch.zeros(1))
+            self.losses = [3.0, 1.0, 4.0, 1.5, 5.0, 9.0]
+            self.n_evals = 0
+
+        def forward(self, x, y):
+            if self.training:
+                return self.param.sum(), {}
+            self.n_evals += 1
+            return self.param.sum() + self.losses[self.n_evals - 1], {}
+
+    core.init(params=[])
+    game = ScheduledLossGame()
+    manager = core.CheckpointManager(checkpoint_path, keep_last=1, keep_best=2, keep_every=3)
+    trainer = core.Trainer(game, torch.optim.SGD(game.parameters(), lr=0.0), train_data=Dataset(),
+                           validation_data=Dataset(), callbacks=[manager])
+    trainer.train(6)
+
+    # 1 and 3 are the best ones, 2 and 5 are saved after 3 and 6 epochs, and final is the latest
+    retained = ['1.tar', '2.tar', '3.tar', '5.tar', 'final.tar']
+    assert sorted(p.name for p in checkpoint_path.glob('*.tar')) == retained
+    manifest = json.loads((checkpoint_path / 'checkpoints.json').read_text())
+    assert manifest['latest'] == 'final.tar'
+    assert sorted(e['file'] for e in manifest['checkpoints']) == retained
+
+    # the manifest, rather than the timestamps, decides which checkpoint is the latest
+    torch.save(torch.load(checkpoint_path / '1.tar'), checkpoint_path / 'stray.tar')
+    trainer = core.Trainer(game, torch.optim.SGD(game.parameters(), lr=0.0), train_data=Dataset())
+    trainer.load_from_latest(checkpoint_path)
+    assert trainer.start_epoch == 6
+    shutil.rmtree(checkpoint_path)
+
+
+def test_flat_checkpoint_conversion():
+    from egg.core.checkpointing import convert_checkpoint, load_checkpoint
+
+    checkpoint_path = Path('./test_flat_checkpoints')
+    core.init(params=[])
+    game = RegressionGame()
+    optimizer = torch.optim.Adam(game.parameters())
+    trainer = core.Trainer(game, optimizer, train_data=[(torch.randn(4, 8), torch.randn(4))],
+                           callbacks=[core.CheckpointSaver(checkpoint_path)])
+    trainer.train(2)
+
+    flat_path = convert_checkpoint(checkpoint_path / 'final.tar')
+    assert flat_path == checkpoint_path / 'final.flat'
+    checkpoint, flat = torch.load(checkpoint_path / 'final.tar'), load_checkpoint(flat_path)
+    assert flat.epoch == checkpoint.epoch == 2 and flat.trainer_state['global_step'] == 2
+    for name, value in checkpoint.model_state_dict.items():
+        assert torch.equal(flat.model_state_dict[name], value)
+    assert flat.optimizer_state_dict['param_groups'] == checkpoint.optimizer_state_dict['param_groups']
+    assert flat.optimizer_state_dict['state'][0]['exp_avg'].equal(checkpoint.optimizer_state_dict['state'][0]['exp_avg'])
+
+    # the weights alone, e.g. for analysis
+    weights = load_checkpoint(flat_path, sections=['model_state_dict'])
+    assert weights.optimizer_state_dict is None and weights.trainer_state is None
+    game.load_state_dict(weights.model_state_dict)
+
+    trainer = core.Trainer(game, optimizer, train_data=[(torch.randn(4, 8), torch.randn(4))])
+    (checkpoint_path / 'final.tar').unlink()
+    trainer.load_from_latest(checkpoint_path)
+    assert trainer.start_epoch == 2
+    shutil.rmtree(checkpoint_path)
+
+
+def _build_resumable_game():
+    from egg.zoo.channel.features import OneHotLoader
+
+    class Receiver(torch.nn.Module):
+        def __init__(self):
+            super(Receiver, self).__init__()
+            self.fc = torch.nn.Linear(4, 8)
+
+        def forward(self, x, _input=None):
+            return F.log_softmax(self.fc(x), dim=1)
+
+    def loss(sender_input, _message, _receiver_input, receiver_output, _labels):
+        return F.nll_loss(receiver_output, sender_input.argmax(dim=1), reduction='none'), {}
+
+    sender = core.ReinforceWrapper(torch.nn.Sequential(torch.nn.Linear(8, 4), torch.nn.LogSoftmax(dim=1)))
+    receiver = core.SymbolReceiverWrapper(core.ReinforceDeterministicWrapper(Receiver()), vocab_size=4,
+                                          agent_input_size=4)
+    game = core.SymbolGameReinforce(sender, receiver, loss, sender_entropy_coeff=0.1, receiver_entropy_coeff=0.0)
+    data = OneHotLoader(n_features=8, batches_per_epoch=4, batch_size=16, probs=np.ones(8) / 8)
+    return game, torch.optim.Adam(game.parameters(), lr=1e-2), data
+
+
+@pytest.mark.parametrize('checkpoint_format', ['torch', 'flat'])
+def test_mid_epoch_resume(checkpoint_format):
+    checkpoint_path = Path('./test_resume_checkpoints')
+    suffix = '.tar' if checkpoint_format == 'torch' else '.flat'
+
+    core.init(params=['--random_seed=1'])
+    game, optimizer, data = _build_resumable_game()
+    sender = core.GumbelSoftmaxWrapper(ToyAgent(), temperature=1.0)
+    callbacks = [core.CheckpointSaver(checkpoint_path, checkpoint_freq=3, unit='step', format=checkpoint_format),
+                 core.TemperatureUpdater(sender, decay=0.5, unit='step')]
+    trainer = core.Trainer(game, optimizer, train_data=data, callbacks=callbacks)
+    trainer.train(3)
+    expected = {k: v.clone() for k, v in game.state_dict().items() if torch.is_tensor(v)}
+    expected_baseline, expected_temperature = game.mean_baseline, sender.temperature
+
+    # a new process would start from a different random state
+    core.init(params=['--random_seed=2'])
+    game, optimizer, data = _build_resumable_game()
+    sender = core.GumbelSoftmaxWrapper(ToyAgent(), temperature=1.0)
+    trainer = core.Trainer(game, optimizer, train_data=data,
+                           callbacks=[core.TemperatureUpdater(sender, decay=0.5, unit='step')])
+    # saved after the 2nd of the 4 batches of the 2nd epoch
+    trainer.load_from_checkpoint(checkpoint_path / f'step_6{suffix}')
+    assert (trainer.start_epoch, trainer.batch_id, trainer.global_step) == (1, 2, 6)
+    trainer.train(3)
+
+    assert trainer.global_step == 12
+    assert game.mean_baseline == expected_baseline and sender.temperature == expected_temperature
+    for k, v in expected.items():
+        assert torch.equal(game.state_dict()[k], v), k
+    shutil.rmtree(checkpoint_path)
+
+    # saved within a gradient accumulation window, whose gradients are restored
+    core.init(params=['--random_seed=1', '--grad_accumulation_steps=2'])
+    game, optimizer, data = _build_resumable_game()
+    callbacks = [core.CheckpointSaver(checkpoint_path, checkpoint_freq=3, unit='step', format=checkpoint_format)]
+    core.Trainer(game, optimizer, train_data=data, callbacks=callbacks).train(3)
+    expected = {k: v.clone() for k, v in game.state_dict().items() if torch.is_tensor(v)}
+
+    core.init(params=['--random_seed=2', '--grad_accumulation_steps=2'])
+    game, optimizer, data = _build_resumable_game()
+    trainer = core.Trainer(game, optimizer, train_data=data, callbacks=[])
+    trainer.load_from_checkpoint(checkpoint_path / f'step_3{suffix}')
+    assert trainer.batch_id == 3
+    trainer.train(3)
+    for k, v in expected.items():
+        assert torch.equal(game.state_dict()[k], v), k
+    shutil.rmtree(checkpoint_path)
+    core.init(params=[])
+
+
+def test_step_budget(capsys):
+    checkpoint_path = Path('./test_budget_checkpoints')
+
+    core.init(params=['--random_seed=1'])
+    game, optimizer, data = _build_resumable_game()
+    core.Trainer(game, optimizer, train_data=data, callbacks=[]).train(3)
+    expected = {k: v.clone() for k, v in game.state_dict().items() if torch.is_tensor(v)}
+
+    # the budget runs out within the 2nd epoch
+    core.init(params=['--random_seed=1', '--max_steps=6'])
+    game, optimizer, data = _build_resumable_game()
+    logger = core.ConsoleLogger(print_train_loss=True, as_json=True, print_every_steps=4)
+    trainer = core.Trainer(game, optimizer, train_data=data,
+                           callbacks=[logger, core.CheckpointSaver(checkpoint_path, checkpoint_freq=0)])
+    trainer.train(n_epochs=1)
+    assert trainer.global_step == 6 and (trainer.epoch, trainer.batch_id) == (1, 2)
+    logs = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+    assert [(log['epoch'], log.get('step')) for log in logs] == [(0, 4), (0, None)]
+
+    core.init(params=['--random_seed=2', '--max_steps=12'])
+    game, optimizer, data = _build_resumable_game()
+    trainer = core.Trainer(game, optimizer, train_data=data, callbacks=[])
+    trainer.load_from_checkpoint(checkpoint_path / 'final.tar')
+    trainer.train(n_epochs=1)
+    assert trainer.global_step == 12
+    for k, v in expected.items():
+        assert torch.equal(game.state_dict()[k], v), k
+    shutil.rmtree(checkpoint_path)
+
+    core.init(params=['--max_wall_time=1e-9'])
+    trainer = core.Trainer(MockGame(), optimizer, train_data=Dataset(), callbacks=[])
+    trainer.train(n_epochs=10)
+    assert trainer.global_step == 0
+
+    # with gradient accumulation, the budget runs out at the end of the window, not within it
+    core.init(params=['--random_seed=1', '--grad_accumulation_steps=2'])
+    game, optimizer, data = _build_resumable_game()
+    core.Trainer(game, optimizer, train_data=data, callbacks=[]).train(3)
+    expected = {k: v.clone() for k, v in game.state_dict().items() if torch.is_tensor(v)}
+
+    core.init(params=['--random_seed=1', '--grad_accumulation_steps=2', '--max_steps=5'])
+    game, optimizer, data = _build_resumable_game()
+    trainer = core.Trainer(game, optimizer, train_data=data,
+                           callbacks=[core.CheckpointSaver(checkpoint_path, checkpoint_freq=0)])
+    trainer.train(n_epochs=1)
+    assert trainer.global_step == 6 and (trainer.epoch, trainer.batch_id) == (1, 2)
+
+    core.init(params=['--random_seed=2', '--grad_accumulation_steps=2', '--max_steps=12'])
+    game, optimizer, data = _build_resumable_game()
+    trainer = core.Trainer(game, optimizer, train_data=data, callbacks=[])
+    trainer.load_from_checkpoint(checkpoint_path / 'final.tar')
+    trainer.train(n_epochs=1)
+    assert trainer.global_step == 12
+    for k, v in expected.items():
+        assert torch.equal(game.state_dict()[k], v), k
+    shutil.rmtree(checkpoint_path)
+
+    # the budget runs out on the last batch of the 2nd epoch, which is complete
+    core.init(params=['--max_steps=8'])
+    game, optimizer, data = _build_resumable_game()
+    recorder = EpochRecorder()
+    trainer = core.Trainer(game, optimizer, train_data=data, validation_data=data, callbacks=[recorder])
+    trainer.train(n_epochs=10)
+    assert recorder.epoch_ends == recorder.validations == 2
+    state = trainer.state_dict()
+    assert (state['epoch'], state['batch_id'], state['global_step']) == (2, 0, 8) and 'rng_state' not in state
+    core.init(params=[])
+
+
+class EpochRecorder(core.Callback):
+    def __init__(self):
+        self.epoch_ends, self.validations = 0, 0
+
+    def on_epoch_end(self, loss, logs=None):
+        self.epoch_ends += 1
+
+    def on_test_end(self, loss, logs=None):
+        self.validations += 1
+
+
+def test_resume_rng_state_per_rank(monkeypatch):
+    core.init(params=['--max_steps=2'])
+    game, optimizer, data = _build_resumable_game()
+    trainer = core.Trainer(game, optimizer, train_data=data, callbacks=[])
+    trainer.train(1)
+    state = trainer.state_dict()
+
+    resumed = []
+    for rank in range(3):
+        monkeypatch.setattr(core.distributed, 'get_rank', lambda: rank)
+        trainer = core.Trainer(game, optimizer, train_data=data, callbacks=[])
+        trainer.load_state_dict(state)
+        resumed.append(trainer._resume_state)
+    # the process with rank 0 resumes exactly, the others from their own derived states
+    assert resumed[0] is state
+    for name in ['rng_state', 'epoch_rng_state']:
+        torch_states = [resume[name]['torch'] for resume in resumed]
+        assert not torch.equal(torch_states[0], torch_states[1]) and not torch.equal(torch_states[1], torch_states[2])
+    core.init(params=[])
+
+
+class Preempter(core.Callback):
+    def __init__(self, step):
+        self.step = step
+
+    def on_batch_end(self, batch, loss, logs, batch_id):
+        if self.trainer.global_step == self.step:
+            os.kill(os.getpid(), signal.SIGUSR1)
+
+
+def test_preemption_signal(monkeypatch):
+    checkpoint_root = Path('./test_preemption_checkpoints')
+    shutil.rmtree(checkpoint_root, ignore_errors=True)
+    checkpoint_root.mkdir()
+    monkeypatch.setenv('SLURM_JOB_ID', '1')
+    previous_handler = signal.getsignal(signal.SIGUSR1)
+
+    # no routine checkpoints, only that saved on the signal
+    params = ['--preemptable', f'--checkpoint_dir={checkpoint_root}', '--preemptable_checkpoint_freq=0']
+    core.init(params=params)
+    game, optimizer, data = _build_resumable_game()
+    trainer = core.Trainer(game, optimizer, train_data=data, callbacks=[Preempter(step=6)])
+    with pytest.raises(SystemExit) as exit_info:
+        trainer.train(3)
+    assert exit_info.value.code == 128 + signal.SIGUSR1
+    assert signal.getsignal(signal.SIGUSR1) == previous_handler
+
+    checkpoint_path = checkpoint_root / '1_0'
+    assert sorted(p.name for p in checkpoint_path.glob('*.tar')) == ['step_6.tar']
+    expected = {k: v.clone() for k, v in game.state_dict().items() if torch.is_tensor(v)}
+
+    # the requeued job resumes from the checkpoint
+    core.init(params=params)
+    game, optimizer, data = _build_resumable_game()
+    trainer = core.Trainer(game, optimizer, train_data=data, callbacks=[])
+    assert (trainer.start_epoch, trainer.batch_id, trainer.global_step) == (1, 2, 6)
+    for k, v in expected.items():
+        assert torch.equal(game.state_dict()[k], v), k
+    trainer.train(3)
+    assert trainer.global_step == 12
+    shutil.rmtree(checkpoint_root)
+    core.init(params=[])
+
+
+class BatchIdGame(torch.nn.Module):
+    def __init__(self):
+        super(BatchIdGame, self).__init__()
+        self.param = torch.nn.Parameter(torch.Tensor([0]))
+
+    def forward(self, batch_id):
+        return self.param, {'batch_id': batch_id}
+
+
+class ValidationRecorder(core.Callback):
+    def __init__(self):
+        self.validations = []
+
+    def on_test_end(self, loss, logs=None):
+        self.validations.append((self.trainer.global_step, self.trainer.validation_full, logs['batch_id']))
+
+
+def test_validation_schedule():
+    train_data = [(torch.zeros(1),)] * 4
+    validation_data = [(torch.Tensor([i]),) for i in range(10)]
+
+    core.init(params=['--validation_every_steps=2', '--validation_max_batches=3'])
+    game, recorder = BatchIdGame(), ValidationRecorder()
+    trainer = core.Trainer(game, torch.optim.SGD(game.parameters(), lr=0.0), train_data=train_data,
+                           validation_data=validation_data, callbacks=[recorder])
+    trainer.train(2)
+    assert recorder.validations == [(step, False, 1.0) for step in (2, 4, 6, 8)]
+
+    core.init(params=['--validation_every_steps=2', '--validation_max_batches=3', '--validation_random_subset',
+                      '--validation_full_every=3'])
+    game, recorder = BatchIdGame(), ValidationRecorder()
+    early_stopper = core.EarlyStopperAccuracy(threshold=4.0, field_name='batch_id', full_validation_only=True)
+    trainer = core.Trainer(game, torch.optim.SGD(game.parameters(), lr=0.0), train_data=train_data,
+                           validation_data=validation_data, callbacks=[recorder, early_stopper])
+    trainer.train(2)
+    # the subset is the same in every run, and the training stops after the first full validation run
+    steps, full, values = zip(*recorder.validations)
+    assert steps == (2, 4, 6) and full == (False, False, True)
+    assert values[0] == values[1] and values[2] == 4.5
+    assert len(trainer._validation_subset) == 3
+    assert len(early_stopper.validation_stats) == 1 and trainer.global_step == 6
+
+    # the loaders of the zoo subclass DataLoader without having a length, hence the first batches are used
+    core.init(params=['--validation_max_batches=1', '--validation_random_subset'])
+    game, optimizer, data = _build_resumable_game()
+    recorder = EpochRecorder()
+    trainer = core.Trainer(game, optimizer, train_data=data, validation_data=data, callbacks=[recorder])
+    trainer.train(1)
+    assert recorder.validations == 1 and trainer._validation_subset is None
+    core.init(params=[])
+
+
+class SlowDataset:
+    def __iter__(self):
+        time.sleep(0.2)
+        return iter([(torch.zeros(1),)])
+
+
+class WeightGame(torch.nn.Module):
+    def __init__(self):
+        super(WeightGame, self).__init__()
+        self.param = torch.nn.Parameter(torch.Tensor([0]))
+
+    def forward(self, x):
+        return self.param.sum(), {'weight': self.param.detach(), 'neg_weight': -self.param.detach()}
+
+
+class AsyncValidationRecorder(core.Callback):
+    def __init__(self):
+        self.validations = []
+
+    def on_test_end(self, loss, logs=None):
+        self.validations.append((self.trainer.validation_epoch, self.trainer.validation_step,
+                                 self.trainer.global_step, logs['weight']))
+
+
+def test_async_validation():
+    core.init(params=['--async_validation'])
+    game, recorder = WeightGame(), AsyncValidationRecorder()
+    # each step decreases the weight by 1
+    trainer = core.Trainer(game, torch.optim.SGD(game.parameters(), lr=1.0), train_data=[(torch.zeros(1),)] * 2,
+                           validation_data=SlowDataset(), callbacks=[recorder])
+    trainer.train(3)
+    epochs, steps, current_steps, weights = zip(*recorder.validations)
+    assert epochs == (1, 2, 3) and steps == (2, 4, 6)
+    # the weights evaluated are those at the end of the epoch, while the training went on
+    assert weights == (-2.0, -4.0, -6.0)
+    assert any(current > step for step, current in zip(steps, current_steps))
+
+    game = WeightGame()
+    early_stopper = core.EarlyStopperAccuracy(threshold=3.0, field_name='neg_weight')
+    trainer = core.Trainer(game, torch.optim.SGD(game.parameters(), lr=1.0), train_data=[(torch.zeros(1),)] * 2,
+                           validation_data=SlowDataset(), callbacks=[early_stopper])
+    trainer.train(100)
+    # the training is stopped once the result of the second epoch arrives
+    assert len(early_stopper.validation_stats) >= 2 and early_stopper.validation_stats[1][1]['neg_weight'] == 4.0
+    assert trainer.global_step < 200
+    core.init(params=[])
+
+
+class InteractionRecorder(core.Callback):
+    def __init__(self):
+        self.interactions = []
+        self.receiver_outputs = []
+
+    def on_test_batch_end(self, game, interaction, batch_id):
+        self.interactions.append(interaction)
+        # e.g. an intervention runs Receiver on the altered messages
+        self.receiver_outputs.append(game.receiver(interaction.message.flip(0), None))
+
+
+def test_interaction_callbacks():
+    core.init(params=[])
+    agent = ToyAgent()
+    sender_calls = []
+    agent.register_forward_hook(lambda *args: sender_calls.append(1))
+    loss = lambda sender_input, message, receiver_input, receiver_output, labels: \
+        (F.cross_entropy(receiver_output, labels), {'acc': (receiver_output.argmax(dim=1) == labels).float()})
+    game = core.SymbolGameGS(core.GumbelSoftmaxWrapper(agent, temperature=1), Receiver(), loss)
+
+    recorder = InteractionRecorder()
+    trainer = core.Trainer(game, torch.optim.SGD(game.parameters(), lr=0.0), train_data=Dataset(),
+                           validation_data=Dataset(), callbacks=[recorder])
+    trainer.train(1)
+    # a single forward pass of Sender per batch, shared by the metrics and the callback
+    assert len(sender_calls) == 2 and len(recorder.interactions) == 1
+    interaction = recorder.interactions[0]
+    assert torch.equal(interaction.sender_input, BATCH_X) and torch.equal(interaction.labels, BATCH_Y)
+    assert interaction.receiver_input is None and 'acc' in interaction.aux
+    # under evaluation, the messages are one-hot, and Receiver outputs them as is
+    assert torch.equal(interaction.receiver_output, interaction.message)
+    assert interaction.message.sum(dim=1).eq(1).all()
+    assert torch.equal(recorder.receiver_outputs[0], interaction.message.flip(0))
+    # the hooks are removed after the validation
+    assert not game.sender._forward_hooks and not game.receiver._forward_hooks
+
+
 def test_early_stopping():
     game, data = MockGame(), Dataset()
     early_stopper = core.EarlyStopperAccuracy(threshold=0.9)
@@ -101,3 +554,341 @@ def test_early_stopping():
                            validation_data=data, callbacks=[early_stopper])
     trainer.train(1)
     assert trainer.should_stop
+
+    # without validation data, the threshold is never met
+    early_stopper = core.EarlyStopperAccuracy(threshold=0.9)
+    trainer = core.Trainer(game=game, optimizer=torch.optim.Adam(game.parameters()), train_data=data,
+                           validation_data=None, callbacks=[early_stopper])
+    trainer.train(2)
+    assert not trainer.should_stop and trainer.epoch == 2
+
+
+class UnevenDataset:
+    def __iter__(self):
+        return iter([(torch.ones(3, 8), torch.ones(3)), (torch.zeros(1, 8), torch.zeros(1))])
+
+
+class IdentityGame(torch.nn.Module):
+    def __init__(self):
+        super(IdentityGame, self).__init__()
+        self.param = torch.nn.Parameter(torch.Tensor([0]))
+
+    def forward(self, sender_input, labels):
+        return self.param.sum() + labels.mean(), {'acc': labels}
+
+
+class LossSequenceGame(torch.nn.Module):
+    def __init__(self, losses):
+        super(LossSequenceGame, self).__init__()
+        self.param = torch.nn.Parameter(torch.Tensor([0]))
+        self.losses = losses
+        self.calls = 0
+
+    def forward(self, *args):
+        loss = self.losses[min(self.calls, len(self.losses) - 1)]
+        self.calls += 1
+        return self.param * 0.0 + loss, {'acc': 1.0 - loss}
+
+
+def test_plateau_early_stopping():
+    core.init(params=[])
+    # the validation loss improves for three epochs, then plateaus
+    game = LossSequenceGame([0.0, 3.0, 0.0, 2.0, 0.0, 1.0, 0.0, 0.95, 0.0, 1.5, 0.0, 0.99])
+    stopper = core.EarlyStopperPlateau(patience=2, min_delta=0.1)
+    trainer = core.Trainer(game, torch.optim.SGD(game.parameters(), lr=0.0), train_data=Dataset(),
+                           validation_data=Dataset(), callbacks=[stopper])
+    trainer.train(100)
+    assert trainer.epoch == 5 and stopper.best == 1.0
+    assert stopper.train_stats == [] and stopper.validation_stats == []
+
+    # the training accuracy, per step
+    game = LossSequenceGame([0.5, 0.4, 0.45, 0.3, 0.35, 0.32])
+    stopper = core.EarlyStopperMovingAverage(smoothing=0.5, field_name='acc', mode='max', patience=1,
+                                             validation=False, unit='step')
+    trainer = core.Trainer(game, torch.optim.SGD(game.parameters(), lr=0.0), train_data=[(BATCH_X, BATCH_Y)] * 3,
+                           callbacks=[stopper])
+    trainer.train(100)
+    # the average accuracy is 0.5, 0.55, 0.55, 0.625, 0.6375, 0.649
+    assert trainer.global_step == 3 and stopper.bad_observations == 1
+
+    game = MockGame()
+    stopper = core.EarlyStopperWallClock(max_seconds=0.0)
+    trainer = core.Trainer(game, torch.optim.SGD(game.parameters(), lr=0.0), train_data=Dataset(),
+                           callbacks=[stopper])
+    trainer.train(100)
+    assert trainer.epoch == 1 and stopper.state_dict()['elapsed'] > 0.0
+
+
+def test_metrics_weighted_by_batch_size():
+    core.init()
+    game = IdentityGame()
+    trainer = core.Trainer(game=game, optimizer=torch.optim.SGD(game.parameters(), lr=0.0),
+                           train_data=UnevenDataset(), validation_data=UnevenDataset())
+    loss, rest = trainer.eval()
+    assert loss == 0.75 and rest['acc'] == 0.75
+    assert isinstance(rest['acc'], float)
+
+
+def test_prefetching():
+    core.init(params=['--prefetch_batches=1'])
+    game = IdentityGame()
+    trainer = core.Trainer(game=game, optimizer=torch.optim.SGD(game.parameters(), lr=0.0),
+                           train_data=UnevenDataset())
+    loss, rest = trainer.train_epoch()
+    assert loss == 0.75 and rest['acc'] == 0.75
+    assert rest['data_wait_time'] >= 0.0
+
+    # the waiting time is also reported without prefetching
+    core.init(params=[])
+    trainer = core.Trainer(game=game, optimizer=torch.optim.SGD(game.parameters(), lr=0.0),
+                           train_data=UnevenDataset())
+    _, rest = trainer.train_epoch()
+    assert rest['data_wait_time'] >= 0.0
+
+
+class BatchRecorder(core.Callback):
+    def __init__(self):
+        self.begin_ids, self.end_ids, self.losses = [], [], []
+
+    def on_batch_begin(self, batch, batch_id):
+        self.begin_ids.append(batch_id)
+
+    def on_batch_end(self, batch, loss, logs, batch_id):
+        assert torch.is_tensor(loss) and torch.is_tensor(logs['acc'])
+        self.end_ids.append(batch_id)
+        self.losses.append(loss.item())
+
+
+def test_batch_callbacks():
+    core.init(params=['--micro_batch_size=2'])
+    game = IdentityGame()
+    recorder = BatchRecorder()
+    logger = core.ConsoleLogger()
+    trainer = core.Trainer(game=game, optimizer=torch.optim.SGD(game.parameters(), lr=0.0),
+                           train_data=UnevenDataset(), callbacks=[recorder, logger])
+    trainer.train(2)
+    assert trainer._batch_end_callbacks == [recorder] and trainer._batch_begin_callbacks == [recorder]
+    assert recorder.begin_ids == recorder.end_ids == [0, 1, 0, 1]
+    # the loss of the first batch is averaged over its two micro-batches
+    assert recorder.losses == [1.0, 0.0, 1.0, 0.0]
+    assert trainer.global_step == 4
+
+    sender = core.GumbelSoftmaxWrapper(ToyAgent(), temperature=1)
+    early_stopper = core.EarlyStopperAccuracy(threshold=0.5, validation=False, unit='step')
+    trainer = core.Trainer(game=game, optimizer=torch.optim.SGD(game.parameters(), lr=0.0),
+                           train_data=UnevenDataset(),
+                           callbacks=[core.TemperatureUpdater(agent=sender, decay=0.5, unit='step'), early_stopper])
+    trainer.train(2)
+    # the first batch has accuracy 1.0, the training is stopped before the second one
+    assert trainer.global_step == 1 and early_stopper.epoch == 1
+    assert sender.temperature == 0.5
+    core.init(params=[])
+
+
+def test_step_timer(capsys):
+    core.init(params=[])
+    game = IdentityGame()
+    timer = core.StepTimer()
+    logger = core.ConsoleLogger(print_train_loss=True, as_json=True)
+    trainer = core.Trainer(game=game, optimizer=torch.optim.SGD(game.parameters(), lr=0.0),
+                           train_data=UnevenDataset(), validation_data=UnevenDataset(), callbacks=[logger, timer])
+    trainer.train(1)
+
+    train_log, test_log = [json.loads(line) for line in capsys.readouterr().out.strip().split('\n')]
+    for phase in ['data', 'move_to', 'forward', 'backward', 'optimizer']:
+        assert train_log[f'{phase}_ms_p50'] <= train_log[f'{phase}_ms_p95'] <= train_log[f'{phase}_ms_p99']
+    assert 'backward_ms_p50' not in test_log and 'forward_ms_p99' in test_log
+    assert train_log['samples_per_sec'] == 2 * train_log['steps_per_sec']
+    assert train_log['acc'] == test_log['acc'] == 0.75
+
+
+class RegressionGame(torch.nn.Module):
+    def __init__(self):
+        super(RegressionGame, self).__init__()
+        self.fc = torch.nn.Linear(8, 1)
+
+    def forward(self, x, y):
+        loss = (self.fc(x).squeeze(1) - y).pow(2.0)
+        return loss.mean(), {'mse': loss}
+
+
+def test_bf16_precision():
+    core.init(params=['--precision=bf16'])
+
+    class Receiver(torch.nn.Module):
+        def __init__(self):
+            super(Receiver, self).__init__()
+            self.fc = torch.nn.Linear(6, 8)
+
+        def forward(self, x, _input=None):
+            return self.fc(x)
+
+    def loss(sender_input, _message, _receiver_input, receiver_output, labels):
+        acc = (receiver_output.argmax(dim=1) == labels).float()
+        return F.cross_entropy(receiver_output, labels, reduction='none'), {'acc': acc}
+
+    sender = core.RnnSenderReinforce(torch.nn.Linear(8, 6), vocab_size=4, embed_dim=3, hidden_size=6, max_len=3)
+    receiver = core.RnnReceiverDeterministic(Receiver(), vocab_size=4, embed_dim=3, hidden_size=6)
+    game = core.SenderReceiverRnnReinforce(sender, receiver, loss, sender_entropy_coeff=0.1,
+                                           receiver_entropy_coeff=0.0)
+    dtypes = []
+    receiver.agent.fc.register_forward_hook(lambda _module, _input, output: dtypes.append(output.dtype))
+
+    data = [(BATCH_X, torch.arange(8))] * 2
+    trainer = core.Trainer(game, torch.optim.Adam(game.parameters(), lr=1e-2), train_data=data,
+                           validation_data=data)
+    trainer.train(2)
+    assert dtypes and all(dtype == torch.bfloat16 for dtype in dtypes)
+    loss_value, rest = trainer.eval()
+    assert np.isfinite(loss_value) and np.isfinite(rest['acc'])
+    assert all(np.isfinite(baseline) for baseline in game.mean_baseline.values())
+
+    # the dumped outputs are in fp32, regardless of the precision of the forward pass
+    _, messages, _, receiver_outputs, _ = core.dump_sender_receiver(game, [(BATCH_X, None)], gs=False,
+                                                                    variable_length=True)
+    assert len(messages) == len(receiver_outputs) == 8
+    assert all(output.dtype == torch.float32 and torch.isfinite(output).all() for output in receiver_outputs)
+    core.init(params=[])
+
+
+def test_micro_batching_gradient():
+    x, y = torch.randn(6, 8), torch.randn(6)
+
+    weights = []
+    for params in [[], ['--micro_batch_size=4'], ['--micro_batch_size=2', '--grad_accumulation_steps=2']]:
+        core.init(params=params)
+        torch.manual_seed(0)
+        game = RegressionGame()
+        data = [(x, y)] * 2 if '--grad_accumulation_steps=2' in params else [(torch.cat([x, x]), torch.cat([y, y]))]
+        trainer = core.Trainer(game=game, optimizer=torch.optim.SGD(game.parameters(), lr=0.1), train_data=data)
+        loss, rest = trainer.train_epoch()
+        assert abs(loss - rest['mse']) < 1e-5
+        weights.append(game.fc.weight.detach().clone())
+
+    assert torch.allclose(weights[0], weights[1], atol=1e-6)
+    assert torch.allclose(weights[0], weights[2], atol=1e-6)
+
+    # with uneven batches (5 + 1 samples, then an incomplete window of 3), each step uses the mean over its samples
+    weights = []
+    for params, data in [([], [(x, y), (x[:3], y[:3])]),
+                         (['--grad_accumulation_steps=2', '--micro_batch_size=2'],
+                          [(x[:5], y[:5]), (x[5:], y[5:]), (x[:3], y[:3])])]:
+        core.init(params=params)
+        torch.manual_seed(0)
+        game = RegressionGame()
+        trainer = core.Trainer(game=game, optimizer=torch.optim.SGD(game.parameters(), lr=0.1), train_data=data)
+        trainer.train_epoch()
+        weights.append(game.fc.weight.detach().clone())
+
+    assert torch.allclose(weights[0], weights[1], atol=1e-6)
+    core.init(params=[])
+
+
+def test_ensemble_training():
+    core.init(params=[])
+    x, y = torch.randn(6, 8), torch.randn(6)
+    ensemble = core.build_ensemble(RegressionGame, n_replicas=3, seed=0)
+    replicas = [ensemble.replica(i) for i in range(3)]
+    # the replicas are initialised independently
+    assert not torch.equal(replicas[0].fc.weight, replicas[1].fc.weight)
+
+    trainer = core.Trainer(game=ensemble, optimizer=torch.optim.Adam(ensemble.parameters(), lr=0.1),
+                           train_data=[(x, y)] * 3, validation_data=[(x, y)])
+    trainer.train(1)
+    validation_loss, rest = trainer.eval()
+    # a single Adam over the stacked parameters trains each replica as its own Adam would
+    for i, replica in enumerate(replicas):
+        optimizer = torch.optim.Adam(replica.parameters(), lr=0.1)
+        for _ in range(3):
+            optimizer.zero_grad()
+            replica(x, y)[0].backward()
+            optimizer.step()
+        assert torch.allclose(replica.fc.weight, ensemble.game.fc.weight[i], atol=1e-6)
+        assert abs(rest[f'loss_{i}'] - replica(x, y)[0].item()) < 1e-5
+        assert abs(rest[f'mse_{i}'] - rest[f'loss_{i}']) < 1e-5
+
+    assert abs(validation_loss - sum(rest[f'loss_{i}'] for i in range(3))) < 1e-5
+    assert abs(rest['mse'] - validation_loss / 3) < 1e-5
+
+    # running the replicas one after another gives the same results
+    vectorized = core.build_ensemble(RegressionGame, n_replicas=3, seed=1)
+    sequential = core.build_ensemble(RegressionGame, n_replicas=3, seed=1, vectorized=False)
+    (loss, rest), (sequential_loss, sequential_rest) = vectorized(x, y), sequential(x, y)
+    assert torch.allclose(loss, sequential_loss, atol=1e-6)
+    assert torch.allclose(rest['mse_2'], sequential_rest['mse_2'], atol=1e-6)
+
+
+def test_checkpoint_evaluation(tmp_path):
+    core.init(params=[])
+    x, y = torch.randn(6, 8), torch.randn(6)
+    paths, expected = [], []
+    for seed in range(3):
+        torch.manual_seed(seed)
+        game = RegressionGame()
+        saver = core.CheckpointSaver(tmp_path / str(seed))
+        trainer = core.Trainer(game=game, optimizer=torch.optim.SGD(game.parameters(), lr=0.1),
+                               train_data=[(x, y)], validation_data=[(x[:4], y[:4]), (x[4:], y[4:])],
+                               callbacks=[saver])
+        trainer.train(2)
+        paths.append(tmp_path / str(seed) / 'final.tar')
+        expected.append(trainer.eval())
+
+    table = core.evaluate_checkpoints(lambda path: RegressionGame(), paths, [(x[:4], y[:4]), (x[4:], y[4:])],
+                                      output_path=tmp_path / 'metrics.csv', group_size=2)
+    assert [row['checkpoint'] for row in table] == [str(path) for path in paths]
+    for row, (loss, rest) in zip(table, expected):
+        assert abs(row['loss'] - loss) < 1e-5 and abs(row['mse'] - rest['mse']) < 1e-5
+
+    with open(tmp_path / 'metrics.csv') as f:
+        rows = list(csv.DictReader(f))
+    assert [row['checkpoint'] for row in rows] == [str(path) for path in paths]
+    assert abs(float(rows[2]['loss']) - table[2]['loss']) < 1e-6
+
+
+def _distributed_worker(rank, world_size, port, params):
+    import os
+    import torch.distributed as dist
+
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), RANK=str(rank),
+                      WORLD_SIZE=str(world_size), LOCAL_RANK=str(rank))
+    core.init(params=['--no_cuda'] + params)
+
+    sender = core.ReinforceWrapper(ToyAgent())
+    receiver = core.ReinforceDeterministicWrapper(Receiver())
+    losses = []
+
+    def loss(sender_input, message, receiver_input, receiver_output, labels):
+        losses.append(-(receiver_output == labels).float())
+        return losses[-1], {}
+    game = core.SymbolGameReinforce(sender, receiver, loss, sender_entropy_coeff=1e-1)
+
+    # every worker has its own data
+    data = [(BATCH_X[rank::world_size], BATCH_Y[rank::world_size])]
+    trainer = core.Trainer(game, torch.optim.Adagrad(game.parameters(), lr=1e-1), train_data=data,
+                           callbacks=[core.ConsoleLogger()])
+    assert len(trainer.callbacks) == (1 if rank == 0 else 0)
+    trainer.train(5)
+
+    # destroying a gloo process group joins its threads while holding the GIL; a thread still releasing the last
+    # collective would need the GIL if that freed Python objects, hence the gathered tensors are kept alive until then
+    state = torch.cat([torch.tensor([game.mean_baseline, game.n_points, torch.cat(losses).sum()], dtype=torch.float64),
+                       sender.agent.fc1.weight.detach().flatten().double()])
+    states = [torch.empty_like(state) for _ in range(world_size)]
+    dist.all_gather(states, state)
+    for other in states:
+        assert torch.equal(other[:2], states[0][:2]) and torch.equal(other[3:], states[0][3:])
+    # DistributedDataParallel broadcasts the buffers, hence the baselines, from rank 0 at every forward pass; they have
+    # to be the mean over the losses of all workers nevertheless
+    baseline, n_points = states[0][:2].tolist()
+    assert n_points == 40 and abs(baseline - sum(other[2].item() for other in states) / n_points) < 1e-9
+    # DistributedDataParallel holds a reference to the process group, which is only destroyed with the last one
+    del trainer
+    dist.destroy_process_group()
+
+
+def test_distributed_training():
+    import random
+    torch.multiprocessing.spawn(_distributed_worker, args=(2, random.randint(20000, 40000), []), nprocs=2)
+    # each epoch ends with an incomplete accumulation window, whose gradients are synchronized after the loop
+    torch.multiprocessing.spawn(_distributed_worker, args=(2, random.randint(20000, 40000),
+                                                           ['--grad_accumulation_steps=2']), nprocs=2)